@@ -1,71 +1,313 @@
 import streamlit as st
-from PIL import Image
-from io import BytesIO
-import base64
-import os
-from streamlit_cropper import st_cropper
-from orientation import correct_image_orientation, get_orientation_from_llama
-from license_processing import process_license
-from passport_processing import process_passport
-from dotenv import load_dotenv
-import openai
+import hashlib
+import io
+import queue
+import threading
+import time
+from config import existing_client, get_api_key, get_setting
 
-# Load environment variables
-load_dotenv()
+# Streamlit reruns main() on every widget change (the cropper updates in real
+# time), so everything derived from an upload is keyed by its content hash and
+# computed once: decoded and rotated images, orientation answers and results.
+IMAGE_CACHE_ENTRIES = int(get_setting("APP_IMAGE_CACHE_ENTRIES", "32"))
+RESULTS_PER_SESSION = int(get_setting("APP_RESULTS_PER_SESSION", "20"))
+# Longest side of the images shown in the page and given to the cropper; the
+# full-resolution image is only rotated and cropped when a document is processed
+PREVIEW_MAX_SIDE = int(get_setting("APP_PREVIEW_MAX_SIDE", "1024"))
 
-# Access the API key
-API_KEY = os.getenv("API_KEY")
+# The pipeline modules (pydantic, numpy, requests, PIL) and the cropper
+# component are imported on the code paths that use them, so the first paint
+# only pays for Streamlit itself. The warm-up thread below imports them in the
+# background while the user is still choosing a file.
+PIPELINE_MODULES = ("orientation", "license_processing", "passport_processing")
 
-if not API_KEY:
-    raise ValueError("API_KEY not found in environment variables. Please set it in your .env file or in your environment.")
 
-# Set up the Fireworks client
-client = openai.Client(api_key=API_KEY, base_url="https://api.fireworks.ai/inference/v1")
+def _warm_up():
+    import importlib
+    for name in PIPELINE_MODULES:
+        importlib.import_module(name)
+    from inference_client import prewarm
+    prewarm()
 
 
+@st.cache_resource
+def warm_up_pipeline():
+    # Runs once per server process; imports and handshakes happen off the render thread
+    threading.Thread(target=_warm_up, name="pipeline-warm-up", daemon=True).start()
+    return True
 
 
+@st.cache_resource
+def serve_metrics():
+    # Prometheus endpoint, opt-in via METRICS_PORT; one per server process
+    port = get_setting("METRICS_PORT")
+    if port:
+        from metrics import start_metrics_server
+        start_metrics_server(int(port))
+    return True
 
-# Try to import LicenseData, but don't fail if it's not available
-try:
-    from license_processing import LicenseData
-    USE_LICENSE_DATA = True
-except ImportError:
-    USE_LICENSE_DATA = False
-    st.warning("LicenseData model not available. Validation will be skipped.")
 
-def encode_image_base64(img):
-    if img.mode in ('RGBA', 'LA'):
-        img = img.convert('RGB')
-    buffered = BytesIO()
-    img.save(buffered, format="JPEG")
-    return base64.b64encode(buffered.getvalue()).decode('utf-8')
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+# Images come from cache_resource so reruns get the same objects back without
+# a copy; nothing downstream modifies them. Arguments starting with "_" are not
+# hashed by Streamlit, the digest stands in for them.
+@st.cache_resource(max_entries=IMAGE_CACHE_ENTRIES, show_spinner=False)
+def decode_image(digest, _data):
+    from PIL import Image
+    image = Image.open(io.BytesIO(_data))
+    image.load()
+    return image
+
+
+@st.cache_resource(max_entries=IMAGE_CACHE_ENTRIES, show_spinner=False)
+def rotated_image(digest, angle, _image):
+    """The upload identified by digest turned clockwise by angle degrees."""
+    if angle % 360 == 0:
+        return _image
+    return _image.rotate(-angle, expand=True)
+
+
+@st.cache_resource(max_entries=IMAGE_CACHE_ENTRIES, show_spinner=False)
+def cropped_image(digest, angle, box, _image):
+    return _image.crop(box)
+
+
+@st.cache_resource(max_entries=IMAGE_CACHE_ENTRIES, show_spinner=False)
+def preview_image(digest, angle, _original):
+    """Display proxy of the upload, at most PREVIEW_MAX_SIDE pixels on its longest side,
+    turned clockwise by angle degrees."""
+    if angle % 360:
+        return preview_image(digest, 0, _original).rotate(-angle, expand=True)
+    from PIL import Image
+    scale = PREVIEW_MAX_SIDE / max(_original.size)
+    if scale >= 1:
+        return _original
+    size = (max(1, round(_original.width * scale)), max(1, round(_original.height * scale)))
+    return _original.resize(size, Image.LANCZOS, reducing_gap=3.0)
+
+
+def scale_box(box, from_size, to_size):
+    """Map a (left, top, right, bottom) box between two sizes of the same image."""
+    scale_x = to_size[0] / from_size[0]
+    scale_y = to_size[1] / from_size[1]
+    left, top, right, bottom = box
+    return (max(0, int(left * scale_x)), max(0, int(top * scale_y)),
+            min(to_size[0], round(right * scale_x)), min(to_size[1], round(bottom * scale_y)))
+
+
+def full_resolution_image(digest, angle, preview_box, original):
+    """The image to process: the chosen rotation and crop applied to the original upload."""
+    image = rotated_image(digest, angle, original)
+    if preview_box is None:
+        return image
+    preview = preview_image(digest, angle, original)
+    return cropped_image(digest, angle, scale_box(preview_box, preview.size, image.size), image)
+
+
+@st.cache_data(max_entries=IMAGE_CACHE_ENTRIES, show_spinner=False)
+def cached_orientation(digest, _image):
+    # Estimated locally first; the Llama model is only asked when unsure
+    from orientation import detect_orientation
+    return detect_orientation(_image)
+
+
+def session_store(name):
+    if name not in st.session_state:
+        st.session_state[name] = {}
+    return st.session_state[name]
+
+
+def remember_result(key, outcome):
+    results = session_store("results")
+    results.pop(key, None)
+    results[key] = outcome
+    while len(results) > RESULTS_PER_SESSION:
+        results.pop(next(iter(results)))
+
+
+STORE_DOC_TYPES = {"Passport": "passport", "Driver's License": "license"}
+
+
+def store_variant(angle, crop):
+    # Results for a rotated or cropped upload are stored apart from the upload as is
+    if not angle and crop is None:
+        return ""
+    return f"angle={angle};crop={','.join(str(round(value)) for value in crop) if crop else ''}"
+
+
+def stored_result(doc_type, digest, angle, crop):
+    """(result, buffer) from the result store for this document state, or None."""
+    from result_store import get_result_store
+    store = get_result_store()
+    if store is None:
+        return None
+    document = store.find_image(digest, STORE_DOC_TYPES[doc_type], store_variant(angle, crop))
+    if document is None:
+        return None
+    return document["result"], document["steps"] or []
+
+
+def save_result(doc_type, digest, angle, crop, result, buffer, elapsed_seconds):
+    from cascade import cascade_record
+    from result_store import get_result_store
+    store = get_result_store()
+    if store is None or result is None:
+        return
+    store.put(STORE_DOC_TYPES[doc_type], digest, result, steps=buffer, cascade=cascade_record(buffer),
+              elapsed_seconds=round(elapsed_seconds, 3), source="app", variant=store_variant(angle, crop))
+
+
+def validate_license_result(result):
+    # Try to import LicenseData, but don't fail if it's not available
+    try:
+        from license_processing import LicenseData
+    except ImportError:
+        st.warning("LicenseData model not available. Validation will be skipped.")
+        return result
+    return LicenseData(**result).dict()
+
+def format_step(step):
+    if "elapsed_seconds" not in step:
+        return step['description']
+    text = f"{step['description']} ({step['elapsed_seconds']:.2f}s"
+    metrics = step.get("metrics") or {}
+    if metrics.get("calls"):
+        text += f", {metrics['prompt_tokens'] + metrics['completion_tokens']} tokens"
+        if metrics.get("cache_hits"):
+            text += ", cached"
+        elif metrics.get("coalesced"):
+            text += ", shared with an identical request"
+    return text + ")"
+
+
+def run_with_live_progress(process, image):
+    """Run a pipeline on a worker thread and render its step events as they arrive.
+
+    Streamlit calls must stay on the script thread, so the pipeline only pushes
+    events onto a queue and this loop draws them.
+    """
+    events = queue.Queue()
+    outcome = {}
+
+    def worker():
+        try:
+            outcome["result"] = process(image, on_event=events.put)
+        except Exception as e:
+            outcome["error"] = e
+        finally:
+            events.put(None)
+
+    threading.Thread(target=worker, daemon=True).start()
+
+    status = st.status("Processing document...", expanded=True)
+    step_lines = {}
+    partial_fields = st.empty()
+    while True:
+        event = events.get()
+        if event is None:
+            break
+        if event["event"] == "step_started":
+            step_lines[event["index"]] = status.empty()
+            step_lines[event["index"]].write(f"{event['description']} running...")
+        elif event["event"] == "step_finished":
+            line = step_lines.get(event["index"]) or status.empty()
+            line.write(f"{event['description']} done ({event['elapsed_seconds']:.2f}s)")
+        elif event["event"] == "partial_result":
+            partial_fields.json(event["fields"])
+
+    partial_fields.empty()
+    if "error" in outcome:
+        status.update(label="Processing failed", state="error")
+        raise outcome["error"]
+    status.update(label="Processing complete", state="complete", expanded=False)
+    return outcome["result"]
+
+
+def show_result(doc_type, result, buffer):
+    # Display processing steps
+    with st.expander("View Processing Steps", expanded=True):
+        for step in buffer:
+            st.write(format_step(step))
+
+    # Display results
+    st.subheader("Extracted Information")
+    from cascade import cascade_record, model_label
+    cascade = cascade_record(buffer)
+    if cascade is not None:
+        text = f"Produced by cascade tier {cascade['tier']} ({model_label(cascade['model'])} {cascade['stage']})"
+        if cascade["escalations"]:
+            text += f" after {len(cascade['escalations'])} escalation(s)"
+        st.caption(text + ".")
+    if doc_type == "Driver's License":
+        # Validate the result against the LicenseData model
+        try:
+            st.json(validate_license_result(result))
+        except Exception as e:
+            st.error(f"Error in validating result: {str(e)}")
+            st.json(result)
+    else:
+        st.json(result)
+
+    # Display raw output in sidebar
+    st.sidebar.subheader("Raw Output")
+    for i, step_output in enumerate(buffer):
+        with st.sidebar.expander(f"Step {i+1} Raw Output"):
+            st.sidebar.json(step_output['raw_output'])
+
 
 def main():
     st.title("Document Processing App")
 
+    try:
+        get_api_key()
+    except ValueError as e:
+        st.error(str(e))
+        st.stop()
+
+    warm_up_pipeline()
+    serve_metrics()
+
     # Document type selection
     doc_type = st.radio("Select document type:", ("Passport", "Driver's License"))
 
     uploaded_file = st.file_uploader("Choose an image file", type=["jpg", "jpeg", "png"])
 
     if uploaded_file is not None:
-        image = Image.open(uploaded_file)
-        st.image(image, caption="Uploaded Image", use_column_width=True)
+        from streamlit_cropper import st_cropper
 
-        # Orientation check and correction
+        # Hash each upload once per session rather than on every rerun. Older
+        # Streamlit versions have no file_id, so their uploads are always hashed.
+        data = uploaded_file.getvalue()
+        digests = session_store("digests")
+        file_id = getattr(uploaded_file, "file_id", None)
+        if file_id:
+            digest = digests.get(file_id) or content_hash(data)
+            digests[file_id] = digest
+        else:
+            digest = content_hash(data)
+        original = decode_image(digest, data)
+        st.image(preview_image(digest, 0, original), caption="Uploaded Image", use_column_width=True)
+
+        # Orientation check and correction; the answer is kept for this upload
+        # so later reruns keep showing (and using) the corrected image
+        orientations = session_store("orientation")
         if st.button("Check and Correct Orientation"):
             with st.spinner("Checking orientation..."):
-                image_base64 = encode_image_base64(image)
-                orientation = get_orientation_from_llama(image_base64)
-                
-                if orientation == 0:
-                    st.write("Image orientation is correct.")
-                else:
-                    st.write(f"Correcting orientation by {orientation} degrees...")
-                    corrected_image = image.rotate(-orientation, expand=True)
-                    st.image(corrected_image, caption="Corrected Image", use_column_width=True)
-                    image = corrected_image
+                orientations[digest] = cached_orientation(digest, original)
+
+        orientation = 0
+        if digest in orientations:
+            orientation, source = orientations[digest]
+            st.caption(f"Orientation determined by the {'local estimator' if source == 'local' else 'LLaMA model'}.")
+            if orientation == 0:
+                st.write("Image orientation is correct.")
+            else:
+                st.write(f"Correcting orientation by {orientation} degrees...")
+                st.image(preview_image(digest, orientation, original), caption="Corrected Image",
+                         use_column_width=True)
 
         # Manual orientation correction with fixed values (multiples of 90)
         st.write("If the orientation is still incorrect, you can manually adjust it:")
@@ -74,71 +316,64 @@ def main():
             options=[-90, 0, 90, 180, 270],
             value=0
         )
+        angle = (orientation + manual_angle) % 360
+        preview = preview_image(digest, angle, original)
         if manual_angle != 0:
-            manually_corrected_image = image.rotate(-manual_angle, expand=True)
-            st.image(manually_corrected_image, caption="Manually Corrected Image", use_column_width=True)
-            image = manually_corrected_image
+            st.image(preview, caption="Manually Corrected Image", use_column_width=True)
 
         # Image cropping
         st.write("Select region of interest (click and drag on the image):")
         st.write("You can move the red box by dragging the four corners or the sides to adjust the area you want to select.")
-        cropped_img = st_cropper(image, realtime_update=True, box_color='red', aspect_ratio=None)
+        # The cropper works on the preview; its box is mapped back to the
+        # full-resolution image when the document is processed
+        box = st_cropper(preview, realtime_update=True, box_color='red', aspect_ratio=None, return_type="box")
 
-        if cropped_img is not None:
-            st.image(cropped_img, caption="Cropped Image", use_column_width=True)
-            image = cropped_img  # Use the cropped image for further processing
+        crop = None
+        if box:
+            crop = (box["left"], box["top"], box["left"] + box["width"], box["top"] + box["height"])
+            st.image(preview.crop(crop), caption="Cropped Image", use_column_width=True)
 
-        # Document processing
+        # Results are kept per document state, so going back to a rotation
+        # or crop that was already processed shows its result immediately
+        result_key = (doc_type, digest, angle, crop)
+        reprocess = st.checkbox("Process again even if this document has a stored result")
         if st.button("Process Document"):
-            with st.spinner("Processing document..."):
-                # Save the image temporarily
-                temp_image_path = "temp_image.jpg"
-                
-                # Convert RGBA to RGB if necessary
-                if image.mode == 'RGBA':
-                    image = image.convert('RGB')
-                image.save(temp_image_path)
-                
-                try:
+            try:
+                # Documents processed before, in any session, come from the result store
+                stored = None if reprocess else stored_result(doc_type, digest, angle, crop)
+                if stored is not None:
+                    remember_result(result_key, stored)
+                    st.success("Loaded the stored result for this document.")
+                else:
+                    # The in-memory image is handed over directly; each pipeline
+                    # encodes it once and shares the payload across its stages.
                     if doc_type == "Passport":
-                        result, buffer = process_passport(temp_image_path)
-                    else:  # Driver's License
-                        result, buffer = process_license(temp_image_path)
-
-                    # Display processing steps
-                    with st.expander("View Processing Steps", expanded=True):
-                        for step in buffer:
-                            st.write(step['description'])
-
-                    # Display results
-                    st.success("Document processed successfully!")
-                    st.subheader("Extracted Information")
-                    if doc_type == "Driver's License" and USE_LICENSE_DATA:
-                        # Validate the result against the LicenseData model
-                        try:
-                            validated_result = LicenseData(**result)
-                            st.json(validated_result.dict())
-                        except Exception as e:
-                            st.error(f"Error in validating result: {str(e)}")
-                            st.json(result)
+                        from passport_processing import process_passport as process
                     else:
-                        st.json(result)
-
-                    # Display raw output in sidebar
-                    st.sidebar.subheader("Raw Output")
-                    for i, step_output in enumerate(buffer):
-                        with st.sidebar.expander(f"Step {i+1} Raw Output"):
-                            st.sidebar.json(step_output['raw_output'])
+                        from license_processing import process_license as process
+                    image = full_resolution_image(digest, angle, crop, original)
+                    start = time.perf_counter()
+                    outcome = run_with_live_progress(process, image)
+                    remember_result(result_key, outcome)
+                    save_result(doc_type, digest, angle, crop, *outcome, time.perf_counter() - start)
+                    st.success("Document processed successfully!")
+            except Exception as e:
+                st.error(f"Error during document processing: {str(e)}")
 
-                except Exception as e:
-                    st.error(f"Error during document processing: {str(e)}")
-                finally:
-                    # Clean up temporary file
-                    if os.path.exists(temp_image_path):
-                        os.remove(temp_image_path)
+        if result_key in session_store("results"):
+            show_result(doc_type, *session_store("results")[result_key])
 
     st.sidebar.header("About")
     st.sidebar.info("This app processes passport and driver's license documents using AI.")
 
+    # Only report on the cache once the pipeline has created it
+    cache = existing_client("response_cache")
+    if cache is not None:
+        stats = cache.stats()
+        st.sidebar.caption(
+            f"Response cache: {stats['memory_hits'] + stats['disk_hits']} hits, "
+            f"{stats['misses']} misses ({stats['hit_rate']:.0%} hit rate)"
+        )
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,105 @@
+# batch_extraction.py
+import asyncio
+import json
+from prompts import MAX_OUTPUT_TOKENS
+
+
+def max_batch_size(item_template):
+    """How many documents fit one call when each may need item_template's output budget."""
+    return max(1, MAX_OUTPUT_TOKENS // item_template.max_tokens)
+
+
+def batch_max_tokens(item_template, count):
+    return min(MAX_OUTPUT_TOKENS, item_template.max_tokens * count)
+
+
+def batch_content(images_base64, prompt_text, image_data_url):
+    """Message content with each image preceded by its index label, then the prompt once."""
+    content = []
+    for index, image_base64 in enumerate(images_base64):
+        content.append({"type": "text", "text": f"Image {index}:"})
+        content.append({"type": "image_url", "image_url": {"url": image_data_url(image_base64)}})
+    content.append({"type": "text", "text": prompt_text})
+    return content
+
+
+def parse_batch_documents(response_json, count, item_model):
+    """Map image index to its {"fields", "transcription"} entry.
+
+    Entries that are missing, duplicated, out of range or don't match item_model
+    are left out, so the caller extracts those images again on their own.
+    """
+    content = json.loads(response_json['choices'][0]['message']['content'])
+    entries = content.get("documents") if isinstance(content, dict) else content
+    documents = {}
+    duplicates = set()
+    for entry in entries or []:
+        try:
+            item = item_model.parse_obj(entry)
+        except Exception as e:
+            print(f"Skipping invalid batched entry: {e}")
+            continue
+        index = item.image_index
+        if not 0 <= index < count:
+            continue
+        if index in documents:
+            duplicates.add(index)
+        documents[index] = {"fields": entry["fields"], "transcription": item.transcription}
+    for index in duplicates:
+        del documents[index]
+    return documents
+
+
+def document_response(response_json, document, count):
+    """A single-document combined-extraction response cut out of a batched one.
+
+    Token usage is split evenly across the batch, so per-document totals still add up.
+    """
+    usage = response_json.get("usage") or {}
+    return {
+        "id": response_json.get("id"),
+        "object": "chat.completion",
+        "model": response_json.get("model"),
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": json.dumps(document)},
+                     "finish_reason": response_json['choices'][0].get("finish_reason")}],
+        "usage": {key: round(value / count) for key, value in usage.items() if isinstance(value, (int, float))},
+        "batch_size": count,
+    }
+
+
+async def extract_batched(images_base64, extract_batch, extract_single, item_model, limit):
+    """Return one combined-extraction response per image, in order.
+
+    extract_batch(images) makes one multi-image call; extract_single(image) is the
+    single-image combined call; both are coroutine functions. A batch whose call
+    or answer fails is split in half and both halves tried again concurrently;
+    images the answer leaves out or gets wrong are extracted alone, also concurrently.
+    """
+    if len(images_base64) > limit:
+        chunks = await asyncio.gather(*(extract_batched(images_base64[start:start + limit], extract_batch,
+                                                        extract_single, item_model, limit)
+                                        for start in range(0, len(images_base64), limit)))
+        return [response for chunk in chunks for response in chunk]
+    if len(images_base64) == 1:
+        return [await extract_single(images_base64[0])]
+
+    count = len(images_base64)
+    try:
+        response_json = await extract_batch(images_base64)
+        documents = parse_batch_documents(response_json, count, item_model)
+    except Exception as e:
+        print(f"Batched extraction of {count} images failed ({e}); splitting the batch")
+        middle = count // 2
+        first, second = await asyncio.gather(
+            extract_batched(images_base64[:middle], extract_batch, extract_single, item_model, limit),
+            extract_batched(images_base64[middle:], extract_batch, extract_single, item_model, limit))
+        return first + second
+
+    async def response_for(index, image_base64):
+        if index in documents:
+            return document_response(response_json, documents[index], count)
+        print(f"Image {index} of the batch is missing or invalid in the answer; extracting it alone")
+        return await extract_single(image_base64)
+
+    return list(await asyncio.gather(*(response_for(index, image_base64)
+                                       for index, image_base64 in enumerate(images_base64))))
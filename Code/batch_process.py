@@ -0,0 +1,347 @@
+# batch_process.py
+import argparse
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from cascade import cascade_record
+from image_encoding import encode_document_image, encode_image_base64, image_data_url
+from inference_client import chat_completion
+from license_processing import extract_license_batch, process_license
+from metrics import start_metrics_server
+from passport_processing import extract_passport_batch, process_passport
+from prompts import PromptTemplate
+from rate_limiter import get_rate_limiter
+from result_store import file_hash, get_result_store
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+DOC_TYPES = ("license", "passport")
+
+# Filename hints checked before falling back to a classification call
+FILENAME_HINTS = {
+    "passport": "passport",
+    "license": "license",
+    "licence": "license",
+}
+
+DOCUMENT_TYPE_PROMPT = PromptTemplate(
+    "document_type",
+    "Is this document a passport or a driver's license? Answer as a JSON object "
+    "with the key 'document_type' set to either 'passport' or 'license'.",
+    response_type="json_object", output_tokens=32)
+
+
+def iter_documents(source, default_doc_type):
+    """Yield (path, doc_type) from a directory of images or a manifest file.
+
+    A manifest holds one image path per line, or JSON lines with "path" and an
+    optional "doc_type". Relative paths resolve against the manifest's folder.
+    """
+    if os.path.isdir(source):
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for name in sorted(files):
+                if name.lower().endswith(IMAGE_EXTENSIONS):
+                    yield os.path.join(root, name), default_doc_type
+        return
+
+    base_dir = os.path.dirname(os.path.abspath(source))
+    with open(source, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            doc_type = default_doc_type
+            if line.startswith("{"):
+                entry = json.loads(line)
+                path = entry["path"]
+                doc_type = entry.get("doc_type") or default_doc_type
+            else:
+                path = line
+            if not os.path.isabs(path):
+                path = os.path.join(base_dir, path)
+            yield path, doc_type
+
+
+def detect_document_type(image_path):
+    name = os.path.basename(image_path).lower()
+    for hint, doc_type in FILENAME_HINTS.items():
+        if hint in name:
+            return doc_type
+
+    with Image.open(image_path) as img:
+        image_base64 = encode_image_base64(img, purpose="classification")
+
+    payload = {
+        "model": "accounts/fireworks/models/llama-v3p2-11b-vision-instruct",
+        "max_tokens": DOCUMENT_TYPE_PROMPT.max_tokens,
+        "temperature": 0,
+        "response_format": DOCUMENT_TYPE_PROMPT.response_format,
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "image_url", "image_url": {"url": image_data_url(image_base64)}},
+                    {"type": "text", "text": DOCUMENT_TYPE_PROMPT.render()}
+                ]
+            }
+        ]
+    }
+    response_json = chat_completion(payload, cache_version=DOCUMENT_TYPE_PROMPT.version)
+    answer = json.loads(response_json["choices"][0]["message"]["content"])
+    doc_type = str(answer.get("document_type", "")).lower()
+    if doc_type not in DOC_TYPES:
+        raise ValueError(f"Could not determine document type for {image_path}: {answer}")
+    return doc_type
+
+
+def load_checkpoint(checkpoint_path):
+    if not os.path.exists(checkpoint_path):
+        return set()
+    with open(checkpoint_path, "r", encoding="utf-8") as f:
+        return {line.rstrip("\n") for line in f if line.strip()}
+
+
+def process_document(image_path, doc_type, include_steps=False, extraction=None):
+    start = time.perf_counter()
+    record = {"path": image_path, "doc_type": doc_type}
+    try:
+        if doc_type == "auto":
+            doc_type = detect_document_type(image_path)
+            record["doc_type"] = doc_type
+
+        if doc_type == "passport":
+            result, buffer = process_passport(image_path, extraction=extraction)
+        else:
+            result, buffer = process_license(image_path, extraction=extraction)
+
+        if result is None:
+            # process_passport reports failures through the last buffer entry
+            record["status"] = "error"
+            record["error"] = buffer[-1]["raw_output"].get("error") if buffer else "unknown error"
+        else:
+            record["status"] = "ok"
+            record["result"] = result
+        cascade = cascade_record(buffer)
+        if cascade is not None:
+            # Which tier of the document type's model cascade produced the result
+            record["cascade"] = cascade
+        if include_steps:
+            record["steps"] = buffer
+    except Exception as e:
+        record["status"] = "error"
+        record["error"] = str(e)
+
+    record["elapsed_seconds"] = round(time.perf_counter() - start, 3)
+    return record
+
+
+def stored_document(store, image_path, doc_type, include_steps=False):
+    """The record for a document the result store already has, or None."""
+    start = time.perf_counter()
+    try:
+        stored = store.find_image(file_hash(image_path), None if doc_type == "auto" else doc_type)
+    except OSError:
+        # Unreadable files are left to process_document, which reports the error
+        return None
+    if stored is None:
+        return None
+    record = {"path": image_path, "doc_type": stored["doc_type"], "status": "ok", "result": stored["result"],
+              "stored_id": stored["id"]}
+    if stored["cascade"] is not None:
+        record["cascade"] = stored["cascade"]
+    if include_steps and stored["steps"] is not None:
+        record["steps"] = stored["steps"]
+    record["elapsed_seconds"] = round(time.perf_counter() - start, 3)
+    return record
+
+
+def store_entry(record, source=None):
+    """put_many() arguments for a successful record processed with include_steps."""
+    return {"doc_type": record["doc_type"], "image_hash": file_hash(record["path"]), "result": record["result"],
+            "steps": record.get("steps"), "cascade": record.get("cascade"),
+            "elapsed_seconds": record["elapsed_seconds"], "source": source or record["path"]}
+
+
+BATCH_EXTRACTORS = {"license": extract_license_batch, "passport": extract_passport_batch}
+
+
+def process_group(entries, include_steps=False, store=None):
+    """Process [(path, doc_type)] and return their records in the same order.
+
+    Documents of the same type share one multi-image extraction call; scoring
+    and validation then run per document as usual. Documents already in store
+    are taken from it without any model call.
+    """
+    records = {}
+    pending = []
+    for image_path, doc_type in entries:
+        record = stored_document(store, image_path, doc_type, include_steps) if store is not None else None
+        if record is None:
+            pending.append((image_path, doc_type))
+        else:
+            records[image_path] = record
+
+    if len(pending) == 1:
+        records[pending[0][0]] = process_document(pending[0][0], pending[0][1], include_steps)
+        return [records[image_path] for image_path, _ in entries]
+
+    by_type = {}
+    for image_path, doc_type in pending:
+        try:
+            if doc_type == "auto":
+                doc_type = detect_document_type(image_path)
+            by_type.setdefault(doc_type, []).append(image_path)
+        except Exception as e:
+            records[image_path] = {"path": image_path, "doc_type": doc_type, "status": "error", "error": str(e),
+                                   "elapsed_seconds": 0.0}
+
+    for doc_type, paths in by_type.items():
+        start = time.perf_counter()
+        try:
+            extractions = BATCH_EXTRACTORS[doc_type]([encode_document_image(path) for path in paths])
+        except Exception as e:
+            # Fall back to extracting each document on its own
+            print(f"Batched {doc_type} extraction failed: {e}")
+            extractions = [None] * len(paths)
+        extraction_seconds = round(time.perf_counter() - start, 3)
+
+        with ThreadPoolExecutor(max_workers=len(paths), thread_name_prefix="batch-group") as executor:
+            futures = [executor.submit(process_document, path, doc_type, include_steps, extraction)
+                       for path, extraction in zip(paths, extractions)]
+            for path, extraction, future in zip(paths, extractions, futures):
+                record = future.result()
+                if extraction is not None:
+                    record["batch_size"] = extraction.get("batch_size", 1)
+                    record["elapsed_seconds"] = round(record["elapsed_seconds"] + extraction_seconds, 3)
+                records[path] = record
+    return [records[image_path] for image_path, _ in entries]
+
+
+def iter_groups(documents, size):
+    group = []
+    for document in documents:
+        group.append(document)
+        if len(group) == size:
+            yield group
+            group = []
+    if group:
+        yield group
+
+
+def run_batch(source, doc_type, output_path, checkpoint_path, workers, include_steps=False, batch_size=1,
+              store=None, reprocess=False):
+    """Process every pending document of source. With a result store, new results
+    are saved to it in bulk per group, and (unless reprocess) documents it already
+    holds are taken from it instead of being processed again."""
+    done = load_checkpoint(checkpoint_path)
+    if done:
+        print(f"Resuming: {len(done)} documents already processed.")
+
+    write_lock = threading.Lock()
+    counts = {"ok": 0, "error": 0, "skipped": 0, "stored": 0}
+    # Keep a small backlog beyond the worker count so the pool never idles,
+    # without materialising the whole input list.
+    max_in_flight = workers * 2
+
+    with open(output_path, "a", encoding="utf-8") as output, \
+            open(checkpoint_path, "a", encoding="utf-8") as checkpoint, \
+            ThreadPoolExecutor(max_workers=workers, thread_name_prefix="batch") as executor:
+
+        slots = threading.BoundedSemaphore(max_in_flight)
+
+        def record_results(group, future):
+            try:
+                try:
+                    records = future.result()
+                    if store is not None:
+                        # Saved before the checkpoint, so a checkpointed document is always in the store
+                        store.put_many([store_entry(record) for record in records
+                                        if record["status"] == "ok" and "stored_id" not in record])
+                except Exception as e:
+                    # A callback's exception is dropped by the executor, so record the
+                    # whole group as failed; it is retried on resume.
+                    print(f"Group of {len(group)} documents failed: {e}")
+                    records = [{"path": image_path, "doc_type": doc_type, "status": "error", "error": str(e),
+                                "elapsed_seconds": 0.0} for image_path, doc_type in group]
+                for record in records:
+                    if not include_steps:
+                        record.pop("steps", None)
+                    with write_lock:
+                        output.write(json.dumps(record) + "\n")
+                        output.flush()
+                        counts[record["status"]] += 1
+                        counts["stored"] += "stored_id" in record
+                        # Only successes are checkpointed, so failures are retried on resume.
+                        # The output line is written first: a crash in between re-runs the
+                        # document rather than losing it.
+                        if record["status"] == "ok":
+                            checkpoint.write(record["path"] + "\n")
+                            checkpoint.flush()
+                            os.fsync(checkpoint.fileno())
+                        print(f"[{record['status']}] {record['path']} ({record['elapsed_seconds']}s)")
+            finally:
+                slots.release()
+
+        def pending():
+            for image_path, item_doc_type in iter_documents(source, doc_type):
+                if image_path in done:
+                    counts["skipped"] += 1
+                    continue
+                yield image_path, item_doc_type
+
+        # Each task is a group of up to batch_size documents sharing one extraction call
+        for group in iter_groups(pending(), batch_size):
+            slots.acquire()
+            # Steps are always kept when saving, as the store holds them with the result
+            future = executor.submit(process_group, group, include_steps or store is not None,
+                                     None if reprocess else store)
+            future.add_done_callback(functools.partial(record_results, group))
+
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Process a directory or manifest of KYC document images.")
+    parser.add_argument("source", help="Directory of images, or a manifest file (one path or JSON object per line)")
+    parser.add_argument("--doc-type", choices=DOC_TYPES + ("auto",), default="auto",
+                        help="Document type for every input, or 'auto' to detect per document (default: auto)")
+    parser.add_argument("--output", default="results.jsonl", help="JSONL file results are appended to")
+    parser.add_argument("--checkpoint", default=None,
+                        help="File of completed paths used to resume (default: <output>.checkpoint)")
+    parser.add_argument("--workers", type=int, default=4, help="Number of documents processed concurrently")
+    parser.add_argument("--include-steps", action="store_true", help="Store the per-step buffer with each result")
+    parser.add_argument("--batch-size", type=int, default=1,
+                        help="Documents of the same type extracted together in one multi-image 11B call "
+                             "(default: 1, one call per document)")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="Serve Prometheus metrics on this port while the batch runs")
+    parser.add_argument("--no-store", action="store_true",
+                        help="Neither look up nor save results in the result store (RESULT_STORE_PATH)")
+    parser.add_argument("--reprocess", action="store_true",
+                        help="Process documents again even when the result store already has them")
+    args = parser.parse_args(argv)
+
+    if args.metrics_port:
+        start_metrics_server(args.metrics_port)
+
+    checkpoint_path = args.checkpoint or f"{args.output}.checkpoint"
+    start = time.perf_counter()
+    counts = run_batch(args.source, args.doc_type, args.output, checkpoint_path,
+                       max(1, args.workers), args.include_steps, max(1, args.batch_size),
+                       None if args.no_store else get_result_store(), args.reprocess)
+    elapsed = time.perf_counter() - start
+    print(f"\nDone in {elapsed:.1f}s: {counts['ok']} ok ({counts['stored']} from the result store), "
+          f"{counts['error']} failed, {counts['skipped']} skipped (already checkpointed).")
+    for model, stats in get_rate_limiter().stats().items():
+        print(f"{model}: {stats['calls']} calls, {stats['throttled']} throttled, "
+              f"concurrency limit {stats['limit']}, {stats['waited_seconds']:.1f}s waiting for the rate limiter")
+    return 0 if counts["error"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,128 @@
+# bench_image_encoding.py
+import argparse
+import base64
+import json
+import os
+import sys
+import time
+from io import BytesIO
+from PIL import Image
+from image_encoding import EncodingPolicy, POLICIES, encode_image_bytes
+
+DEFAULT_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Data")
+
+# Extra variants compared against the configured policies
+VARIANTS = {
+    "extraction-webp": EncodingPolicy(**{**POLICIES["extraction"].dict(), "format": "WEBP"}),
+    "extraction-gray": EncodingPolicy(**{**POLICIES["extraction"].dict(), "grayscale": True}),
+    "extraction-1024": EncodingPolicy(**{**POLICIES["extraction"].dict(), "max_long_edge": 1024}),
+}
+
+
+def iter_images(data_dir):
+    for name in sorted(os.listdir(data_dir)):
+        if name.lower().endswith((".jpg", ".jpeg", ".png")):
+            yield os.path.join(data_dir, name)
+
+
+def doc_type_for(path):
+    return "passport" if "passport" in os.path.basename(path).lower() else "license"
+
+
+def extract_fields(image_base64, doc_type):
+    if doc_type == "passport":
+        from passport_processing import extract_json_from_llama11b
+    else:
+        from license_processing import extract_json_from_llama11b
+    response = extract_json_from_llama11b(image_base64)
+    return json.loads(response['choices'][0]['message']['content'])
+
+
+def flatten(fields, prefix=""):
+    flat = {}
+    for key, value in (fields or {}).items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        else:
+            flat[f"{prefix}{key}"] = "" if value is None else str(value).strip().upper()
+    return flat
+
+
+def field_agreement(reference, candidate):
+    reference, candidate = flatten(reference), flatten(candidate)
+    if not reference:
+        return None
+    matches = sum(1 for key, value in reference.items() if candidate.get(key) == value)
+    return matches / len(reference)
+
+
+def run(data_dir, policy_names, with_extraction):
+    policies = {name: POLICIES.get(name) or VARIANTS[name] for name in policy_names}
+    rows = []
+    for path in iter_images(data_dir):
+        with Image.open(path) as img:
+            img.load()
+            original_size = img.size
+            baseline_fields = None
+            for name, policy in policies.items():
+                start = time.perf_counter()
+                data = encode_image_bytes(img, policy=policy)
+                encode_ms = (time.perf_counter() - start) * 1000
+                with Image.open(BytesIO(data)) as encoded:
+                    encoded_size = encoded.size
+                row = {
+                    "image": os.path.basename(path),
+                    "policy": name,
+                    "source_size": original_size,
+                    "encoded_size": encoded_size,
+                    "bytes": len(data),
+                    "base64_chars": len(base64.b64encode(data)),
+                    "encode_ms": round(encode_ms, 1),
+                }
+                if with_extraction:
+                    # Accuracy is measured as field agreement with the full-resolution
+                    # "original" encoding, which is always run first.
+                    fields = extract_fields(base64.b64encode(data).decode("utf-8"), doc_type_for(path))
+                    if baseline_fields is None:
+                        baseline_fields = fields
+                    row["field_agreement"] = field_agreement(baseline_fields, fields)
+                rows.append(row)
+    return rows
+
+
+def print_report(rows):
+    baseline = {row["image"]: row["bytes"] for row in rows if row["policy"] == "original"}
+    header = f"{'image':<20} {'policy':<18} {'size':>11} {'KB':>8} {'saved':>7} {'ms':>7} {'agree':>6}"
+    print(header)
+    print("-" * len(header))
+    for row in rows:
+        size = f"{row['encoded_size'][0]}x{row['encoded_size'][1]}"
+        saved = 1 - row["bytes"] / baseline[row["image"]] if baseline.get(row["image"]) else 0.0
+        agreement = row.get("field_agreement")
+        agreement = f"{agreement:.0%}" if agreement is not None else "-"
+        print(f"{row['image']:<20} {row['policy']:<18} {size:>11} {row['bytes'] / 1024:>8.1f} "
+              f"{saved:>7.0%} {row['encode_ms']:>7.1f} {agreement:>6}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare image encoding policies on the sample documents.")
+    parser.add_argument("--data-dir", default=DEFAULT_DATA_DIR)
+    parser.add_argument("--policies", nargs="+",
+                        default=["original", "extraction", "orientation"] + list(VARIANTS),
+                        help="Policy names to compare ('original' is always included as the baseline)")
+    parser.add_argument("--with-extraction", action="store_true",
+                        help="Also run 11B structured extraction per policy and report field agreement (uses the API)")
+    parser.add_argument("--json", help="Write the raw rows to this file")
+    args = parser.parse_args(argv)
+
+    policy_names = ["original"] + [name for name in args.policies if name != "original"]
+    rows = run(args.data_dir, policy_names, args.with_extraction)
+    print_report(rows)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(rows, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
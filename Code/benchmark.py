@@ -0,0 +1,290 @@
+# benchmark.py
+import argparse
+import glob
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+CODE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_DATA_DIR = os.path.join(CODE_DIR, "..", "Data")
+DEFAULT_RESULTS_DIR = os.path.join(CODE_DIR, "..", "Benchmarks", "results")
+SCENARIOS = ("license", "passport", "orientation", "image_cpu")
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = (len(ordered) - 1) * fraction
+    lower = int(index)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (index - lower)
+
+
+def summarize_latencies(latencies):
+    return {
+        "count": len(latencies),
+        "p50": percentile(latencies, 0.50),
+        "p95": percentile(latencies, 0.95),
+        "p99": percentile(latencies, 0.99),
+        "mean": sum(latencies) / len(latencies) if latencies else None,
+    }
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_fake_server(args):
+    """Run fake_fireworks.py in its own process so its CPU use doesn't count against the pipeline."""
+    port = free_port()
+    command = [sys.executable, os.path.join(CODE_DIR, "fake_fireworks.py"), "--port", str(port),
+               "--latency", args.latency, "--error-rate", str(args.error_rate),
+               "--error-codes", args.error_codes, "--seed", str(args.seed)]
+    if args.recordings:
+        command += ["--recordings", args.recordings]
+    for item in args.model_latency:
+        command += ["--model-latency", item]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    base_url = f"http://127.0.0.1:{port}/inference/v1"
+    deadline = time.time() + 15
+    while time.time() < deadline:
+        try:
+            requests.head(base_url, timeout=0.5)
+            return process, base_url
+        except requests.RequestException:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("Fake Fireworks server did not start")
+
+
+def images_for(data_dir, scenario):
+    paths = sorted(path for path in glob.glob(os.path.join(data_dir, "*"))
+                   if path.lower().endswith((".jpg", ".jpeg", ".png")))
+    if scenario == "license":
+        return [path for path in paths if "license" in os.path.basename(path).lower()]
+    if scenario == "passport":
+        return [path for path in paths if "passport" in os.path.basename(path).lower()]
+    return paths
+
+
+def run_pipeline_scenario(scenario, paths, iterations, concurrency):
+    # Imported here so FIREWORKS_BASE_URL and friends are set before the modules read them
+    from image_encoding import clear_encoded_cache
+    from license_processing import process_license
+    from orientation import correct_image_orientation
+    from passport_processing import process_passport
+
+    func = {"license": process_license, "passport": process_passport,
+            "orientation": correct_image_orientation}[scenario]
+
+    def run_one(path):
+        started = time.perf_counter()
+        try:
+            result = func(path)
+            ok = not (scenario == "passport" and result[0] is None)
+        except Exception as e:
+            print(f"{scenario} {os.path.basename(path)} failed: {e}")
+            ok = False
+        return time.perf_counter() - started, ok
+
+    tasks = [path for _ in range(iterations) for path in paths]
+    clear_encoded_cache()
+    cpu_started = time.process_time()
+    wall_started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        outcomes = list(executor.map(run_one, tasks))
+    wall = time.perf_counter() - wall_started
+    cpu = time.process_time() - cpu_started
+
+    latencies = [latency for latency, ok in outcomes if ok]
+    return {
+        **summarize_latencies(latencies),
+        "errors": sum(1 for _, ok in outcomes if not ok),
+        "wall_seconds": wall,
+        "throughput_per_second": len(outcomes) / wall if wall else None,
+        "cpu_seconds": cpu,
+        "cpu_seconds_per_document": cpu / len(outcomes) if outcomes else None,
+    }
+
+
+def run_image_cpu_scenario(paths, iterations):
+    """CPU time of the local image work alone: encoding for extraction and the orientation estimate."""
+    from PIL import Image
+    from image_encoding import clear_encoded_cache, encode_document_image
+    from orientation import estimate_orientation_locally
+
+    encode_cpu, orientation_cpu = [], []
+    for _ in range(iterations):
+        for path in paths:
+            clear_encoded_cache()
+            started = time.process_time()
+            encode_document_image(path)
+            encode_cpu.append(time.process_time() - started)
+
+            with Image.open(path) as img:
+                img.load()
+                started = time.process_time()
+                estimate_orientation_locally(img)
+                orientation_cpu.append(time.process_time() - started)
+    return {
+        "encode_cpu_seconds": summarize_latencies(encode_cpu),
+        "orientation_cpu_seconds": summarize_latencies(orientation_cpu),
+        "cpu_seconds_per_document": (sum(encode_cpu) + sum(orientation_cpu)) / len(encode_cpu) if encode_cpu else None,
+    }
+
+
+def git_revision():
+    try:
+        revision = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=CODE_DIR, capture_output=True,
+                                  text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=CODE_DIR,
+                               capture_output=True, text=True).stdout.strip()
+        return revision + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def latest_result(results_dir, exclude=None):
+    paths = sorted(glob.glob(os.path.join(results_dir, "*.json")), key=os.path.getmtime)
+    paths = [path for path in paths if os.path.abspath(path) != os.path.abspath(exclude or "")]
+    return paths[-1] if paths else None
+
+
+# (scenario metric path, True when higher is better)
+COMPARED_METRICS = (
+    ("p50", False), ("p95", False), ("p99", False), ("throughput_per_second", True), ("cpu_seconds_per_document", False),
+)
+
+
+def compare(current, previous, threshold):
+    """Return (lines, regressions) comparing two result files scenario by scenario."""
+    lines, regressions = [], []
+    for scenario, stats in current["scenarios"].items():
+        before = previous["scenarios"].get(scenario)
+        if not before:
+            continue
+        for metric, higher_is_better in COMPARED_METRICS:
+            new, old = stats.get(metric), before.get(metric)
+            if not new or not old:
+                continue
+            change = (new - old) / old
+            worse = change < -threshold if higher_is_better else change > threshold
+            lines.append(f"{scenario:<12} {metric:<26} {old:>10.4f} -> {new:>10.4f} ({change:+.1%})"
+                         + ("  REGRESSION" if worse else ""))
+            if worse:
+                regressions.append((scenario, metric, change))
+    return lines, regressions
+
+
+def print_report(results):
+    print(f"\nRevision {results['revision']}  ({results['config']['iterations']} iterations, "
+          f"concurrency {results['config']['concurrency']}, latency {results['config']['latency']})")
+    header = f"{'scenario':<12} {'n':>4} {'err':>4} {'p50 s':>8} {'p95 s':>8} {'p99 s':>8} {'docs/s':>8} {'cpu/doc':>8}"
+    print(header)
+    print("-" * len(header))
+    for scenario, stats in results["scenarios"].items():
+        if scenario == "image_cpu":
+            continue
+
+        def fmt(value):
+            return "-" if value is None else f"{value:.3f}"
+
+        print(f"{scenario:<12} {stats['count']:>4} {stats['errors']:>4} {fmt(stats['p50']):>8} {fmt(stats['p95']):>8} "
+              f"{fmt(stats['p99']):>8} {fmt(stats['throughput_per_second']):>8} "
+              f"{fmt(stats['cpu_seconds_per_document']):>8}")
+    image_cpu = results["scenarios"].get("image_cpu")
+    if image_cpu:
+        print(f"\nLocal image CPU per document: encode p50 {image_cpu['encode_cpu_seconds']['p50'] * 1000:.1f} ms, "
+              f"orientation estimate p50 {image_cpu['orientation_cpu_seconds']['p50'] * 1000:.1f} ms")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark against a fake Fireworks server.")
+    parser.add_argument("--data-dir", default=DEFAULT_DATA_DIR)
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--iterations", type=int, default=5, help="Passes over the sample images per scenario")
+    parser.add_argument("--concurrency", type=int, default=4, help="Documents processed at once")
+    parser.add_argument("--latency", default="lognormal:0.8,0.4", help="Fake server latency spec")
+    parser.add_argument("--model-latency", action="append", default=["405b=lognormal:2.0,0.4"], metavar="MODEL=SPEC")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-codes", default="503")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--recordings", help="Recordings directory for the fake server")
+    parser.add_argument("--base-url", help="Use an already running (fake) server instead of starting one")
+    parser.add_argument("--results-dir", default=DEFAULT_RESULTS_DIR)
+    parser.add_argument("--compare", default="latest",
+                        help="Result file to compare against, 'latest' for the newest saved run, or 'none'")
+    parser.add_argument("--regression-threshold", type=float, default=0.10)
+    parser.add_argument("--fail-on-regression", action="store_true")
+    args = parser.parse_args(argv)
+
+    server = None
+    base_url = args.base_url
+    if not base_url and set(args.scenarios) - {"image_cpu"}:
+        server, base_url = start_fake_server(args)
+    if base_url:
+        os.environ["FIREWORKS_BASE_URL"] = base_url
+    os.environ.setdefault("API_KEY", "benchmark")
+    os.environ["RESPONSE_CACHE_ENABLED"] = "0"
+    os.environ.setdefault("METRICS_EXPORTERS", "prometheus")
+
+    # correct_image_orientation writes corrected copies next to the working directory
+    work_dir = tempfile.mkdtemp(prefix="kyc-benchmark-")
+    data_dir = os.path.abspath(args.data_dir)
+    previous_cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        scenarios = {}
+        for scenario in args.scenarios:
+            paths = images_for(data_dir, scenario)
+            print(f"Running {scenario} on {len(paths)} image(s)...", flush=True)
+            if scenario == "image_cpu":
+                scenarios[scenario] = run_image_cpu_scenario(paths, args.iterations)
+            else:
+                scenarios[scenario] = run_pipeline_scenario(scenario, paths, args.iterations, args.concurrency)
+    finally:
+        os.chdir(previous_cwd)
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    results = {
+        "revision": git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {key: getattr(args, key) for key in ("iterations", "concurrency", "latency", "model_latency",
+                                                       "error_rate", "seed")},
+        "scenarios": scenarios,
+    }
+    print_report(results)
+
+    os.makedirs(args.results_dir, exist_ok=True)
+    output_path = os.path.join(args.results_dir, f"{time.strftime('%Y%m%d-%H%M%S')}-{results['revision']}.json")
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nSaved results to {output_path}")
+
+    baseline_path = latest_result(args.results_dir, exclude=output_path) if args.compare == "latest" else (
+        None if args.compare == "none" else args.compare)
+    if baseline_path:
+        with open(baseline_path, "r", encoding="utf-8") as f:
+            previous = json.load(f)
+        lines, regressions = compare(results, previous, args.regression_threshold)
+        print(f"\nCompared with {os.path.basename(baseline_path)} (revision {previous.get('revision')}):")
+        for line in lines:
+            print(line)
+        if regressions and args.fail_on_regression:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,173 @@
+# cascade.py
+import re
+from pydantic import ValidationError
+from config import get_client, get_setting
+from field_validation import fields_below_threshold
+from metrics import REGISTRY
+
+MODEL_PREFIX = "accounts/fireworks/models/"
+LLAMA_11B_VISION = MODEL_PREFIX + "llama-v3p2-11b-vision-instruct"
+LLAMA_90B_VISION = MODEL_PREFIX + "llama-v3p2-90b-vision-instruct"
+LLAMA_405B = MODEL_PREFIX + "llama-v3p1-405b-instruct"
+
+# Escalation triggers: "schema" (the answer does not parse or fit the schema),
+# "agreement" (too few fields pass the local rules) and "mrz" (a passport MRZ
+# that is missing or fails its check digits)
+TRIGGERS = ("schema", "agreement", "mrz")
+
+# Share of scored fields that must pass the local rules for a tier's answer to stand
+MIN_AGREEMENT = float(get_setting("CASCADE_MIN_AGREEMENT", "0.75"))
+
+# Models per stage, cheapest first. Override per document type with
+# CASCADE_<TYPE>_EXTRACT / _VALIDATE / _ESCALATE_ON (comma-separated), or for
+# every type without the <TYPE>_ part. Names without a "/" get MODEL_PREFIX.
+DEFAULT_POLICIES = {
+    "license": {"extract": (LLAMA_11B_VISION, LLAMA_90B_VISION), "validate": (LLAMA_405B,),
+                "escalate_on": ("schema", "agreement")},
+    "passport": {"extract": (LLAMA_11B_VISION, LLAMA_90B_VISION), "validate": (LLAMA_405B,),
+                 "escalate_on": ("schema", "agreement", "mrz")},
+}
+
+CASCADE_DOCUMENTS = REGISTRY.counter("kyc_cascade_documents_total", "Documents by the cascade tier that produced them",
+                                     ("document_type", "stage", "model"))
+CASCADE_ESCALATIONS = REGISTRY.counter("kyc_cascade_escalations_total", "Escalations to the next cascade tier",
+                                       ("document_type", "stage", "trigger"))
+
+
+def model_name(model):
+    model = model.strip()
+    return model if "/" in model else MODEL_PREFIX + model
+
+
+def model_label(model):
+    """Display name used in step descriptions, e.g. "LLaMA Vision 11B" or "LLaMA 405B"."""
+    match = re.search(r"llama-v[\dp]+-(\d+b)(-vision)?", model or "")
+    if not match:
+        return (model or "").rsplit("/", 1)[-1]
+    return f"LLaMA {'Vision ' if match.group(2) else ''}{match.group(1).upper()}"
+
+
+def field_agreement(scores):
+    """Share of scored fields at or above the confidence threshold (1.0 when nothing was scored)."""
+    if not scores:
+        return 1.0
+    return 1 - len(fields_below_threshold(scores)) / len(scores)
+
+
+def schema_problem(model_cls, fields):
+    """Why fields do not fit model_cls, or None when they do."""
+    if not isinstance(fields, dict):
+        return f"expected a JSON object, got {type(fields).__name__}"
+    try:
+        model_cls(**fields)
+    except ValidationError as e:
+        return "; ".join(f"{'.'.join(str(part) for part in error['loc'])}: {error['msg']}"
+                         for error in e.errors()[:3])
+    except TypeError as e:
+        return str(e)
+    return None
+
+
+class CascadePolicy:
+    """Ordered models for each stage of one document type and the triggers that move a
+    document from one model to the next."""
+
+    def __init__(self, document_type, extract_models, validate_models, escalate_on=TRIGGERS,
+                 min_agreement=MIN_AGREEMENT):
+        unknown = set(escalate_on) - set(TRIGGERS)
+        if unknown:
+            raise ValueError(f"Unknown cascade trigger(s): {', '.join(sorted(unknown))}")
+        if not extract_models or not validate_models:
+            raise ValueError(f"Cascade for {document_type} needs at least one extraction and one validation model")
+        self.document_type = document_type
+        self.extract_models = [model_name(model) for model in extract_models]
+        self.validate_models = [model_name(model) for model in validate_models]
+        self.escalate_on = tuple(escalate_on)
+        self.min_agreement = min_agreement
+
+    @classmethod
+    def from_settings(cls, document_type):
+        defaults = DEFAULT_POLICIES[document_type]
+
+        def setting(key, default):
+            value = get_setting(f"CASCADE_{document_type.upper()}_{key}") or get_setting(f"CASCADE_{key}")
+            if not value:
+                return default
+            return [item.strip() for item in value.split(",") if item.strip()]
+
+        return cls(document_type, setting("EXTRACT", defaults["extract"]), setting("VALIDATE", defaults["validate"]),
+                   setting("ESCALATE_ON", defaults["escalate_on"]))
+
+    @property
+    def tiers(self):
+        return [("extract", model) for model in self.extract_models] + \
+               [("validate", model) for model in self.validate_models]
+
+    def escalation_reasons(self, schema_error=None, scores=None, mrz_error=None):
+        """The enabled triggers an answer sets off, as "trigger: detail" strings."""
+        reasons = []
+        if "schema" in self.escalate_on and schema_error:
+            reasons.append(f"schema: {schema_error}")
+        if "agreement" in self.escalate_on and scores is not None:
+            agreement = field_agreement(scores)
+            if agreement < self.min_agreement:
+                reasons.append(f"agreement: only {agreement:.0%} of fields pass the local rules")
+        if "mrz" in self.escalate_on and mrz_error:
+            reasons.append(f"mrz: {mrz_error}")
+        return reasons
+
+
+def get_cascade_policy(document_type):
+    return get_client(f"cascade_policy.{document_type}", lambda: CascadePolicy.from_settings(document_type))
+
+
+class CascadeRun:
+    """The tiers one document went through; the last one used produced its result."""
+
+    def __init__(self, policy):
+        self.policy = policy
+        self.stage = None
+        self.model = None
+        self.escalations = []
+
+    def use(self, stage, model):
+        self.stage = stage
+        self.model = model
+
+    def escalate(self, steps, reasons, next_model):
+        self.escalations.append({"stage": self.stage, "from": self.model, "to": next_model, "reasons": reasons})
+        for reason in reasons:
+            CASCADE_ESCALATIONS.inc(document_type=self.policy.document_type, stage=self.stage,
+                                    trigger=reason.split(":", 1)[0])
+        steps.add(f"Escalating from {model_label(self.model)} to {model_label(next_model)}: {'; '.join(reasons)}",
+                  {"reasons": reasons}, stage="escalate")
+
+    def record(self):
+        return {
+            "tier": self.policy.tiers.index((self.stage, self.model)),
+            "stage": self.stage,
+            "model": self.model,
+            "escalations": self.escalations,
+        }
+
+    def finish(self, steps, provenance=None):
+        """Record the producing tier on the step log, the document trace and the tier counter.
+
+        provenance, the extraction's Provenance, is kept with it.
+        """
+        record = self.record()
+        if provenance is not None:
+            record["extraction"] = provenance.dict()
+        steps.span.attributes["tier"] = record["tier"]
+        CASCADE_DOCUMENTS.inc(document_type=self.policy.document_type, stage=self.stage, model=model_label(self.model))
+        steps.add(f"Result produced by cascade tier {record['tier']} ({model_label(self.model)} {self.stage})",
+                  record, stage="cascade")
+        return record
+
+
+def cascade_record(buffer):
+    """The cascade step's record from a pipeline's step buffer, or None."""
+    for step in reversed(buffer or []):
+        if step.get("metrics", {}).get("name") == "cascade":
+            return step["raw_output"]
+    return None
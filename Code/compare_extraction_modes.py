@@ -0,0 +1,178 @@
+# compare_extraction_modes.py
+import argparse
+import json
+import os
+import sys
+import time
+
+# Latency is only meaningful against the live API, so cached responses are off
+# unless explicitly re-enabled in the environment.
+os.environ.setdefault("RESPONSE_CACHE_ENABLED", "0")
+
+from bench_image_encoding import DEFAULT_DATA_DIR, doc_type_for, field_agreement, iter_images
+from image_encoding import encode_document_image
+from pipeline import EXTRACTION_MODES, run_parallel, split_combined_extraction
+
+
+def processing_module(doc_type):
+    if doc_type == "passport":
+        import passport_processing as module
+    else:
+        import license_processing as module
+    return module
+
+
+def add_usage(total, response_json):
+    for key, value in (response_json.get("usage") or {}).items():
+        if isinstance(value, (int, float)):
+            total[key] = total.get(key, 0) + value
+    return total
+
+
+def run_mode(image_data, doc_type, mode):
+    """Run only the 11B extraction stage in the given mode and return fields, raw text, latency and usage."""
+    module = processing_module(doc_type)
+    usage = {}
+    start = time.perf_counter()
+    if mode == "combined":
+        response_json = module.extract_combined_from_llama11b(image_data)
+        add_usage(usage, response_json)
+        extracted_json, raw_text = split_combined_extraction(response_json)
+        calls = 1
+    else:
+        extracted_json, raw_text = run_parallel(
+            lambda: module.extract_json_from_llama11b(image_data),
+            lambda: module.extract_raw_text_from_llama11b(image_data),
+        )
+        add_usage(usage, extracted_json)
+        add_usage(usage, raw_text)
+        calls = 2
+    elapsed = time.perf_counter() - start
+    return {
+        "fields": json.loads(extracted_json['choices'][0]['message']['content']),
+        "raw_text": raw_text['choices'][0]['message']['content'],
+        "latency_seconds": round(elapsed, 3),
+        "calls": calls,
+        "usage": usage,
+    }
+
+
+def load_truth(path):
+    # {"License-2.jpg": {"full_name": "...", ...}, ...}
+    if not path:
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def run(data_dir, modes, repeats, truth):
+    rows = []
+    for path in iter_images(data_dir):
+        name = os.path.basename(path)
+        doc_type = doc_type_for(path)
+        image_data = encode_document_image(path)
+        results = {}
+        for mode in modes:
+            for attempt in range(repeats):
+                try:
+                    result = run_mode(image_data, doc_type, mode)
+                except Exception as e:
+                    print(f"{name} [{mode}] failed: {e}")
+                    rows.append({"image": name, "mode": mode, "attempt": attempt, "error": str(e)})
+                    continue
+                results.setdefault(mode, result)
+                rows.append({
+                    "image": name,
+                    "mode": mode,
+                    "attempt": attempt,
+                    "latency_seconds": result["latency_seconds"],
+                    "calls": result["calls"],
+                    "prompt_tokens": result["usage"].get("prompt_tokens"),
+                    "completion_tokens": result["usage"].get("completion_tokens"),
+                    "total_tokens": result["usage"].get("total_tokens"),
+                    "raw_text_chars": len(result["raw_text"]),
+                    "fields": result["fields"],
+                })
+
+        # Accuracy is measured against the ground truth when one is given for
+        # the image, otherwise as agreement with the separate-mode fields.
+        reference = truth.get(name) or (results.get("separate") or {}).get("fields")
+        for row in rows:
+            if row["image"] == name and "fields" in row:
+                row["field_accuracy"] = field_agreement(reference, row["fields"]) if reference else None
+                row["accuracy_basis"] = "truth" if name in truth else "separate"
+    return rows
+
+
+def summarize(rows, modes):
+    summary = {}
+    for mode in modes:
+        mode_rows = [row for row in rows if row["mode"] == mode and "error" not in row]
+        if not mode_rows:
+            continue
+
+        def mean(key):
+            values = [row[key] for row in mode_rows if row.get(key) is not None]
+            return sum(values) / len(values) if values else None
+
+        summary[mode] = {
+            "documents": len({row["image"] for row in mode_rows}),
+            "errors": sum(1 for row in rows if row["mode"] == mode and "error" in row),
+            "mean_latency_seconds": mean("latency_seconds"),
+            "mean_calls": mean("calls"),
+            "mean_prompt_tokens": mean("prompt_tokens"),
+            "mean_completion_tokens": mean("completion_tokens"),
+            "mean_total_tokens": mean("total_tokens"),
+            "mean_field_accuracy": mean("field_accuracy"),
+        }
+    return summary
+
+
+def _fmt(value, spec):
+    return "-" if value is None else format(value, spec)
+
+
+def print_report(rows, summary):
+    header = f"{'image':<20} {'mode':<9} {'s':>7} {'calls':>5} {'prompt':>8} {'compl':>7} {'accuracy':>9}"
+    print(header)
+    print("-" * len(header))
+    for row in rows:
+        if "error" in row:
+            print(f"{row['image']:<20} {row['mode']:<9} error: {row['error']}")
+            continue
+        print(f"{row['image']:<20} {row['mode']:<9} {row['latency_seconds']:>7.2f} {row['calls']:>5} "
+              f"{_fmt(row['prompt_tokens'], 'd'):>8} {_fmt(row['completion_tokens'], 'd'):>7} "
+              f"{_fmt(row.get('field_accuracy'), '.0%'):>9}")
+
+    print()
+    for mode, stats in summary.items():
+        print(f"{mode}: {stats['documents']} documents, {stats['errors']} errors, "
+              f"mean latency {_fmt(stats['mean_latency_seconds'], '.2f')}s, "
+              f"mean tokens {_fmt(stats['mean_total_tokens'], '.0f')} "
+              f"(prompt {_fmt(stats['mean_prompt_tokens'], '.0f')}, "
+              f"completion {_fmt(stats['mean_completion_tokens'], '.0f')}), "
+              f"mean field accuracy {_fmt(stats['mean_field_accuracy'], '.0%')}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Compare separate and combined 11B extraction on the sample documents (uses the API).")
+    parser.add_argument("--data-dir", default=DEFAULT_DATA_DIR)
+    parser.add_argument("--modes", nargs="+", choices=EXTRACTION_MODES, default=list(EXTRACTION_MODES))
+    parser.add_argument("--repeats", type=int, default=1, help="Runs per image and mode, for steadier latency")
+    parser.add_argument("--truth", help="JSON file of expected fields per image name; "
+                                        "without it accuracy is agreement with the separate mode")
+    parser.add_argument("--json", help="Write the raw rows and summary to this file")
+    args = parser.parse_args(argv)
+
+    rows = run(args.data_dir, args.modes, args.repeats, load_truth(args.truth))
+    summary = summarize(rows, args.modes)
+    print_report(rows, summary)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"rows": rows, "summary": summary}, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,124 @@
+# compare_validation_prompts.py
+import argparse
+import json
+import os
+import sys
+
+from bench_image_encoding import DEFAULT_DATA_DIR, doc_type_for, iter_images
+from compare_extraction_modes import processing_module
+from field_validation import fields_below_threshold, focus_instructions
+from image_encoding import encode_document_image
+from pipeline import StageOutput, response_content, run_parallel
+from prompts import estimate_tokens
+
+
+def score(module, doc_type, fields, raw_text):
+    if doc_type == "passport":
+        return module.score_passport_fields(fields, raw_text)
+    return module.score_license_fields(fields, raw_text)
+
+
+def validation_prompts(path):
+    """The validation prompt for one sample document, built from the whole responses as
+    before and from the compact stage output as now."""
+    doc_type = doc_type_for(path)
+    module = processing_module(doc_type)
+    template = module.PASSPORT_VALIDATION_PROMPT if doc_type == "passport" else module.LICENSE_VALIDATION_PROMPT
+    image_data = encode_document_image(path)
+    fields_response, raw_text_response = run_parallel(
+        lambda: module.extract_json_from_llama11b(image_data),
+        lambda: module.extract_raw_text_from_llama11b(image_data),
+    )
+    output = StageOutput.from_responses(fields_response, raw_text_response, "separate")
+    scores = score(module, doc_type, output.fields, output.transcription)
+    focus = focus_instructions(scores, fields_below_threshold(scores))
+
+    if doc_type == "passport":
+        # Passports already sent the parsed fields, indented, and the raw content
+        legacy = template.render(extracted_json=json.dumps(output.fields, indent=2),
+                                 raw_text=response_content(raw_text_response), focus=focus)
+    else:
+        # Licenses sent both chat-completion responses whole
+        legacy = template.render(extracted_json=json.dumps(fields_response, indent=2), raw_text=raw_text_response,
+                                 focus=focus)
+    compact = template.render(extracted_json=output.fields_json(), raw_text=output.transcription, focus=focus)
+    return doc_type, legacy, compact
+
+
+def run(data_dir):
+    rows = []
+    for path in iter_images(data_dir):
+        name = os.path.basename(path)
+        try:
+            doc_type, legacy, compact = validation_prompts(path)
+        except Exception as e:
+            print(f"{name} failed: {e}")
+            rows.append({"image": name, "error": str(e)})
+            continue
+        legacy_tokens, compact_tokens = estimate_tokens(legacy), estimate_tokens(compact)
+        rows.append({
+            "image": name,
+            "doc_type": doc_type,
+            "legacy_chars": len(legacy),
+            "compact_chars": len(compact),
+            "legacy_tokens": legacy_tokens,
+            "compact_tokens": compact_tokens,
+            "reduction": 1 - compact_tokens / legacy_tokens,
+        })
+    return rows
+
+
+def summarize(rows):
+    summary = {}
+    for doc_type in ("license", "passport"):
+        typed = [row for row in rows if row.get("doc_type") == doc_type]
+        if not typed:
+            continue
+        legacy = sum(row["legacy_tokens"] for row in typed)
+        compact = sum(row["compact_tokens"] for row in typed)
+        summary[doc_type] = {
+            "documents": len(typed),
+            "mean_legacy_tokens": legacy / len(typed),
+            "mean_compact_tokens": compact / len(typed),
+            "reduction": 1 - compact / legacy,
+        }
+    return summary
+
+
+def print_report(rows, summary):
+    header = f"{'image':<20} {'type':<9} {'before':>8} {'after':>8} {'saved':>7}"
+    print(header)
+    print("-" * len(header))
+    for row in rows:
+        if "error" in row:
+            print(f"{row['image']:<20} error: {row['error']}")
+            continue
+        print(f"{row['image']:<20} {row['doc_type']:<9} {row['legacy_tokens']:>8} {row['compact_tokens']:>8} "
+              f"{row['reduction']:>7.0%}")
+
+    print()
+    for doc_type, stats in summary.items():
+        print(f"{doc_type}: {stats['documents']} documents, validation prompt "
+              f"{stats['mean_legacy_tokens']:.0f} -> {stats['mean_compact_tokens']:.0f} estimated tokens "
+              f"({stats['reduction']:.0%} smaller)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Measure validation prompt size before and after the compact stage output "
+                    "on the sample documents (uses the API for the extraction step).")
+    parser.add_argument("--data-dir", default=DEFAULT_DATA_DIR)
+    parser.add_argument("--json", help="Write the raw rows and summary to this file")
+    args = parser.parse_args(argv)
+
+    rows = run(args.data_dir)
+    summary = summarize(rows)
+    print_report(rows, summary)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"rows": rows, "summary": summary}, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,61 @@
+# config.py
+import os
+import threading
+
+API_KEY_ERROR = ("API_KEY not found in environment variables. "
+                 "Please set it in your .env file or in your environment.")
+
+_lock = threading.RLock()
+_environment_loaded = False
+_clients = {}
+
+
+def load_environment():
+    """Load .env into the environment once per process; variables already set win."""
+    global _environment_loaded
+    if not _environment_loaded:
+        with _lock:
+            if not _environment_loaded:
+                from dotenv import load_dotenv
+                load_dotenv()
+                _environment_loaded = True
+
+
+def get_setting(name, default=None):
+    load_environment()
+    return os.getenv(name, default)
+
+
+def get_api_key():
+    """The Fireworks API key. Checked on first use rather than at import, so
+    tools that never call the API (and the app's first paint) don't need it."""
+    api_key = get_setting("API_KEY")
+    if not api_key:
+        raise ValueError(API_KEY_ERROR)
+    return api_key
+
+
+def get_client(name, factory):
+    """Return the process-wide client registered under name, building it with factory on first use.
+
+    Streamlit keeps imported modules across reruns and sessions, so a client
+    built here is shared by every rerun and session of the server process.
+    """
+    client = _clients.get(name)
+    if client is None:
+        with _lock:
+            client = _clients.get(name)
+            if client is None:
+                client = _clients[name] = factory()
+    return client
+
+
+def existing_client(name):
+    """The client registered under name, or None if nothing has built it yet."""
+    return _clients.get(name)
+
+
+def reset_clients():
+    """Drop every registered client, e.g. after changing settings in a long-lived process."""
+    with _lock:
+        _clients.clear()
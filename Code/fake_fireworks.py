@@ -0,0 +1,384 @@
+# fake_fireworks.py
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import requests
+from prompts import estimate_payload_tokens, estimate_tokens
+from response_cache import make_cache_key
+
+DEFAULT_RECORDINGS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Benchmarks", "recordings")
+UPSTREAM_URL = os.getenv("FIREWORKS_UPSTREAM_URL", "https://api.fireworks.ai/inference/v1").rstrip("/")
+
+# Characters per streamed delta when answering with stream=true
+STREAM_CHUNK_CHARS = 16
+
+
+def parse_latency(spec):
+    """Build a sampler from a latency spec, in seconds.
+
+    "0.5" or "fixed:0.5", "uniform:0.2,0.8", "normal:1.0,0.2",
+    "lognormal:1.2,0.4" (median, sigma) or "recorded" (the upstream time
+    stored with each recording, scaled by an optional factor: "recorded:0.5").
+    """
+    kind, _, args = spec.partition(":")
+    if not args and kind != "recorded":
+        kind, args = "fixed", spec
+    values = [float(value) for value in args.split(",")] if args else []
+    if kind == "fixed":
+        return lambda rng, recorded: values[0]
+    if kind == "uniform":
+        return lambda rng, recorded: rng.uniform(values[0], values[1])
+    if kind == "normal":
+        return lambda rng, recorded: max(0.0, rng.gauss(values[0], values[1]))
+    if kind == "lognormal":
+        return lambda rng, recorded: rng.lognormvariate(math.log(values[0]), values[1])
+    if kind == "recorded":
+        scale = values[0] if values else 1.0
+        return lambda rng, recorded: (recorded or 0.0) * scale
+    raise ValueError(f"Unknown latency spec: {spec}")
+
+
+# Synthetic documents whose fields pass the local validators and agree with their
+# transcription, so a synthesized run takes the same cascade path as a clean real
+# document instead of escalating every call. The passport is the ICAO 9303
+# specimen with its expiry moved into the future.
+SAMPLE_LICENSE_TRANSCRIPTION = "\n".join((
+    "CALIFORNIA", "DRIVER LICENSE", "DL D1234567", "CLASS C", "EXP 01/15/2030", "LN DOE", "FN JANE ANN",
+    "123 MAIN ST", "SACRAMENTO, CA 95814", "DOB 01/15/1985", "SEX F HGT 5'-06\" WGT 130 lb", "EYES BRN HAIR BRN",
+    "ISS 01/15/2022",
+))
+SAMPLE_LICENSE = {
+    "full_name": "DOE, JANE ANN",
+    "date_of_birth": "01/15/1985",
+    "license_number": "D1234567",
+    "address": {"street": "123 MAIN ST", "city": "SACRAMENTO", "state": "CA", "zip_code": "95814"},
+    "sex": "F",
+    "height": "5'-06\"",
+    "weight": "130 lb",
+    "eye_color": "BRN",
+    "hair_color": "BRN",
+    "issuance_date": "01/15/2022",
+    "expiration_date": "01/15/2030",
+    "class_type": "C",
+    "transcription": SAMPLE_LICENSE_TRANSCRIPTION,
+}
+SAMPLE_MRZ = {"line1": "P<UTOERIKSSON<<ANNA<MARIA<<<<<<<<<<<<<<<<<<<",
+              "line2": "L898902C36UTO7408122F3404159ZE184226B<<<<<16"}
+SAMPLE_PASSPORT_TRANSCRIPTION = "\n".join((
+    "PASSPORT", "UTOPIA", "Surname ERIKSSON", "Given names ANNA MARIA", "Nationality UTO",
+    "Date of birth 12 AUG 1974", "Sex F", "Place of birth ZENITH", "Passport No. L898902C3",
+    "Date of issue 15 APR 2024", "Date of expiry 15 APR 2034", "Authority PASSPORT OFFICE",
+    SAMPLE_MRZ["line1"], SAMPLE_MRZ["line2"],
+))
+SAMPLE_PASSPORT = {
+    "full_name": "ANNA MARIA ERIKSSON",
+    "date_of_birth": "12 AUG 1974",
+    "passport_number": "L898902C3",
+    "nationality": "UTO",
+    "place_of_birth": "ZENITH",
+    "issuance_date": "15 APR 2024",
+    "expiration_date": "15 APR 2034",
+    "sex": "F",
+    "authority": "PASSPORT OFFICE",
+    "mrz": SAMPLE_MRZ,
+    "transcription": SAMPLE_PASSPORT_TRANSCRIPTION,
+}
+
+
+def _sample_from_schema(schema, node, images=1, sample=None):
+    """JSON shaped like node, taking values by field name from sample where it has them."""
+    ref = node.get("$ref")
+    if ref:
+        node = schema
+        for part in ref.lstrip("#/").split("/"):
+            node = node[part]
+    options = node.get("anyOf") or node.get("oneOf")
+    if options:
+        non_null = [option for option in options if option.get("type") != "null"]
+        return _sample_from_schema(schema, (non_null or options)[0], images, sample)
+    if node.get("type") == "object" or "properties" in node:
+        if not node.get("properties") and isinstance(sample, dict):
+            return sample
+        # Wrapper objects (e.g. {"fields": ..., "transcription": ...}) pass the sample down
+        return {name: _sample_from_schema(schema, child, images,
+                                          sample.get(name, sample) if isinstance(sample, dict) else None)
+                for name, child in node.get("properties", {}).items()}
+    if sample is not None and not isinstance(sample, dict):
+        return sample
+    if node.get("type") == "array":
+        item = _sample_from_schema(schema, node.get("items", {}), images, sample)
+        if isinstance(item, dict) and "image_index" in item:
+            # Batched extraction: one entry per image in the request
+            return [dict(item, image_index=index) for index in range(images)]
+        return [item]
+    if node.get("type") in ("integer", "number"):
+        return 0
+    if node.get("type") == "boolean":
+        return False
+    if node.get("type") == "null":
+        return None
+    return "SAMPLE"
+
+
+def synthesize_response(payload):
+    """A plausible answer for a payload with no recording: the sample license or passport,
+    as schema-shaped JSON or as a transcription."""
+    response_format = payload.get("response_format") or {}
+    prompt_text = json.dumps(payload.get("messages", []))
+    passport = "passport" in prompt_text.lower()
+    if response_format.get("type") == "json_object":
+        schema = response_format.get("schema")
+        if isinstance(schema, str):
+            schema = json.loads(schema)
+        if schema:
+            images = prompt_text.count('"image_url"') // 2 or 1
+            sample = SAMPLE_PASSPORT if "passport_number" in json.dumps(schema) else SAMPLE_LICENSE
+            content = json.dumps(_sample_from_schema(schema, schema, images, sample))
+        elif "'orientation'" in prompt_text:
+            content = json.dumps({"orientation": 0})
+        elif "'document_type'" in prompt_text:
+            content = json.dumps({"document_type": "license"})
+        else:
+            content = "{}"
+    else:
+        content = SAMPLE_PASSPORT_TRANSCRIPTION if passport else SAMPLE_LICENSE_TRANSCRIPTION
+    return {
+        "id": "synthetic",
+        "object": "chat.completion",
+        "model": payload.get("model"),
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": estimate_payload_tokens(payload), "completion_tokens": estimate_tokens(content),
+                  "total_tokens": estimate_payload_tokens(payload) + estimate_tokens(content)},
+    }
+
+
+class FakeFireworks:
+    """Replays (or records) chat completions with configurable latency and injected errors."""
+
+    def __init__(self, recordings_dir=DEFAULT_RECORDINGS_DIR, mode="replay", latency="0",
+                 model_latency=None, error_rate=0.0, error_codes=(503,), on_miss="synthesize",
+                 per_token_seconds=0.0, seed=None):
+        self.recordings_dir = recordings_dir
+        self.mode = mode
+        self.latency = parse_latency(latency)
+        # {model name substring: sampler}, checked before the default latency
+        self.model_latency = {name: parse_latency(spec) for name, spec in (model_latency or {}).items()}
+        self.error_rate = error_rate
+        self.error_codes = tuple(error_codes)
+        self.on_miss = on_miss
+        self.per_token_seconds = per_token_seconds
+        self.rng = random.Random(seed)
+        self._rng_lock = threading.Lock()
+        self.stats = {"requests": 0, "replayed": 0, "recorded": 0, "synthesized": 0, "missing": 0, "errors": 0}
+        self._stats_lock = threading.Lock()
+
+    def _count(self, name):
+        with self._stats_lock:
+            self.stats[name] += 1
+
+    def _path(self, key):
+        return os.path.join(self.recordings_dir, key[:2], f"{key}.json")
+
+    def _key(self, payload):
+        # stream and max_tokens don't change the answer, so they are left out of the key
+        return make_cache_key({k: v for k, v in payload.items() if k not in ("stream", "max_tokens")}, "recorded")
+
+    def _load(self, key):
+        try:
+            with open(self._path(key), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _record(self, payload, authorization):
+        upstream_payload = {k: v for k, v in payload.items() if k != "stream"}
+        started = time.perf_counter()
+        response = requests.post(f"{UPSTREAM_URL}/chat/completions", json=upstream_payload,
+                                 headers={"Authorization": authorization or ""}, timeout=(10, 300))
+        elapsed = time.perf_counter() - started
+        if response.status_code != 200:
+            return None, response.status_code, response.text
+        recording = {"response": response.json(), "model": payload.get("model"),
+                     "recorded_at": time.time(), "upstream_seconds": elapsed}
+        path = self._path(self._key(payload))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(recording, f)
+        self._count("recorded")
+        return recording, 200, None
+
+    def _sample(self, sampler, recorded):
+        with self._rng_lock:
+            return sampler(self.rng, recorded)
+
+    def latency_for(self, model, recorded=None):
+        for name, sampler in self.model_latency.items():
+            if name in (model or ""):
+                return self._sample(sampler, recorded)
+        return self._sample(self.latency, recorded)
+
+    def inject_error(self):
+        with self._rng_lock:
+            if self.error_rate and self.rng.random() < self.error_rate:
+                return self.rng.choice(self.error_codes)
+        return None
+
+    def handle(self, payload, authorization=None):
+        """Return (status, response dict or error text, latency seconds)."""
+        self._count("requests")
+        error = self.inject_error()
+        if error:
+            self._count("errors")
+            return error, f"injected {error}", self.latency_for(payload.get("model"))
+
+        if self.mode == "record":
+            recording, status, error_text = self._record(payload, authorization)
+            if recording is None:
+                return status, error_text, 0.0
+            return 200, recording["response"], 0.0
+
+        recording = self._load(self._key(payload))
+        if recording is not None:
+            self._count("replayed")
+            response_json = recording["response"]
+        elif self.on_miss == "synthesize":
+            self._count("synthesized")
+            response_json = synthesize_response(payload)
+            recording = {}
+        else:
+            self._count("missing")
+            return 404, "no recording for this request", 0.0
+
+        latency = self.latency_for(payload.get("model"), recording.get("upstream_seconds"))
+        completion_tokens = (response_json.get("usage") or {}).get("completion_tokens") or 0
+        return 200, response_json, latency + completion_tokens * self.per_token_seconds
+
+
+def _make_handler(fake):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _send(self, status, body, content_type="application/json", headers=None):
+            data = body if isinstance(body, bytes) else body.encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_HEAD(self):
+            self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def do_GET(self):
+            if self.path.rstrip("/").endswith("/stats"):
+                with fake._stats_lock:
+                    self._send(200, json.dumps(fake.stats))
+            else:
+                self._send(404, json.dumps({"error": "not found"}))
+
+        def do_POST(self):
+            if not self.path.rstrip("/").endswith("/chat/completions"):
+                self._send(404, json.dumps({"error": "not found"}))
+                return
+            payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            status, body, latency = fake.handle(payload, self.headers.get("Authorization"))
+
+            if status != 200:
+                time.sleep(latency)
+                headers = {"Retry-After": "1"} if status == 429 else None
+                self._send(status, json.dumps({"error": {"message": body}}), headers=headers)
+                return
+            if not payload.get("stream"):
+                time.sleep(latency)
+                self._send(200, json.dumps(body))
+                return
+            self._stream(body, latency)
+
+        def _stream(self, response_json, latency):
+            content = response_json["choices"][0]["message"]["content"]
+            chunks = [content[i:i + STREAM_CHUNK_CHARS] for i in range(0, len(content), STREAM_CHUNK_CHARS)] or [""]
+            # Half the latency goes to the first token, the rest is spread over the deltas
+            time.sleep(latency / 2)
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            for chunk in chunks:
+                event = {"id": response_json.get("id"), "model": response_json.get("model"),
+                         "choices": [{"index": 0, "delta": {"content": chunk}, "finish_reason": None}]}
+                self.wfile.write(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+                time.sleep(latency / 2 / len(chunks))
+            final = {"id": response_json.get("id"), "model": response_json.get("model"),
+                     "choices": [{"index": 0, "delta": {},
+                                  "finish_reason": response_json["choices"][0].get("finish_reason", "stop")}],
+                     "usage": response_json.get("usage")}
+            self.wfile.write(f"data: {json.dumps(final)}\n\ndata: [DONE]\n\n".encode("utf-8"))
+            self.wfile.flush()
+            self.close_connection = True
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def start_server(fake, port=0, host="127.0.0.1"):
+    """Serve fake on a daemon thread; returns (server, base_url)."""
+    server = ThreadingHTTPServer((host, port), _make_handler(fake))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="fake-fireworks", daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/inference/v1"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local stand-in for the Fireworks chat-completions endpoint.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--mode", choices=("replay", "record"), default="replay",
+                        help="replay recordings, or forward to FIREWORKS_UPSTREAM_URL and record the answers")
+    parser.add_argument("--recordings", default=DEFAULT_RECORDINGS_DIR)
+    parser.add_argument("--latency", default="0", help="Default latency spec, e.g. lognormal:1.5,0.4 or recorded")
+    parser.add_argument("--model-latency", action="append", default=[], metavar="MODEL=SPEC",
+                        help="Latency spec for models whose name contains MODEL (repeatable)")
+    parser.add_argument("--per-token-ms", type=float, default=0.0, help="Extra latency per completion token")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with an error")
+    parser.add_argument("--error-codes", default="503", help="Comma-separated status codes used for errors")
+    parser.add_argument("--on-miss", choices=("synthesize", "404"), default="synthesize",
+                        help="Answer for requests without a recording")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args(argv)
+
+    fake = FakeFireworks(
+        recordings_dir=args.recordings,
+        mode=args.mode,
+        latency=args.latency,
+        model_latency=dict(item.split("=", 1) for item in args.model_latency),
+        error_rate=args.error_rate,
+        error_codes=[int(code) for code in args.error_codes.split(",")],
+        on_miss=args.on_miss,
+        per_token_seconds=args.per_token_ms / 1000,
+        seed=args.seed,
+    )
+    server = ThreadingHTTPServer((args.host, args.port), _make_handler(fake))
+    server.daemon_threads = True
+    print(f"Fake Fireworks ({args.mode}) listening on http://{args.host}:{args.port}/inference/v1", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,217 @@
+# field_validation.py
+import datetime
+import re
+from difflib import SequenceMatcher
+from pydantic import ValidationError
+from config import get_setting
+
+# Fields scoring below this are sent to the large model for a second look
+CONFIDENCE_THRESHOLD = float(get_setting("FIELD_CONFIDENCE_THRESHOLD", "0.8"))
+
+# Confidence assigned when a value fails a deterministic format rule
+FORMAT_FAILURE_CONFIDENCE = 0.2
+
+US_STATE_CODES = {
+    "AL", "AK", "AZ", "AR", "CA", "CO", "CT", "DE", "DC", "FL", "GA", "HI", "ID", "IL", "IN", "IA",
+    "KS", "KY", "LA", "ME", "MD", "MA", "MI", "MN", "MS", "MO", "MT", "NE", "NV", "NH", "NJ", "NM",
+    "NY", "NC", "ND", "OH", "OK", "OR", "PA", "RI", "SC", "SD", "TN", "TX", "UT", "VT", "VA", "WA",
+    "WV", "WI", "WY", "AS", "GU", "MP", "PR", "VI",
+}
+
+
+def compact(text):
+    return re.sub(r"[^A-Z0-9]", "", str(text or "").upper())
+
+
+def tokens(text):
+    return re.findall(r"[A-Z0-9]+", str(text or "").upper())
+
+
+def text_agreement(value, raw_text):
+    """How well a field value is supported by the raw transcription, from 0 to 1.
+
+    Exact containment after stripping punctuation and spacing scores 1.0;
+    otherwise each value token is fuzzily matched against the transcription's
+    tokens and the scores are averaged.
+    """
+    value_compact = compact(value)
+    raw_compact = compact(raw_text)
+    if not value_compact:
+        return 0.0
+    if value_compact in raw_compact:
+        return 1.0
+
+    raw_tokens = set(tokens(raw_text))
+    value_tokens = tokens(value)
+    if not raw_tokens:
+        return 0.0
+    scores = []
+    for token in value_tokens:
+        if token in raw_tokens:
+            scores.append(1.0)
+        else:
+            scores.append(max(SequenceMatcher(None, token, raw).ratio() for raw in raw_tokens))
+    return sum(scores) / len(scores)
+
+
+def parse_date(value, formats):
+    for fmt in formats:
+        try:
+            return datetime.datetime.strptime(str(value).strip().title(), fmt).date()
+        except ValueError:
+            continue
+    return None
+
+
+def date_agreement(date, raw_text, formats):
+    """Agreement for dates, which the transcription may print in another layout."""
+    if date is None:
+        return 0.0
+    raw_compact = compact(raw_text)
+    renderings = {compact(date.strftime(fmt)) for fmt in formats}
+    renderings.update({date.strftime("%m%d%Y"), date.strftime("%d%m%Y"), date.strftime("%Y%m%d"),
+                       date.strftime("%m%d%y")})
+    return 1.0 if any(r in raw_compact for r in renderings) else 0.0
+
+
+def get_path(data, path):
+    for key in path.split("."):
+        if not isinstance(data, dict):
+            return None
+        data = data.get(key)
+    return data
+
+
+def set_path(data, path, value):
+    keys = path.split(".")
+    for key in keys[:-1]:
+        # A parent the model returned as null or a scalar is replaced, not descended into
+        if not isinstance(data.get(key), dict):
+            data[key] = {}
+        data = data[key]
+    data[keys[-1]] = value
+
+
+def score_fields(model_cls, fields, raw_text, rules, cross_checks=(), required=()):
+    """Score every rule-covered field of an extraction against the local rules.
+
+    rules maps a dotted field path to a callable (value, raw_text) returning
+    (format_ok, agreement, issue). cross_checks are callables (fields) that
+    return {path: issue} for relationships between fields. Returns
+    {path: {"value", "confidence", "issues"}}.
+    """
+    scores = {}
+    schema_errors = {}
+    try:
+        model_cls(**fields)
+    except ValidationError as e:
+        for error in e.errors():
+            schema_errors[".".join(str(part) for part in error["loc"])] = error["msg"]
+    except TypeError as e:
+        schema_errors["__root__"] = str(e)
+
+    for path, rule in rules.items():
+        value = get_path(fields, path)
+        issues = []
+        if path in schema_errors:
+            issues.append(schema_errors[path])
+
+        if value in (None, ""):
+            if path in required:
+                issues.append("missing required field")
+                confidence = 0.0
+            else:
+                confidence = 1.0
+        else:
+            format_ok, agreement, issue = rule(value, raw_text)
+            if issue:
+                issues.append(issue)
+            if not format_ok:
+                confidence = FORMAT_FAILURE_CONFIDENCE
+            else:
+                confidence = 0.4 + 0.6 * agreement
+                if agreement < 1.0:
+                    issues.append(f"only {agreement:.0%} supported by the raw text")
+        if path in schema_errors:
+            confidence = min(confidence, FORMAT_FAILURE_CONFIDENCE)
+        scores[path] = {"value": value, "confidence": round(confidence, 3), "issues": issues}
+
+    for check in cross_checks:
+        for path, issue in check(fields).items():
+            entry = scores.setdefault(path, {"value": get_path(fields, path), "confidence": 1.0, "issues": []})
+            entry["issues"].append(issue)
+            entry["confidence"] = min(entry["confidence"], FORMAT_FAILURE_CONFIDENCE)
+    return scores
+
+
+def fields_below_threshold(scores, threshold=CONFIDENCE_THRESHOLD):
+    return [path for path, entry in scores.items() if entry["confidence"] < threshold]
+
+
+def merge_fields(base, corrections, paths, only_present=False):
+    """Take only the given field paths from corrections, keeping everything else from base.
+
+    With only_present, paths missing from corrections (e.g. not streamed yet) keep
+    their base value.
+    """
+    merged = {key: (dict(value) if isinstance(value, dict) else value) for key, value in base.items()}
+    for path in paths:
+        value = get_path(corrections, path)
+        if value is None and only_present:
+            continue
+        set_path(merged, path, value)
+    return merged
+
+
+# Rule builders shared by the document types
+
+def text_rule(pattern=None, description=None):
+    def rule(value, raw_text):
+        if pattern and not re.fullmatch(pattern, str(value).strip()):
+            return False, 0.0, f"expected {description}"
+        return True, text_agreement(value, raw_text), None
+    return rule
+
+
+def choice_rule(choices):
+    def rule(value, raw_text):
+        if str(value).strip().upper() not in choices:
+            return False, 0.0, f"expected one of {', '.join(sorted(choices))}"
+        # Single letters are too short to check against the transcription
+        return True, 1.0, None
+    return rule
+
+
+def date_rule(formats, description):
+    def rule(value, raw_text):
+        date = parse_date(value, formats)
+        if date is None:
+            return False, 0.0, f"expected a valid {description} date"
+        return True, date_agreement(date, raw_text, formats), None
+    return rule
+
+
+def date_order_check(earlier, later, formats):
+    """Cross-check that one date field precedes another when both are present."""
+    def check(fields):
+        first = parse_date(get_path(fields, earlier), formats) if get_path(fields, earlier) else None
+        second = parse_date(get_path(fields, later), formats) if get_path(fields, later) else None
+        if first and second and first >= second:
+            issue = f"{earlier} must precede {later}"
+            return {earlier: issue, later: issue}
+        return {}
+    return check
+
+
+def focus_instructions(scores, paths):
+    """Prompt section that narrows a validation call to the fields in doubt."""
+    if not paths:
+        return ""
+    lines = [
+        "Local checks already confirmed every other field. Re-check ONLY these fields and copy all",
+        "other fields from the extracted JSON unchanged:",
+    ]
+    for path in paths:
+        issues = "; ".join(scores[path]["issues"]) or "low confidence"
+        lines.append(f"    - {path} (currently {scores[path]['value']!r}): {issues}")
+    return "\n".join(lines)
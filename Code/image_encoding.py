@@ -0,0 +1,189 @@
+# image_encoding.py
+import base64
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from io import BytesIO
+from typing import Optional
+from PIL import Image
+from pydantic import BaseModel, Field
+from config import get_setting
+
+
+class EncodingPolicy(BaseModel):
+    max_long_edge: Optional[int] = Field(None, description="Longest image side in pixels (None keeps full resolution)")
+    format: str = Field("JPEG", description="Output format: JPEG, WEBP or PNG")
+    quality: int = Field(85, description="Starting JPEG/WEBP quality")
+    min_quality: int = Field(60, description="Lowest quality tried before shrinking the image further")
+    grayscale: bool = Field(False, description="Drop colour information")
+    max_bytes: Optional[int] = Field(None, description="Target size of the encoded image in bytes (None disables)")
+    min_long_edge: int = Field(320, description="Never shrink below this long edge to meet max_bytes")
+
+
+# Orientation only needs coarse layout, so it gets a much smaller budget than
+# extraction, which has to keep small print legible.
+DEFAULT_POLICIES = {
+    "orientation": EncodingPolicy(max_long_edge=768, quality=70, min_quality=50, grayscale=True, max_bytes=60_000),
+    "classification": EncodingPolicy(max_long_edge=768, quality=70, min_quality=50, grayscale=True, max_bytes=60_000),
+    "extraction": EncodingPolicy(max_long_edge=1600, quality=80, min_quality=60, max_bytes=150_000, min_long_edge=1024),
+    # Previous behaviour: full resolution with Pillow's default JPEG settings
+    "original": EncodingPolicy(max_long_edge=None, quality=75, min_quality=75),
+}
+
+# Leading base64 characters of each format's magic bytes
+_BASE64_SIGNATURES = (("/9j/", "image/jpeg"), ("iVBORw0KGgo", "image/png"), ("UklGR", "image/webp"))
+
+QUALITY_STEP = 10
+SHRINK_FACTOR = 0.8
+
+# Encoded data URLs memoized per (document content, purpose)
+ENCODED_CACHE_ENTRIES = int(get_setting("ENCODED_IMAGE_CACHE_ENTRIES", "32"))
+_encoded_cache = OrderedDict()
+_encoded_cache_lock = threading.Lock()
+
+
+def _load_policies():
+    policies = dict(DEFAULT_POLICIES)
+    # IMAGE_ENCODING_POLICIES='{"extraction": {"max_long_edge": 2048, "format": "WEBP"}}'
+    overrides = get_setting("IMAGE_ENCODING_POLICIES")
+    if overrides:
+        for purpose, settings in json.loads(overrides).items():
+            base = policies.get(purpose, EncodingPolicy())
+            policies[purpose] = EncodingPolicy(**{**base.dict(), **settings})
+    return policies
+
+
+POLICIES = _load_policies()
+
+
+def get_policy(purpose):
+    if purpose not in POLICIES:
+        raise ValueError(f"Unknown image encoding purpose: {purpose}")
+    return POLICIES[purpose]
+
+
+def set_policy(purpose, policy):
+    POLICIES[purpose] = policy
+
+
+def _resize(img, long_edge):
+    scale = long_edge / max(img.size)
+    if scale >= 1:
+        return img
+    size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+    return img.resize(size, Image.LANCZOS, reducing_gap=3.0)
+
+
+def _convert_mode(img, policy):
+    if policy.grayscale:
+        return img.convert("L") if img.mode != "L" else img
+    if policy.format.upper() == "JPEG" and img.mode not in ("RGB", "L"):
+        return img.convert("RGB")
+    if img.mode not in ("RGB", "RGBA", "L", "LA"):
+        return img.convert("RGBA" if "transparency" in img.info else "RGB")
+    return img
+
+
+def _save(img, policy, quality):
+    buffered = BytesIO()
+    fmt = policy.format.upper()
+    if fmt == "PNG":
+        img.save(buffered, format="PNG", optimize=True)
+    elif fmt == "WEBP":
+        img.save(buffered, format="WEBP", quality=quality, method=4)
+    else:
+        img.save(buffered, format="JPEG", quality=quality, optimize=True)
+    return buffered.getvalue()
+
+
+def encode_image_bytes(img, purpose="extraction", policy=None):
+    """Encode an image under the purpose's policy and return the raw bytes.
+
+    The image is downscaled to the policy's long edge, then quality and size are
+    stepped down until the encoded result fits max_bytes (or the floor is hit).
+    """
+    policy = policy or get_policy(purpose)
+    if policy.max_long_edge:
+        img = _resize(img, policy.max_long_edge)
+    img = _convert_mode(img, policy)
+
+    quality = policy.quality
+    data = _save(img, policy, quality)
+    while policy.max_bytes and len(data) > policy.max_bytes:
+        if policy.format.upper() != "PNG" and quality - QUALITY_STEP >= policy.min_quality:
+            quality -= QUALITY_STEP
+        elif max(img.size) * SHRINK_FACTOR >= policy.min_long_edge:
+            img = _resize(img, int(max(img.size) * SHRINK_FACTOR))
+        else:
+            break
+        data = _save(img, policy, quality)
+    return data
+
+
+def encode_image_base64(img, purpose="extraction", policy=None):
+    return base64.b64encode(encode_image_bytes(img, purpose, policy)).decode('utf-8')
+
+
+def encode_image_direct(image_path, purpose="extraction", policy=None):
+    with Image.open(image_path) as img:
+        return encode_image_base64(img, purpose, policy)
+
+
+def image_data_url(image_base64):
+    """Build the data URL for an encoded image, detecting its format from the payload.
+
+    An existing data URL is returned unchanged, so stages can be handed the URL
+    built once per document instead of copying the base64 string again.
+    """
+    if image_base64.startswith("data:"):
+        return image_base64
+    for signature, mime_type in _BASE64_SIGNATURES:
+        if image_base64.startswith(signature):
+            return f"data:{mime_type};base64,{image_base64}"
+    return f"data:image/jpeg;base64,{image_base64}"
+
+
+def _content_digest(source):
+    if isinstance(source, Image.Image):
+        digest = hashlib.sha256(f"{source.mode}:{source.size}".encode("utf-8"))
+        digest.update(source.tobytes())
+        return digest.hexdigest()
+    return hashlib.sha256(source).hexdigest()
+
+
+def encode_document_image(source, purpose="extraction"):
+    """Return the data URL for a document image, encoding it once per content and purpose.
+
+    source may be a file path, a PIL image, the bytes of an image file, or an
+    already-built data URL (returned as is). Nothing is written to disk.
+    """
+    if isinstance(source, str) and source.startswith("data:"):
+        return source
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, "rb") as f:
+            source = f.read()
+
+    key = (_content_digest(source), purpose)
+    with _encoded_cache_lock:
+        if key in _encoded_cache:
+            _encoded_cache.move_to_end(key)
+            return _encoded_cache[key]
+
+    if isinstance(source, Image.Image):
+        data_url = image_data_url(encode_image_base64(source, purpose))
+    else:
+        with Image.open(BytesIO(source)) as img:
+            data_url = image_data_url(encode_image_base64(img, purpose))
+
+    with _encoded_cache_lock:
+        _encoded_cache[key] = data_url
+        while len(_encoded_cache) > ENCODED_CACHE_ENTRIES:
+            _encoded_cache.popitem(last=False)
+    return data_url
+
+
+def clear_encoded_cache():
+    with _encoded_cache_lock:
+        _encoded_cache.clear()
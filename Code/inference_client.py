@@ -0,0 +1,539 @@
+# inference_client.py
+import asyncio
+import contextvars
+import json
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from metrics import record_llm_call
+from prompts import MAX_OUTPUT_TOKENS, estimate_payload_tokens
+from rate_limiter import get_rate_limiter, parse_retry_after
+from response_cache import get_response_cache, make_cache_key
+from singleflight import AsyncSingleFlight, SingleFlight
+from config import get_api_key, get_client, get_setting
+
+BASE_URL = get_setting("FIREWORKS_BASE_URL", "https://api.fireworks.ai/inference/v1").rstrip("/")
+CHAT_COMPLETIONS_URL = f"{BASE_URL}/chat/completions"
+
+# Connection pool and timeout settings (seconds)
+POOL_SIZE = int(get_setting("INFERENCE_POOL_SIZE", "32"))
+CONNECT_TIMEOUT = float(get_setting("INFERENCE_CONNECT_TIMEOUT", "10"))
+READ_TIMEOUT = float(get_setting("INFERENCE_READ_TIMEOUT", "300"))
+
+# Retry settings for transient server errors (5xx). Throttling (429) is left to
+# the rate limiter, which backs off every caller of the model, not just one request.
+MAX_RETRIES = int(get_setting("INFERENCE_MAX_RETRIES", "4"))
+BACKOFF_FACTOR = float(get_setting("INFERENCE_BACKOFF_FACTOR", "0.5"))
+RETRY_STATUS_CODES = (500, 502, 503, 504)
+MAX_THROTTLED_RETRIES = int(get_setting("INFERENCE_MAX_THROTTLED_RETRIES", "8"))
+
+# Identical requests made while one is already in flight wait for it instead of
+# being sent again (double clicks, retried submissions, duplicate batch entries)
+COALESCE_REQUESTS = get_setting("INFERENCE_COALESCE", "1") not in ("0", "false", "False")
+_in_flight = SingleFlight()
+
+# Async callers get one httpx.AsyncClient and in-flight table per event loop,
+# since a connection belongs to the loop that opened it
+_async_clients = weakref.WeakKeyDictionary()
+_async_in_flight = weakref.WeakKeyDictionary()
+
+# Set inside run_sync. The async pipelines then make their model calls with
+# chat_completion on these threads, so sync callers keep sharing the one
+# keep-alive session instead of opening a loop-bound client per document.
+_sync_calls = contextvars.ContextVar("sync_calls", default=False)
+_call_executor = ThreadPoolExecutor(max_workers=int(get_setting("INFERENCE_SYNC_CALL_WORKERS", "64")),
+                                    thread_name_prefix="inference-call")
+
+
+class _Retry(Retry):
+    # urllib3 otherwise retries any 429 that carries Retry-After, whatever status_forcelist says
+    RETRY_AFTER_STATUS_CODES = frozenset([503])
+
+
+def _build_session():
+    retry = _Retry(
+        total=MAX_RETRIES,
+        connect=MAX_RETRIES,
+        read=MAX_RETRIES,
+        status=MAX_RETRIES,
+        backoff_factor=BACKOFF_FACTOR,
+        status_forcelist=RETRY_STATUS_CODES,
+        # Chat completions are safe to resend, so POST is retried too
+        allowed_methods=frozenset(["GET", "HEAD", "POST"]),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=retry)
+
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update(_headers())
+    return session
+
+
+def _headers():
+    return {
+        "Accept": "application/json",
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {get_api_key()}"
+    }
+
+
+def get_session():
+    """Return the process-wide keep-alive session, creating it on first use."""
+    return get_client("fireworks_session", _build_session)
+
+
+def _build_async_client():
+    # httpx is only needed by the async API, so it is imported on first use
+    import httpx
+    return httpx.AsyncClient(
+        headers=_headers(),
+        limits=httpx.Limits(max_connections=POOL_SIZE, max_keepalive_connections=POOL_SIZE),
+        timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT),
+    )
+
+
+def get_async_client():
+    """This event loop's keep-alive httpx.AsyncClient, created on first use."""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = _build_async_client()
+    return client
+
+
+async def aclose_async_client():
+    """Close this event loop's client; call before the loop shuts down."""
+    client = _async_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+def run_sync(coroutine):
+    """Run an async pipeline to completion from synchronous code.
+
+    Its model calls are made by chat_completion on a shared worker pool, so all
+    sync callers share one session, in-flight table and rate limiter as before.
+    From a thread that is already running an event loop, the coroutine runs on a
+    helper thread instead.
+    """
+    def run():
+        _sync_calls.set(True)
+        return asyncio.run(coroutine)
+
+    context = contextvars.copy_context()
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return context.run(run)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(context.run, run).result()
+
+
+def encode_payload(payload):
+    # Serialized once, compactly; the image data URL is shared with the payload
+    # dict rather than rebuilt per request.
+    return json.dumps(payload, separators=(",", ":")).encode("utf-8")
+
+
+class _StreamReader:
+    """Accumulates a server-sent-event completion stream into a regular response dict."""
+
+    def __init__(self, on_delta):
+        self.on_delta = on_delta
+        self.text = ""
+        self.last_chunk = {}
+        self.finish_reason = None
+        self.received = 0
+
+    def feed(self, line):
+        """Take one line (bytes or str); returns False once the stream is done."""
+        if isinstance(line, str):
+            line = line.encode("utf-8")
+        self.received += len(line) + 1
+        if not line.startswith(b"data:"):
+            return True
+        data = line[5:].strip()
+        if data == b"[DONE]":
+            return False
+        chunk = json.loads(data)
+        self.last_chunk = chunk
+        for choice in chunk.get("choices", []):
+            self.finish_reason = choice.get("finish_reason") or self.finish_reason
+            delta = (choice.get("delta") or {}).get("content")
+            if delta:
+                self.text += delta
+                self.on_delta(delta, self.text)
+        return True
+
+    def response(self):
+        return {
+            "id": self.last_chunk.get("id"),
+            "object": "chat.completion",
+            "model": self.last_chunk.get("model"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": self.text},
+                         "finish_reason": self.finish_reason}],
+            "usage": self.last_chunk.get("usage"),
+        }, self.received
+
+
+def _read_stream(response, on_delta):
+    """Consume a server-sent-event completion stream into a regular response dict."""
+    reader = _StreamReader(on_delta)
+    for line in response.iter_lines():
+        if not reader.feed(line):
+            break
+    return reader.response()
+
+
+async def _read_stream_async(response, on_delta):
+    reader = _StreamReader(on_delta)
+    async for line in response.aiter_lines():
+        if not reader.feed(line):
+            break
+    return reader.response()
+
+
+def chat_completion(payload, timeout=None, cache_version=None, on_delta=None):
+    """POST a chat-completion payload and return the decoded JSON response.
+
+    When cache_version (the prompt template version) is given, responses are
+    served from and stored in the content-addressed response cache.
+
+    When on_delta is given the response is streamed and on_delta(delta, text_so_far)
+    is called as content arrives; the return value has the same shape either way.
+    """
+    started = time.perf_counter()
+    model = payload.get("model")
+    cache = get_response_cache() if cache_version else None
+    # Keyed like the cache: image hashes, prompt text, model and prompt version,
+    # so the stage (template) and the document both take part
+    key = make_cache_key(payload, cache_version) if cache is not None or COALESCE_REQUESTS else None
+    if cache is not None:
+        cached = _from_cache(cache, key, model, on_delta, started)
+        if cached is not None:
+            return cached
+
+    if not COALESCE_REQUESTS:
+        return _complete(payload, timeout, cache, key, on_delta, started)
+    response_json, shared = _in_flight.do(key, _complete, payload, timeout, cache, key, on_delta, started)
+    if shared:
+        _replay(response_json, on_delta)
+        record_llm_call(model, time.perf_counter() - started, "coalesced")
+    return response_json
+
+
+async def chat_completion_async(payload, timeout=None, cache_version=None, on_delta=None):
+    """chat_completion for coroutines, with the same caching, coalescing, rate
+    limiting and metrics, on this event loop's httpx.AsyncClient.
+
+    Inside run_sync the call is made by chat_completion on a worker thread instead.
+    """
+    if _sync_calls.get():
+        return await asyncio.get_running_loop().run_in_executor(
+            _call_executor, contextvars.copy_context().run, chat_completion, payload, timeout, cache_version, on_delta)
+
+    started = time.perf_counter()
+    model = payload.get("model")
+    cache = get_response_cache() if cache_version else None
+    key = make_cache_key(payload, cache_version) if cache is not None or COALESCE_REQUESTS else None
+    if cache is not None:
+        # The cache may read from disk, which must not stall the loop
+        cached = await asyncio.to_thread(_from_cache, cache, key, model, on_delta, started)
+        if cached is not None:
+            return cached
+
+    if not COALESCE_REQUESTS:
+        return await _complete_async(payload, timeout, cache, key, on_delta, started)
+    in_flight = _async_in_flight.get(asyncio.get_running_loop())
+    if in_flight is None:
+        in_flight = _async_in_flight[asyncio.get_running_loop()] = AsyncSingleFlight()
+    response_json, shared = await in_flight.do(key, _complete_async, payload, timeout, cache, key, on_delta, started)
+    if shared:
+        _replay(response_json, on_delta)
+        record_llm_call(model, time.perf_counter() - started, "coalesced")
+    return response_json
+
+
+def _replay(response_json, on_delta):
+    # A response that was not streamed to this caller arrives as one delta
+    if on_delta is not None:
+        content = response_json["choices"][0]["message"]["content"]
+        on_delta(content, content)
+
+
+def _from_cache(cache, key, model, on_delta, started):
+    cached = cache.get(key)
+    if cached is not None:
+        _replay(cached, on_delta)
+        record_llm_call(model, time.perf_counter() - started, "hit")
+    return cached
+
+
+def _complete(payload, timeout, cache, cache_key, on_delta, started):
+    model = payload.get("model")
+    if on_delta is not None:
+        payload = dict(payload, stream=True)
+
+    response_json, transfer = _post(payload, timeout, on_delta)
+    # Output budgets are sized per call from the expected answer; an answer cut
+    # off by max_tokens is useless, so retry it with twice the budget.
+    while _truncated(response_json) and payload.get("max_tokens", MAX_OUTPUT_TOKENS) < MAX_OUTPUT_TOKENS:
+        payload = dict(payload, max_tokens=min(MAX_OUTPUT_TOKENS, payload["max_tokens"] * 2))
+        print(f"Response truncated; retrying with max_tokens={payload['max_tokens']}")
+        response_json, retry_transfer = _post(payload, timeout, on_delta)
+        transfer = {key: transfer[key] + retry_transfer[key] for key in transfer}
+        transfer["retries"] += 1
+
+    record_llm_call(model, time.perf_counter() - started, "miss" if cache is not None else "off",
+                    usage=response_json.get("usage"), **transfer)
+    if cache is not None and not _truncated(response_json):
+        cache.put(cache_key, response_json)
+    return response_json
+
+
+def _post(payload, timeout, on_delta):
+    """Send one request; returns the response dict and its transfer stats (bytes, retries)."""
+    data = encode_payload(payload)
+    limiter = get_rate_limiter().for_model(payload.get("model"))
+    # Reserved up front against the token budget, then reconciled with the reported usage
+    tokens = estimate_payload_tokens(payload) + payload.get("max_tokens", MAX_OUTPUT_TOKENS)
+    shape = payload.get("max_tokens")
+    throttled = 0
+    while True:
+        permit = limiter.acquire(tokens, shape)
+        try:
+            response = get_session().post(
+                CHAT_COMPLETIONS_URL,
+                data=data,
+                timeout=timeout or (CONNECT_TIMEOUT, READ_TIMEOUT),
+                stream=on_delta is not None,
+            )
+        except Exception:
+            limiter.release(permit, failed=True)
+            raise
+        if response.status_code == 429 and throttled < MAX_THROTTLED_RETRIES:
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            response.close()
+            limiter.release(permit, throttled=True, retry_after=retry_after or BACKOFF_FACTOR * 2 ** throttled)
+            throttled += 1
+            continue
+        try:
+            with response:
+                response.raise_for_status()
+                if on_delta is not None:
+                    response_json, received = _read_stream(response, on_delta)
+                else:
+                    received = len(response.content)
+                    response_json = response.json()
+        except Exception:
+            limiter.release(permit, failed=True, throttled=response.status_code == 429)
+            raise
+        limiter.release(permit, used_tokens=(response_json.get("usage") or {}).get("total_tokens"))
+        break
+    # Retries made by the session's urllib3 Retry policy for this request, plus 429s
+    retry_state = getattr(response.raw, "retries", None)
+    retries = throttled + (len(retry_state.history) if retry_state is not None else 0)
+    return response_json, {"bytes_sent": len(data), "bytes_received": received, "retries": retries}
+
+
+async def _complete_async(payload, timeout, cache, cache_key, on_delta, started):
+    model = payload.get("model")
+    if on_delta is not None:
+        payload = dict(payload, stream=True)
+
+    response_json, transfer = await _post_async(payload, timeout, on_delta)
+    while _truncated(response_json) and payload.get("max_tokens", MAX_OUTPUT_TOKENS) < MAX_OUTPUT_TOKENS:
+        payload = dict(payload, max_tokens=min(MAX_OUTPUT_TOKENS, payload["max_tokens"] * 2))
+        print(f"Response truncated; retrying with max_tokens={payload['max_tokens']}")
+        response_json, retry_transfer = await _post_async(payload, timeout, on_delta)
+        transfer = {key: transfer[key] + retry_transfer[key] for key in transfer}
+        transfer["retries"] += 1
+
+    record_llm_call(model, time.perf_counter() - started, "miss" if cache is not None else "off",
+                    usage=response_json.get("usage"), **transfer)
+    if cache is not None and not _truncated(response_json):
+        await asyncio.to_thread(cache.put, cache_key, response_json)
+    return response_json
+
+
+async def _post_async(payload, timeout, on_delta):
+    """_post on the event loop's client. Errors are raised as the requests exceptions
+    _post raises, so callers handle both paths alike."""
+    import httpx
+
+    data = encode_payload(payload)
+    limiter = get_rate_limiter().for_model(payload.get("model"))
+    tokens = estimate_payload_tokens(payload) + payload.get("max_tokens", MAX_OUTPUT_TOKENS)
+    shape = payload.get("max_tokens")
+    client = get_async_client()
+    if isinstance(timeout, tuple):
+        timeout = httpx.Timeout(timeout[1], connect=timeout[0])
+    elif timeout is not None:
+        timeout = httpx.Timeout(timeout)
+    throttled = 0
+    while True:
+        permit = await limiter.acquire_async(tokens, shape)
+        try:
+            response, retries = await _send_async(client, data, timeout)
+        except Exception:
+            limiter.release(permit, failed=True)
+            raise
+        if response.status_code == 429 and throttled < MAX_THROTTLED_RETRIES:
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            await response.aclose()
+            limiter.release(permit, throttled=True, retry_after=retry_after or BACKOFF_FACTOR * 2 ** throttled)
+            throttled += 1
+            continue
+        try:
+            if response.status_code >= 400:
+                await response.aread()
+                raise requests.HTTPError(f"{response.status_code} error for url: {CHAT_COMPLETIONS_URL}: "
+                                         f"{response.text[:200]}")
+            if on_delta is not None:
+                response_json, received = await _read_stream_async(response, on_delta)
+            else:
+                body = await response.aread()
+                received = len(body)
+                response_json = json.loads(body)
+        except httpx.TransportError as e:
+            limiter.release(permit, failed=True)
+            raise requests.ConnectionError(str(e)) from e
+        except Exception:
+            limiter.release(permit, failed=True, throttled=response.status_code == 429)
+            raise
+        finally:
+            await response.aclose()
+        limiter.release(permit, used_tokens=(response_json.get("usage") or {}).get("total_tokens"))
+        break
+    return response_json, {"bytes_sent": len(data), "bytes_received": received, "retries": throttled + retries}
+
+
+async def _send_async(client, data, timeout):
+    """POST with the session's retry policy: connection errors and RETRY_STATUS_CODES
+    are retried with exponential backoff (Retry-After on 503). Returns the open
+    streaming response and the number of retries made."""
+    import httpx
+
+    retries = 0
+    while True:
+        request = client.build_request("POST", CHAT_COMPLETIONS_URL, content=data,
+                                       timeout=timeout if timeout is not None else client.timeout)
+        try:
+            response = await client.send(request, stream=True)
+        except httpx.TransportError as e:
+            if retries >= MAX_RETRIES:
+                raise requests.ConnectionError(str(e)) from e
+        else:
+            if response.status_code not in RETRY_STATUS_CODES or retries >= MAX_RETRIES:
+                return response, retries
+            retry_after = parse_retry_after(response.headers.get("Retry-After")) \
+                if response.status_code in _Retry.RETRY_AFTER_STATUS_CODES else None
+            await response.aclose()
+            if retry_after is not None:
+                retries += 1
+                await asyncio.sleep(retry_after)
+                continue
+        retries += 1
+        await asyncio.sleep(BACKOFF_FACTOR * 2 ** (retries - 1))
+
+
+def _truncated(response_json):
+    return any(choice.get("finish_reason") == "length" for choice in response_json.get("choices", []))
+
+
+def parse_partial_json(text):
+    """Best-effort parse of a JSON object that is still being streamed.
+
+    Returns the object made of every value completed so far (nested objects
+    are closed off), or None if nothing complete has arrived yet.
+    """
+    start = text.find("{")
+    if start < 0:
+        return None
+    stack = []
+    in_string = False
+    escaped = False
+    cut = None
+    for i in range(start, len(text)):
+        char = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+            continue
+        if char == '"':
+            in_string = True
+        elif char in "{[":
+            stack.append("}" if char == "{" else "]")
+        elif char in "}]":
+            if stack:
+                stack.pop()
+            if not stack:
+                cut = (i + 1, "")
+                break
+            cut = (i + 1, "".join(reversed(stack)))
+        elif char == ",":
+            # Everything before a separator is a complete value
+            cut = (i, "".join(reversed(stack)))
+
+    if cut is None:
+        return None
+    end, closing = cut
+    try:
+        parsed = json.loads(text[start:end] + closing)
+    except ValueError:
+        return None
+    return parsed if isinstance(parsed, dict) else None
+
+
+def prewarm(connections=2):
+    """Open pooled connections ahead of the first model call.
+
+    Any HTTP response (even 404/405) means the TCP+TLS handshake is done and the
+    connection is parked in the pool; failures are only logged.
+    """
+    session = get_session()
+
+    def _touch():
+        try:
+            session.head(BASE_URL, timeout=(CONNECT_TIMEOUT, CONNECT_TIMEOUT)).close()
+        except requests.RequestException as e:
+            print(f"Connection pre-warm failed: {e}")
+
+    threads = [threading.Thread(target=_touch, daemon=True) for _ in range(max(1, connections))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def partial_json_handler(on_partial):
+    """Adapt an on_partial(fields) callback into a chat_completion on_delta callback.
+
+    Returns None when on_partial is None, which keeps the request unstreamed.
+    """
+    if on_partial is None:
+        return None
+    last = {}
+
+    def on_delta(delta, text):
+        # A value can only have completed if this delta closed it off
+        if "," not in delta and "}" not in delta and "]" not in delta:
+            return
+        fields = parse_partial_json(text)
+        if fields and fields != last:
+            last.clear()
+            last.update(fields)
+            on_partial(fields)
+
+    return on_delta
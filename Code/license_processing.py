@@ -1,27 +1,20 @@
 # license_processing.py
+import asyncio
 import json
-import base64
-from PIL import Image
-from io import BytesIO
-import requests
+import re
 from pprint import pprint
 from pydantic import BaseModel, Field
-from typing import Optional
-import os
-import openai
-from dotenv import load_dotenv
-
-# Load environment variables
-load_dotenv()
-
-# Access the API key
-API_KEY = os.getenv("API_KEY")
-
-if not API_KEY:
-    raise ValueError("API_KEY not found in environment variables. Please set it in your .env file or in your environment.")
-
-# Set up the Fireworks client
-client = openai.Client(api_key=API_KEY, base_url="https://api.fireworks.ai/inference/v1")
+from typing import List, Optional
+from batch_extraction import batch_content, batch_max_tokens, extract_batched, max_batch_size
+from cascade import LLAMA_11B_VISION, LLAMA_405B, CascadeRun, get_cascade_policy, model_label, schema_problem
+from field_validation import (
+    US_STATE_CODES, compact, choice_rule, date_order_check, date_rule, fields_below_threshold,
+    focus_instructions, merge_fields, score_fields, text_agreement, text_rule, tokens,
+)
+from image_encoding import encode_document_image, image_data_url
+from inference_client import chat_completion_async, partial_json_handler, run_sync
+from prompts import TRANSCRIPTION_OUTPUT_TOKENS, PromptTemplate
+from pipeline import StepLog, compact_json, extract_stage
 
 
 class Address(BaseModel):
@@ -46,20 +39,18 @@ class LicenseData(BaseModel):
     # restrictions: Optional[str] = Field(None, description="License restrictions (if any)")
     # endorsements: Optional[str] = Field(None, description="License endorsements (if any)")
 
-def encode_image_base64(img):
-    if img.mode in ('RGBA', 'LA'):
-        img = img.convert('RGB')
-    buffered = BytesIO()
-    img.save(buffered, format="JPEG")
-    return base64.b64encode(buffered.getvalue()).decode('utf-8')
+class CombinedLicenseExtraction(BaseModel):
+    fields: LicenseData = Field(..., description="Structured license fields")
+    transcription: str = Field(..., description="Verbatim transcription of all visible text, line by line")
 
-def encode_image_direct(image_path):
-    with Image.open(image_path) as img:
-        return encode_image_base64(img)
+class BatchedLicenseExtraction(CombinedLicenseExtraction):
+    image_index: int = Field(..., description="Index of the image this entry describes, as labelled in the request")
 
-def extract_json_from_llama11b(image_base64):
-    url = "https://api.fireworks.ai/inference/v1/chat/completions"
-    prompt = f"""
+class LicenseBatchExtraction(BaseModel):
+    documents: List[BatchedLicenseExtraction] = Field(..., description="One entry per image, in image order")
+
+
+LICENSE_FIELDS_PROMPT = PromptTemplate("license.extract_json", """
     Analyze this driver's license image and extract the following information:
     1. Full name (Format: LAST NAME, First Name Middle Name)
     2. Date of birth (MM/DD/YYYY)
@@ -75,7 +66,7 @@ def extract_json_from_llama11b(image_base64):
     12. License class type
 
     Provide the extracted information in a JSON format strictly adhering to the following schema:
-    {LicenseData.schema_json(indent=2)}
+    $schema
 
     Important:
     - Extract only the information visible in the image.
@@ -85,39 +76,10 @@ def extract_json_from_llama11b(image_base64):
     - Double-check the accuracy of all extracted information.
     - Pay special attention to the license number format, including any leading letters.
     - Make sure to extract the issuance date if it's visible on the license.
-    """
-    
-    # Rest of the function remains the same
-    payload = {
-        "model": "accounts/fireworks/models/llama-v3p2-11b-vision-instruct",
-        "max_tokens": 16384,
-        "temperature": 0.2,
-        "response_format": {"type": "json_object", "schema": LicenseData.schema_json()},
-        "messages": [
-            {
-                "role": "user",
-                "content": [
-                    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_base64}"}},
-                    {"type": "text", "text": prompt}
-                ]
-            }
-        ]
-    }
-    headers = {
-        "Accept": "application/json",
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {API_KEY}"
-    }
-    response = requests.post(url, headers=headers, json=payload)
-    response.raise_for_status()
-    print("Structured JSON extraction from LLaMA 11B:")
-    pprint(response.json())
-    return response.json()
+    """, response_model=LicenseData)
 
 
-def extract_raw_text_from_llama11b(image_base64):
-    url = "https://api.fireworks.ai/inference/v1/chat/completions"
-    prompt = """
+LICENSE_RAW_TEXT_PROMPT = PromptTemplate("license.extract_raw_text", """
     Extract and list all text visible in this image, line by line. Include everything you can see, such as:
     - All text on the front of the license
     - Any numbers, codes, or identifiers
@@ -132,46 +94,78 @@ def extract_raw_text_from_llama11b(image_base64):
     Read and transcribe the text in this image. Also, describe the font style and text placement.
     
     Do not interpret or structure the information, just provide a raw, detailed transcription of all visible text and elements.
-    """
-    
-    payload = {
-        "model": "accounts/fireworks/models/llama-v3p2-11b-vision-instruct",
-        "max_tokens": 16384,
-        "temperature": 0.1,
-        "response_format": {"type": "text"},
-        "messages": [
-            {
-                "role": "user",
-                "content": [
-                    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_base64}"}},
-                    {"type": "text", "text": prompt}
-                ]
-            }
-        ]
-    }
-    headers = {
-        "Accept": "application/json",
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {API_KEY}"
-    }
-    response = requests.post(url, headers=headers, json=payload)
-    response.raise_for_status()
-    print("Raw text extraction from LLaMA 11B:")
-    pprint(response.json())
-    return response.json()
+    """, output_tokens=TRANSCRIPTION_OUTPUT_TOKENS)
+
+
+LICENSE_COMBINED_PROMPT = PromptTemplate("license.extract_combined", """
+    Analyze this driver's license image and return two things in one JSON object:
+
+    1. "fields": the following information, extracted from the license:
+       - Full name (Format: LAST NAME, First Name Middle Name)
+       - Date of birth (MM/DD/YYYY)
+       - License number (alphanumeric, including any leading letters like 'I' or 'DL')
+       - Complete address (street, city, state, ZIP code)
+       - Sex/Gender, height, weight, eye color, hair color
+       - Issuance date (MM/DD/YYYY) - This is typically present, make sure to extract if visible
+       - Expiration date (MM/DD/YYYY)
+       - License class type
+
+    2. "transcription": all text visible in the image, transcribed line by line exactly as printed,
+       including numbers, codes and identifiers. Do not interpret or restructure it.
+
+    The JSON must strictly adhere to the following schema:
+    $schema
+
+    Important:
+    - Extract only the information visible in the image.
+    - Do not invent or assume any information not present.
+    - If a field is not visible or not applicable, use null for optional fields.
+    - Ensure all dates in "fields" are in MM/DD/YYYY format.
+    - Pay special attention to the license number format, including any leading letters.
+    - The transcription must be verbatim; it is used to check the extracted fields.
+    """, 
+                                    response_model=CombinedLicenseExtraction,
+                                    extra_output_tokens=TRANSCRIPTION_OUTPUT_TOKENS)
+
+
+LICENSE_BATCH_PROMPT = PromptTemplate("license.extract_batch", """
+    The $count images above are separate driver's licenses, each labelled with its index.
+    For every image, return one entry in "documents" with:
+
+    - "image_index": the index of the image the entry describes.
+    - "fields": the following information, extracted from that license only:
+       - Full name (Format: LAST NAME, First Name Middle Name)
+       - Date of birth (MM/DD/YYYY)
+       - License number (alphanumeric, including any leading letters like 'I' or 'DL')
+       - Complete address (street, city, state, ZIP code)
+       - Sex/Gender, height, weight, eye color, hair color
+       - Issuance date (MM/DD/YYYY) - This is typically present, make sure to extract if visible
+       - Expiration date (MM/DD/YYYY)
+       - License class type
+    - "transcription": all text visible in that image, transcribed line by line exactly as printed,
+       including numbers, codes and identifiers. Do not interpret or restructure it.
+
+    The JSON must strictly adhere to the following schema:
+    $schema
 
+    Important:
+    - Never mix information from different images; each entry describes exactly one image.
+    - Extract only the information visible in the image.
+    - Do not invent or assume any information not present.
+    - If a field is not visible or not applicable, use null for optional fields.
+    - Ensure all dates in "fields" are in MM/DD/YYYY format.
+    - Pay special attention to the license number format, including any leading letters.
+    """, response_model=LicenseBatchExtraction)
 
 
-def validate_fields_with_llama405b(extracted_json, raw_text):
-    url = "https://api.fireworks.ai/inference/v1/chat/completions"
-    validation_prompt = f"""
+LICENSE_VALIDATION_PROMPT = PromptTemplate("license.validate", """
     You are an expert in US driver's license validation. Your task is to validate and correct the information extracted from a driver's license image. Use the following step-by-step approach:
 
     1. Analyze the extracted JSON:
-    {json.dumps(extracted_json, indent=2)}
+    $extracted_json
 
     2. Compare it with the raw text extraction:
-    {raw_text}
+    $raw_text
 
     3. For each field in the JSON:
        a. Check if it matches the information in the raw text.
@@ -201,7 +195,7 @@ def validate_fields_with_llama405b(extracted_json, raw_text):
        c. Are there any fields you're uncertain about? If so, explain why.
 
     9. Provide the final, validated JSON that strictly adheres to this schema:
-    {LicenseData.schema_json(indent=2)}
+    $schema
 
     Remember:
     - Only include information that can be verified from the provided data.
@@ -209,34 +203,150 @@ def validate_fields_with_llama405b(extracted_json, raw_text):
     - Explain any significant changes or decisions you make in the validation process.
     - Ensure the license number is complete and accurate, including any leading characters.
     - Make sure the issuance date is included if it's visible in the raw text.
-    """
 
-    # Rest of the function remains the same
+    $focus
+    """, response_model=LicenseData)
+
 
+async def extract_json_from_llama11b_async(image_base64, model=LLAMA_11B_VISION):
     payload = {
-        "model": "accounts/fireworks/models/llama-v3p1-405b-instruct",
-        "max_tokens": 16384,
+        "model": model,
+        "max_tokens": LICENSE_FIELDS_PROMPT.max_tokens,
         "temperature": 0.2,
-        "response_format": {"type": "json_object", "schema": LicenseData.schema_json()},
+        "response_format": LICENSE_FIELDS_PROMPT.response_format,
         "messages": [
             {
                 "role": "user",
-                "content": validation_prompt
+                "content": [
+                    {"type": "image_url", "image_url": {"url": image_data_url(image_base64)}},
+                    {"type": "text", "text": LICENSE_FIELDS_PROMPT.render()}
+                ]
             }
         ]
     }
+    response_json = await chat_completion_async(payload, cache_version=LICENSE_FIELDS_PROMPT.version)
+    print(f"Structured JSON extraction from {model_label(model)}:")
+    pprint(response_json)
+    return response_json
+
 
-    headers = {
-        "Accept": "application/json",
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {API_KEY}"
+async def extract_raw_text_from_llama11b_async(image_base64, model=LLAMA_11B_VISION):
+    payload = {
+        "model": model,
+        "max_tokens": LICENSE_RAW_TEXT_PROMPT.max_tokens,
+        "temperature": 0.1,
+        "response_format": LICENSE_RAW_TEXT_PROMPT.response_format,
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "image_url", "image_url": {"url": image_data_url(image_base64)}},
+                    {"type": "text", "text": LICENSE_RAW_TEXT_PROMPT.render()}
+                ]
+            }
+        ]
+    }
+    response_json = await chat_completion_async(payload, cache_version=LICENSE_RAW_TEXT_PROMPT.version)
+    print(f"Raw text extraction from {model_label(model)}:")
+    pprint(response_json)
+    return response_json
+
+
+async def extract_combined_from_llama11b_async(image_base64, model=LLAMA_11B_VISION):
+    # One call returning both the structured fields and the raw transcription,
+    # so the image is only sent (and its tokens paid for) once.
+    payload = {
+        "model": model,
+        "max_tokens": LICENSE_COMBINED_PROMPT.max_tokens,
+        "temperature": 0.1,
+        "response_format": LICENSE_COMBINED_PROMPT.response_format,
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "image_url", "image_url": {"url": image_data_url(image_base64)}},
+                    {"type": "text", "text": LICENSE_COMBINED_PROMPT.render()}
+                ]
+            }
+        ]
+    }
+    response_json = await chat_completion_async(payload, cache_version=LICENSE_COMBINED_PROMPT.version)
+    print(f"Combined extraction from {model_label(model)}:")
+    pprint(response_json)
+    return response_json
+
+
+async def extract_batch_from_llama11b_async(images_base64, model=LLAMA_11B_VISION):
+    # Several licenses in one request: the instructions and schema are sent once
+    # for the whole batch instead of once per document.
+    payload = {
+        "model": model,
+        "max_tokens": batch_max_tokens(LICENSE_COMBINED_PROMPT, len(images_base64)),
+        "temperature": 0.1,
+        "response_format": LICENSE_BATCH_PROMPT.response_format,
+        "messages": [
+            {
+                "role": "user",
+                "content": batch_content(images_base64, LICENSE_BATCH_PROMPT.render(count=len(images_base64)),
+                                         image_data_url)
+            }
+        ]
+    }
+    response_json = await chat_completion_async(payload, cache_version=LICENSE_BATCH_PROMPT.version)
+    print(f"Batched extraction of {len(images_base64)} licenses from {model_label(model)}:")
+    pprint(response_json)
+    return response_json
+
+
+def extract_json_from_llama11b(image_base64, model=LLAMA_11B_VISION):
+    return run_sync(extract_json_from_llama11b_async(image_base64, model))
+
+
+def extract_raw_text_from_llama11b(image_base64, model=LLAMA_11B_VISION):
+    return run_sync(extract_raw_text_from_llama11b_async(image_base64, model))
+
+
+def extract_combined_from_llama11b(image_base64, model=LLAMA_11B_VISION):
+    return run_sync(extract_combined_from_llama11b_async(image_base64, model))
+
+
+def extract_batch_from_llama11b(images_base64, model=LLAMA_11B_VISION):
+    return run_sync(extract_batch_from_llama11b_async(images_base64, model))
+
+
+async def extract_license_batch_async(images_base64):
+    """One combined-extraction response per encoded image, made with as few calls as possible."""
+    model = get_cascade_policy("license").extract_models[0]
+    return await extract_batched(images_base64, lambda images: extract_batch_from_llama11b_async(images, model),
+                                 lambda image: extract_combined_from_llama11b_async(image, model),
+                                 BatchedLicenseExtraction, max_batch_size(LICENSE_COMBINED_PROMPT))
+
+
+def extract_license_batch(images_base64):
+    return run_sync(extract_license_batch_async(images_base64))
+
+
+async def validate_fields_with_llama405b_async(extracted_fields, raw_text, focus="", on_partial=None,
+                                              model=LLAMA_405B):
+    # Only the parsed fields and the transcription go into the prompt, never whole responses
+    payload = {
+        "model": model,
+        "max_tokens": LICENSE_VALIDATION_PROMPT.max_tokens,
+        "temperature": 0.2,
+        "response_format": LICENSE_VALIDATION_PROMPT.response_format,
+        "messages": [
+            {
+                "role": "user",
+                "content": LICENSE_VALIDATION_PROMPT.render(
+                    extracted_json=compact_json(extracted_fields), raw_text=raw_text, focus=focus)
+            }
+        ]
     }
 
-    response = requests.post(url, headers=headers, json=payload)
-    response.raise_for_status()
+    validated_data = await chat_completion_async(payload, cache_version=LICENSE_VALIDATION_PROMPT.version,
+                                                 on_delta=partial_json_handler(on_partial))
 
-    print("Validation and extraction response from LLaMA 405B:")
-    validated_data = response.json()
+    print(f"Validation and extraction response from {model_label(model)}:")
     pprint(validated_data)
 
     # Extract the content from the response
@@ -245,49 +355,159 @@ def validate_fields_with_llama405b(extracted_json, raw_text):
     return validated_json
 
 
-
-
-def process_license(image_path):
-    buffer = []
-
-    # Step 1: Encode the image
-    buffer.append({
-        "description": "Step 1: Encoding the image...",
-        "raw_output": {"status": "Image encoded successfully"}
-    })
-    image_base64 = encode_image_direct(image_path)
-
-    # Step 2: Extract structured JSON
-    buffer.append({
-        "description": "Step 2: Extracting structured information using LLaMA Vision 11B model...",
-        "raw_output": {}
-    })
-    extracted_json = extract_json_from_llama11b(image_base64)
-    buffer[-1]["raw_output"] = extracted_json
-
-    # Step 3: Extract raw text
-    buffer.append({
-        "description": "Step 3: Extracting raw text from the image using LLaMA Vision 11B model...",
-        "raw_output": {}
-    })
-    raw_text = extract_raw_text_from_llama11b(image_base64)
-    buffer[-1]["raw_output"] = raw_text
-
-    # Step 4: Validate fields
-    buffer.append({
-        "description": "Step 4: Validating and correcting extracted information using LLaMA 405B model...",
-        "raw_output": {}
-    })
-    validated_fields = validate_fields_with_llama405b(extracted_json, raw_text)
-    buffer[-1]["raw_output"] = validated_fields
-
-    # Step 5: Final output
-    buffer.append({
-        "description": "Step 5: Final validated output",
-        "raw_output": validated_fields
-    })
-
-    return validated_fields, buffer
+def validate_fields_with_llama405b(extracted_fields, raw_text, focus="", on_partial=None, model=LLAMA_405B):
+    return run_sync(validate_fields_with_llama405b_async(extracted_fields, raw_text, focus, on_partial, model))
+
+
+def _license_number_rule(value, raw_text):
+    number = compact(value)
+    if not re.fullmatch(r"[A-Z0-9]{4,20}", number):
+        return False, 0.0, "expected an alphanumeric license number"
+    # A letter prefix (e.g. 'I', 'DL') printed fused to the number but missing from the value
+    for token in tokens(raw_text):
+        if token != number and token.endswith(number) and token[:-len(number)].isalpha():
+            return False, 0.0, f"raw text shows it as {token}; prefix may be missing"
+    return True, text_agreement(number, raw_text), None
+
+
+def _full_name_rule(value, raw_text):
+    if "," not in value:
+        return False, 0.0, "expected 'LAST NAME, First Name Middle Name'"
+    return True, text_agreement(value, raw_text), None
+
+
+def _state_rule(value, raw_text):
+    if str(value).strip().upper() not in US_STATE_CODES:
+        return False, 0.0, "expected a two-letter US state code"
+    return True, text_agreement(value, raw_text), None
+
+
+LICENSE_DATE_FORMATS = ("%m/%d/%Y",)
+LICENSE_DATE_RULE = date_rule(LICENSE_DATE_FORMATS, "MM/DD/YYYY")
+
+LICENSE_FIELD_RULES = {
+    "full_name": _full_name_rule,
+    "date_of_birth": LICENSE_DATE_RULE,
+    "license_number": _license_number_rule,
+    "address.street": text_rule(),
+    "address.city": text_rule(),
+    "address.state": _state_rule,
+    "address.zip_code": text_rule(r"\d{5}(-?\d{4})?", "a 5 or 9 digit ZIP code"),
+    "sex": choice_rule({"M", "F", "X"}),
+    "height": text_rule(),
+    "weight": text_rule(),
+    "eye_color": text_rule(),
+    "hair_color": text_rule(),
+    "issuance_date": LICENSE_DATE_RULE,
+    "expiration_date": LICENSE_DATE_RULE,
+    "class_type": text_rule(),
+}
+
+LICENSE_REQUIRED_FIELDS = (
+    "full_name", "date_of_birth", "license_number", "address.street", "address.city",
+    "address.state", "address.zip_code", "sex", "expiration_date",
+)
+
+LICENSE_CROSS_CHECKS = (
+    date_order_check("date_of_birth", "issuance_date", LICENSE_DATE_FORMATS),
+    date_order_check("issuance_date", "expiration_date", LICENSE_DATE_FORMATS),
+)
+
+
+def score_license_fields(extracted_content, raw_text):
+    return score_fields(LicenseData, extracted_content, raw_text, LICENSE_FIELD_RULES,
+                        LICENSE_CROSS_CHECKS, LICENSE_REQUIRED_FIELDS)
+
+
+LICENSE_EXTRACTORS = (extract_json_from_llama11b_async, extract_raw_text_from_llama11b_async,
+                      extract_combined_from_llama11b_async)
+
+
+async def process_license_async(image, on_event=None, extraction_mode=None, extraction=None):
+    # image: file path, PIL image, encoded image bytes or a data URL.
+    # on_event, if given, receives step start/finish events and streamed partial results.
+    # extraction_mode: "separate" or "combined" (defaults to EXTRACTION_MODE).
+    # extraction: a combined-extraction response already made for this image
+    # (see extract_license_batch); steps 2 and 3 then make no model call.
+    # Models come from the license cascade policy: each stage starts on its
+    # cheapest model and only moves to the next when an escalation trigger fires.
+    policy = get_cascade_policy("license")
+    cascade = CascadeRun(policy)
+    with StepLog(on_event, document_type="license") as steps:
+        # Step 1: Encode the image
+        encode_step = steps.start("Step 1: Encoding the image...", stage="encode")
+        image_data = await asyncio.to_thread(encode_document_image, image)
+        steps.finish(encode_step, {"status": "Image encoded successfully"})
+
+        for tier, model in enumerate(policy.extract_models):
+            cascade.use("extract", model)
+            last = tier == len(policy.extract_models) - 1
+            try:
+                output = await extract_stage(steps, image_data, extraction_mode, model, LICENSE_EXTRACTORS,
+                                             extraction if tier == 0 else None)
+            except json.JSONDecodeError as e:
+                reasons = policy.escalation_reasons(f"answer is not valid JSON ({e})")
+                if last or not reasons:
+                    raise
+                cascade.escalate(steps, reasons, policy.extract_models[tier + 1])
+                continue
+
+            # Step 4: Score each field locally
+            scores = score_license_fields(output.fields, output.transcription)
+            doubtful_fields = fields_below_threshold(scores)
+            steps.add("Step 4: Checking extracted fields against local validation rules...",
+                      {"field_confidence": scores, "fields_in_doubt": doubtful_fields}, stage="score")
+
+            reasons = policy.escalation_reasons(schema_problem(LicenseData, output.fields), scores)
+            if last or not reasons:
+                break
+            cascade.escalate(steps, reasons, policy.extract_models[tier + 1])
+
+        # Step 5: Validate fields. The validation models are only asked about fields
+        # that failed the local rules, and only those fields are taken from their answers.
+        validated_fields = output.fields
+        if not doubtful_fields:
+            steps.add(f"Step 5: All fields passed local validation; skipping {model_label(policy.validate_models[0])} "
+                      f"validation.", validated_fields, stage="validate")
+        for tier, model in enumerate(policy.validate_models if doubtful_fields else ()):
+            cascade.use("validate", model)
+            last = tier == len(policy.validate_models) - 1
+            validate_step = steps.start(
+                f"Step 5: Validating {len(doubtful_fields)} uncertain field(s) using {model_label(model)} model...",
+                stage="validate")
+            try:
+                corrected = await steps.run_async(
+                    validate_step, validate_fields_with_llama405b_async,
+                    validated_fields, output.transcription, focus_instructions(scores, doubtful_fields),
+                    on_partial=lambda fields: steps.partial(
+                        merge_fields(validated_fields, fields, doubtful_fields, only_present=True)),
+                    model=model)
+            except json.JSONDecodeError as e:
+                reasons = policy.escalation_reasons(f"answer is not valid JSON ({e})")
+                if last or not reasons:
+                    raise
+                steps.finish(validate_step, {"error": str(e)})
+            else:
+                validated_fields = merge_fields(validated_fields, corrected, doubtful_fields)
+                if last:
+                    break
+                scores = score_license_fields(validated_fields, output.transcription)
+                doubtful_fields = fields_below_threshold(scores)
+                reasons = policy.escalation_reasons(schema_problem(LicenseData, validated_fields), scores)
+                if not reasons or not doubtful_fields:
+                    break
+            cascade.escalate(steps, reasons, policy.validate_models[tier + 1])
+
+        cascade.finish(steps, output.provenance)
+
+        # Step 6: Final output
+        steps.add("Step 6: Final validated output", validated_fields, stage="final")
+
+    return validated_fields, steps.buffer
+
+
+def process_license(image, on_event=None, extraction_mode=None, extraction=None):
+    return run_sync(process_license_async(image, on_event, extraction_mode, extraction))
 
 # # Example usage
 # if __name__ == "__main__":
@@ -0,0 +1,344 @@
+# metrics.py
+import bisect
+import contextvars
+import json
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from config import get_setting
+
+# JSON document lines go to this file, or to stdout when unset
+METRICS_LOG_PATH = get_setting("METRICS_LOG_PATH")
+# Comma-separated exporters run for every finished document: "prometheus", "json".
+# The JSON log is on by default only when it has a file to go to.
+METRICS_EXPORTERS = get_setting("METRICS_EXPORTERS", "prometheus,json" if METRICS_LOG_PATH else "prometheus")
+METRICS_PORT = int(get_setting("METRICS_PORT", "9464"))
+# Bind address of the metrics endpoint; set to 0.0.0.0 to let another host scrape it
+METRICS_HOST = get_setting("METRICS_HOST", "127.0.0.1")
+
+SECONDS_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+BYTES_BUCKETS = (1_000, 10_000, 50_000, 100_000, 250_000, 500_000, 1_000_000, 5_000_000)
+TOKENS_BUCKETS = (16, 64, 256, 512, 1024, 2048, 4096, 8192, 16384)
+
+CALL_TOTAL_KEYS = ("calls", "cache_hits", "coalesced", "retries", "bytes_sent", "bytes_received",
+                   "prompt_tokens", "completion_tokens")
+
+
+def _label_text(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{str(value).replace(chr(34), chr(39))}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_label_text(self.labels, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.labels = tuple(labels)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        if value is None:
+            return
+        key = tuple(labels.get(name, "") for name in self.labels)
+        with self._lock:
+            series = self._series.setdefault(key, {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0})
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series["buckets"][index] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, series["buckets"]):
+                    cumulative += count
+                    labels = _label_text(self.labels + ("le",), key + (bound,))
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = _label_text(self.labels + ("le",), key + ("+Inf",))
+                lines.append(f"{self.name}_bucket{labels} {series['count']}")
+                lines.append(f"{self.name}_sum{_label_text(self.labels, key)} {series['sum']}")
+                lines.append(f"{self.name}_count{_label_text(self.labels, key)} {series['count']}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help_text, labels=()):
+        metric = Counter(name, help_text, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help_text, buckets, labels=()):
+        metric = Histogram(name, help_text, buckets, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Prometheus text exposition format."""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+LLM_CALL_SECONDS = REGISTRY.histogram("kyc_llm_call_seconds", "Chat-completion wall time", SECONDS_BUCKETS,
+                                      ("model", "cache"))
+LLM_REQUEST_BYTES = REGISTRY.histogram("kyc_llm_request_bytes", "Chat-completion request body size",
+                                       BYTES_BUCKETS, ("model",))
+LLM_RESPONSE_BYTES = REGISTRY.histogram("kyc_llm_response_bytes", "Chat-completion response body size",
+                                        BYTES_BUCKETS, ("model",))
+LLM_PROMPT_TOKENS = REGISTRY.histogram("kyc_llm_prompt_tokens", "Prompt tokens per call", TOKENS_BUCKETS,
+                                       ("model",))
+LLM_COMPLETION_TOKENS = REGISTRY.histogram("kyc_llm_completion_tokens", "Completion tokens per call",
+                                           TOKENS_BUCKETS, ("model",))
+LLM_RETRIES = REGISTRY.counter("kyc_llm_retries_total", "Retried chat-completion requests", ("model",))
+LLM_CACHE = REGISTRY.counter("kyc_llm_cache_total", "Response cache lookups by result (hit, miss, off, coalesced)",
+                             ("result",))
+STAGE_WALL_SECONDS = REGISTRY.histogram("kyc_stage_wall_seconds", "Pipeline stage wall time", SECONDS_BUCKETS,
+                                        ("document_type", "stage"))
+STAGE_QUEUE_SECONDS = REGISTRY.histogram("kyc_stage_queue_seconds", "Time a stage waited for a worker",
+                                         SECONDS_BUCKETS, ("document_type", "stage"))
+DOCUMENT_SECONDS = REGISTRY.histogram("kyc_document_seconds", "End-to-end document processing time",
+                                      SECONDS_BUCKETS, ("document_type", "status"))
+
+
+class Span:
+    """A timed unit of work in a document trace; LLM calls made under it are totalled on it."""
+
+    def __init__(self, name, parent=None, **attributes):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else uuid.uuid4().hex
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = attributes
+        self.started_at = time.time()
+        self.queue_seconds = 0.0
+        self.wall_seconds = None
+        self.totals = dict.fromkeys(CALL_TOTAL_KEYS, 0)
+        self.models = []
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def record_call(self, call):
+        with self._lock:
+            self.totals["calls"] += 1
+            self.totals["cache_hits"] += call["cache"] == "hit"
+            self.totals["coalesced"] += call["cache"] == "coalesced"
+            for key in ("retries", "bytes_sent", "bytes_received", "prompt_tokens", "completion_tokens"):
+                self.totals[key] += call.get(key) or 0
+            if call["model"] and call["model"] not in self.models:
+                self.models.append(call["model"])
+
+    def end(self):
+        if self.wall_seconds is None:
+            self.wall_seconds = round(time.perf_counter() - self._start, 4)
+        return self
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "name": self.name,
+                "trace_id": self.trace_id,
+                "span_id": self.span_id,
+                "parent_id": self.parent_id,
+                "started_at": self.started_at,
+                "wall_seconds": self.wall_seconds,
+                "queue_seconds": round(self.queue_seconds, 4),
+                "models": list(self.models),
+                **self.totals,
+                **self.attributes,
+            }
+
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+def current_span():
+    return _current_span.get()
+
+
+@contextmanager
+def activate(span):
+    """Make span the parent of LLM calls and spans started in this context."""
+    token = _current_span.set(span)
+    try:
+        yield span
+    finally:
+        _current_span.reset(token)
+
+
+def record_llm_call(model, wall_seconds, cache, bytes_sent=0, bytes_received=0, usage=None, retries=0):
+    """Record one chat completion in the histograms and on the active span, if any."""
+    usage = usage or {}
+    call = {
+        "model": model,
+        "cache": cache,
+        "wall_seconds": wall_seconds,
+        "bytes_sent": bytes_sent,
+        "bytes_received": bytes_received,
+        "prompt_tokens": usage.get("prompt_tokens"),
+        "completion_tokens": usage.get("completion_tokens"),
+        "retries": retries,
+    }
+    LLM_CALL_SECONDS.observe(wall_seconds, model=model, cache=cache)
+    LLM_CACHE.inc(result=cache)
+    # Cache hits and calls coalesced into another in-flight call send nothing
+    if cache not in ("hit", "coalesced"):
+        LLM_REQUEST_BYTES.observe(bytes_sent, model=model)
+        LLM_RESPONSE_BYTES.observe(bytes_received, model=model)
+        LLM_PROMPT_TOKENS.observe(call["prompt_tokens"], model=model)
+        LLM_COMPLETION_TOKENS.observe(call["completion_tokens"], model=model)
+    if retries:
+        LLM_RETRIES.inc(retries, model=model)
+
+    span = current_span()
+    if span is not None:
+        span.record_call(call)
+    return call
+
+
+def document_record(root, stages, status):
+    """The per-document summary exported once its trace is complete."""
+    totals = dict.fromkeys(CALL_TOTAL_KEYS, 0)
+    for stage in stages:
+        for key in CALL_TOTAL_KEYS:
+            totals[key] += stage[key]
+    return {
+        "event": "document_processed",
+        "trace_id": root.trace_id,
+        "span_id": root.span_id,
+        "document_type": root.attributes.get("document_type"),
+        "tier": root.attributes.get("tier"),
+        "status": status,
+        "started_at": root.started_at,
+        "wall_seconds": root.wall_seconds,
+        "totals": totals,
+        "stages": stages,
+    }
+
+
+class PrometheusExporter:
+    """Feeds finished documents into the stage and document histograms served by start_metrics_server."""
+
+    def export_document(self, record):
+        document_type = record["document_type"] or "unknown"
+        for stage in record["stages"]:
+            STAGE_WALL_SECONDS.observe(stage["wall_seconds"], document_type=document_type, stage=stage["name"])
+            STAGE_QUEUE_SECONDS.observe(stage["queue_seconds"], document_type=document_type, stage=stage["name"])
+        DOCUMENT_SECONDS.observe(record["wall_seconds"], document_type=document_type, status=record["status"])
+
+
+class JsonLogExporter:
+    """Writes one JSON line per document."""
+
+    def __init__(self, path=METRICS_LOG_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export_document(self, record):
+        line = json.dumps(record, default=str)
+        with self._lock:
+            if self.path:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(line + "\n")
+            else:
+                print(line, file=sys.stdout, flush=True)
+
+
+EXPORTER_TYPES = {"prometheus": PrometheusExporter, "json": JsonLogExporter}
+
+
+def build_exporters(names):
+    """Exporters for a comma-separated list of names; unknown names are reported and skipped."""
+    exporters = []
+    for name in (name.strip() for name in names.split(",")):
+        if not name:
+            continue
+        if name not in EXPORTER_TYPES:
+            print(f"Unknown metrics exporter {name!r} in METRICS_EXPORTERS, skipping it "
+                  f"(known: {', '.join(EXPORTER_TYPES)})")
+            continue
+        exporters.append(EXPORTER_TYPES[name]())
+    return exporters
+
+
+EXPORTERS = build_exporters(METRICS_EXPORTERS)
+
+
+def register_exporter(exporter):
+    """Add an exporter: any object with export_document(record)."""
+    EXPORTERS.append(exporter)
+
+
+def export_document(record):
+    for exporter in EXPORTERS:
+        try:
+            exporter.export_document(record)
+        except Exception as e:
+            print(f"Metrics exporter {type(exporter).__name__} failed: {e}")
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def start_metrics_server(port=METRICS_PORT, host=METRICS_HOST):
+    """Serve the Prometheus text endpoint on a daemon thread (once per process)."""
+    global _server
+    with _server_lock:
+        if _server is None:
+            _server = ThreadingHTTPServer((host, port), _MetricsHandler)
+            threading.Thread(target=_server.serve_forever, name="metrics-server", daemon=True).start()
+            print(f"Serving metrics on http://{host}:{port}/metrics")
+    return _server
@@ -1,79 +1,48 @@
 # orientation.py
 import json
-import base64
+import numpy as np
 from PIL import Image
-from io import BytesIO
 import requests
 import os
-from dotenv import load_dotenv
-import openai
+from image_encoding import encode_image_base64, image_data_url
+from inference_client import chat_completion_async, run_sync
+from prompts import MIN_OUTPUT_TOKENS, PromptTemplate
+from config import get_setting
 
-# Load environment variables
-load_dotenv()
 
-# Access the API key
-API_KEY = os.getenv("API_KEY")
+ORIENTATION_SYSTEM_PROMPT = (
+    "You are a document validator. Your job is to ensure the document is readable. "
+    "Make sure the text is not upside down or rotated incorrectly. If the text is upside down or at an angle, "
+    "provide the correct orientation in degrees (0, 90, 180, 270) based on how a human would read it."
+)
 
-if not API_KEY:
-    raise ValueError("API_KEY not found in environment variables. Please set it in your .env file or in your environment.")
+ORIENTATION_PROMPT = PromptTemplate(
+    "orientation",
+    "Give me the correct orientation of this document in degrees as a JSON object with the key 'orientation'.",
+    response_type="json_object", output_tokens=MIN_OUTPUT_TOKENS)
 
-# Set up the Fireworks client
-client = openai.Client(api_key=API_KEY, base_url="https://api.fireworks.ai/inference/v1")
-
-
-def encode_image_base64(img):
-    if img.mode in ('RGBA', 'LA'):
-        img = img.convert('RGB')
-    buffered = BytesIO()
-    img.save(buffered, format="JPEG")
-    return base64.b64encode(buffered.getvalue()).decode('utf-8')
-
-def encode_image_direct(image_path):
-    with Image.open(image_path) as img:
-        print(f"Loaded image: {image_path} (Size: {img.size}, Mode: {img.mode})")
-        return encode_image_base64(img)
-
-def get_orientation_from_llama(image_base64):
-    url = "https://api.fireworks.ai/inference/v1/chat/completions"
-
-    system_prompt = (
-        "You are a document validator. Your job is to ensure the document is readable. "
-        "Make sure the text is not upside down or rotated incorrectly. If the text is upside down or at an angle, "
-        "provide the correct orientation in degrees (0, 90, 180, 270) based on how a human would read it."
-    )
-
-    validation_prompt = "Give me the correct orientation of this document in degrees as a JSON object with the key 'orientation'."
 
+async def get_orientation_from_llama_async(image_base64):
     payload = {
         "model": "accounts/fireworks/models/llama-v3p2-11b-vision-instruct",
-        "max_tokens": 1024,
+        "max_tokens": ORIENTATION_PROMPT.max_tokens,
         "temperature": 0,
-        "response_format": {"type": "json_object"},
+        "response_format": ORIENTATION_PROMPT.response_format,
         "messages": [
-            {"role": "system", "content": system_prompt},
+            {"role": "system", "content": ORIENTATION_SYSTEM_PROMPT},
             {
                 "role": "user",
                 "content": [
-                    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_base64}"}},
-                    {"type": "text", "text": validation_prompt}
+                    {"type": "image_url", "image_url": {"url": image_data_url(image_base64)}},
+                    {"type": "text", "text": ORIENTATION_PROMPT.render()}
                 ]
             }
         ]
     }
 
-    headers = {
-        "Accept": "application/json",
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {API_KEY}"
-    }
 
     try:
-        response = requests.post(url, headers=headers, json=payload)
-        response.raise_for_status()
-
-        response_json = response.json()
-        print(f"\n--- Raw JSON response from Fireworks API ---\n{response_json}\n")
-
+        response_json = await chat_completion_async(payload, cache_version=ORIENTATION_PROMPT.version)
         raw_response = response_json.get("choices", [])[0].get("message", {}).get("content", "")
         parsed_json = json.loads(raw_response)
         
@@ -90,39 +59,171 @@ def get_orientation_from_llama(image_base64):
         print(f"API request or JSON parsing error: {e}")
         return None
 
+
+def get_orientation_from_llama(image_base64):
+    return run_sync(get_orientation_from_llama_async(image_base64))
+
+
+# Local orientation estimation. Angles are the clockwise rotation that makes
+# the document upright, matching what get_orientation_from_llama returns.
+ORIENTATION_CONFIDENCE_THRESHOLD = float(get_setting("ORIENTATION_CONFIDENCE_THRESHOLD", "0.6"))
+ANALYSIS_LONG_EDGE = 512
+
+# EXIF orientation tag values that map to a plain rotation (mirrored ones are ignored)
+EXIF_ORIENTATION_TAG = 0x0112
+EXIF_ROTATIONS = {1: 0, 3: 180, 6: 90, 8: 270}
+
+# Text lines make the row profile of an upright page far more jagged than the
+# column profile; this ratio of the two counts as a fully confident axis.
+AXIS_RATIO_FOR_FULL_CONFIDENCE = 1.5
+# Rows of dense text spanning the page within this fraction of an edge are MRZ candidates
+MRZ_EDGE_BAND = 0.2
+MRZ_MIN_ROWS = 2
+# Skin-coloured area bounds within which the ID photo position is trusted
+FACE_MIN_FRACTION = 0.01
+FACE_MAX_FRACTION = 0.35
+
+
+def exif_orientation(img):
+    try:
+        value = img.getexif().get(EXIF_ORIENTATION_TAG)
+    except Exception:
+        return None
+    return EXIF_ROTATIONS.get(value)
+
+
+def _analysis_array(img):
+    small = img.copy()
+    small.draft("RGB", (ANALYSIS_LONG_EDGE, ANALYSIS_LONG_EDGE))
+    small = small.convert("RGB")
+    small.thumbnail((ANALYSIS_LONG_EDGE, ANALYSIS_LONG_EDGE))
+    return np.asarray(small, dtype=np.float32)
+
+
+def _ink_mask(rgb):
+    gray = rgb @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+    # Otsu threshold separates ink from background
+    hist, _ = np.histogram(gray, bins=256, range=(0, 256))
+    weight_below = np.cumsum(hist)
+    weight_above = weight_below[-1] - weight_below
+    cumulative_mean = np.cumsum(hist * np.arange(256))
+    mean_below = cumulative_mean / np.maximum(weight_below, 1)
+    mean_above = (cumulative_mean[-1] - cumulative_mean) / np.maximum(weight_above, 1)
+    between_variance = weight_below * weight_above * (mean_below - mean_above) ** 2
+    return gray < np.argmax(between_variance)
+
+
+def _profile_roughness(ink, axis):
+    profile = ink.mean(axis=axis)
+    return np.abs(np.diff(profile)).mean() / (profile.mean() + 1e-6)
+
+
+def _mrz_vote(ink, bins=16):
+    """+1 if full-width text rows sit along the bottom edge (MRZ upright), -1 if along the top."""
+    height, width = ink.shape
+    margin = int(width * 0.04)
+    transitions = np.abs(np.diff(ink.astype(np.int8), axis=1))[:, margin:width - 1 - margin]
+    density = np.stack([chunk.mean(axis=1) for chunk in np.array_split(transitions, bins, axis=1)], axis=1)
+    full_width_rows = np.nonzero((density > 0.08).mean(axis=1) >= 0.85)[0] / height
+    top = int((full_width_rows <= MRZ_EDGE_BAND).sum())
+    bottom = int((full_width_rows >= 1 - MRZ_EDGE_BAND).sum())
+    if bottom >= MRZ_MIN_ROWS and top < MRZ_MIN_ROWS:
+        return 1
+    if top >= MRZ_MIN_ROWS and bottom < MRZ_MIN_ROWS:
+        return -1
+    return 0
+
+
+def _face_vote(rgb):
+    """Signed strength in [-1, 1]: positive when the ID photo sits on the left half."""
+    r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    cb = 128 - 0.168736 * r - 0.331264 * g + 0.5 * b
+    cr = 128 + 0.5 * r - 0.418688 * g - 0.081312 * b
+    skin = (cb >= 77) & (cb <= 127) & (cr >= 138) & (cr <= 173)
+    if not FACE_MIN_FRACTION <= skin.mean() <= FACE_MAX_FRACTION:
+        return 0.0
+    offset = np.nonzero(skin)[1].mean() / skin.shape[1] - 0.5
+    return float(np.clip(-offset / 0.15, -1, 1))
+
+
+def _upright_vote(rgb):
+    """Confidence-weighted vote on whether a horizontally aligned page is upright (+) or flipped (-)."""
+    mrz = _mrz_vote(_ink_mask(rgb))
+    face = _face_vote(rgb)
+    if mrz and face and np.sign(face) != mrz:
+        return 0.3 * mrz
+    if mrz:
+        return 0.95 * mrz
+    return 0.85 * face
+
+
+def estimate_orientation_locally(img):
+    """Estimate (angle, confidence) from EXIF, text-line projection profiles and
+    MRZ/photo position heuristics on a downscaled copy of the image."""
+    angle = exif_orientation(img)
+    if angle:
+        return angle, 1.0
+
+    rgb = _analysis_array(img)
+    ink = _ink_mask(rgb)
+    row_roughness = _profile_roughness(ink, axis=1)
+    column_roughness = _profile_roughness(ink, axis=0)
+    horizontal = row_roughness >= column_roughness
+    ratio = max(row_roughness, column_roughness) / (min(row_roughness, column_roughness) + 1e-6)
+    axis_confidence = float(np.clip((ratio - 1) / (AXIS_RATIO_FOR_FULL_CONFIDENCE - 1), 0, 1))
+
+    if horizontal:
+        base_angle = 0
+    else:
+        # Turn the page a quarter counter-clockwise so its text runs horizontally
+        rgb = np.rot90(rgb, 1)
+        base_angle = 270
+    vote = _upright_vote(rgb)
+    angle = base_angle if vote >= 0 else (base_angle + 180) % 360
+    return angle, round(axis_confidence * abs(vote), 3)
+
+
+def detect_orientation(img, threshold=ORIENTATION_CONFIDENCE_THRESHOLD):
+    """Return (angle, source). The Llama model is consulted only when the local
+    estimate is below threshold; source is "local" or "llama"."""
+    angle, confidence = estimate_orientation_locally(img)
+    print(f"Local orientation estimate: {angle} degrees (confidence {confidence:.2f})")
+    if confidence >= threshold:
+        return angle, "local"
+
+    remote_angle = get_orientation_from_llama(encode_image_base64(img, purpose="orientation"))
+    if remote_angle is None:
+        return angle, "local"
+    return remote_angle, "llama"
+
+
 def rotate_image(image, angle):
     print(f"Applying rotation of {angle} degrees to the image.")
     return image.rotate(-angle, expand=True)
 
 def correct_image_orientation(image_path):
     with Image.open(image_path) as img:
-        image_base64 = encode_image_base64(img)
-        print(f"\nImage encoded as base64. Size: {len(image_base64)} characters.")
-
-    orientation = get_orientation_from_llama(image_base64)
-
-    if orientation is None:
-        print("Failed to retrieve orientation.")
-        return
-
-    rotation_angle = 0
-    if orientation == 90:
-        rotation_angle = 90
-    elif orientation == 180:
-        rotation_angle = 180
-    elif orientation == 270:
-        rotation_angle = -90
-
-    if rotation_angle != 0:
-        print(f"Rotating image by {rotation_angle} degrees.")
-        with Image.open(image_path) as img:
+        orientation, source = detect_orientation(img)
+        print(f"Orientation: {orientation} degrees (from {source}).")
+
+        rotation_angle = 0
+        if orientation == 90:
+            rotation_angle = 90
+        elif orientation == 180:
+            rotation_angle = 180
+        elif orientation == 270:
+            rotation_angle = -90
+
+        if rotation_angle != 0:
+            print(f"Rotating image by {rotation_angle} degrees.")
             rotated_image = rotate_image(img, rotation_angle)
 
             corrected_image_path = os.path.join("corrected_images", os.path.basename(image_path))
+            os.makedirs(os.path.dirname(corrected_image_path), exist_ok=True)
             save_image_with_quality(rotated_image, corrected_image_path)
             print(f"Corrected image saved at: {corrected_image_path}")
-    else:
-        print("Image is already in the correct orientation.")
+        else:
+            print("Image is already in the correct orientation.")
 
 def save_image_with_quality(image, output_path):
     if image.mode in ('RGBA', 'LA', 'P'):
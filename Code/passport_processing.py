@@ -1,23 +1,20 @@
 # passport_processing.py
+import asyncio
+import datetime
 import json
-import base64
-from PIL import Image
-from io import BytesIO
-import requests
-from pprint import pprint
+import re
 from pydantic import BaseModel, Field
-from typing import Optional
-import os
-from dotenv import load_dotenv
-
-# Load environment variables
-load_dotenv()
-
-# Access the API key
-API_KEY = os.getenv("API_KEY")
-
-if not API_KEY:
-    raise ValueError("API_KEY not found in environment variables. Please set it in your .env file or in your environment.")
+from typing import List, Optional
+from batch_extraction import batch_content, batch_max_tokens, extract_batched, max_batch_size
+from cascade import LLAMA_11B_VISION, LLAMA_405B, CascadeRun, get_cascade_policy, model_label, schema_problem
+from field_validation import (
+    choice_rule, date_order_check, date_rule, fields_below_threshold, focus_instructions,
+    merge_fields, score_fields, text_rule,
+)
+from image_encoding import encode_document_image, image_data_url
+from inference_client import chat_completion_async, partial_json_handler, run_sync
+from prompts import TRANSCRIPTION_OUTPUT_TOKENS, PromptTemplate
+from pipeline import StepLog, compact_json, extract_stage
 
 class MRZ(BaseModel):
     line1: str = Field(..., description="First line of MRZ (44 characters)")
@@ -35,20 +32,19 @@ class PassportData(BaseModel):
     authority: Optional[str] = Field(None, description="Issuing authority")
     mrz: Optional[dict] = Field(None, description="Machine Readable Zone data")
 
-def encode_image_base64(img):
-    if img.mode in ('RGBA', 'LA'):
-        img = img.convert('RGB')
-    buffered = BytesIO()
-    img.save(buffered, format="JPEG")
-    return base64.b64encode(buffered.getvalue()).decode('utf-8')
 
-def encode_image_direct(image_path):
-    with Image.open(image_path) as img:
-        return encode_image_base64(img)
+class CombinedPassportExtraction(BaseModel):
+    fields: PassportData = Field(..., description="Structured passport fields")
+    transcription: str = Field(..., description="Verbatim transcription of all visible text, line by line")
+
+class BatchedPassportExtraction(CombinedPassportExtraction):
+    image_index: int = Field(..., description="Index of the image this entry describes, as labelled in the request")
+
+class PassportBatchExtraction(BaseModel):
+    documents: List[BatchedPassportExtraction] = Field(..., description="One entry per image, in image order")
 
-def extract_json_from_llama11b(image_base64):
-    url = "https://api.fireworks.ai/inference/v1/chat/completions"
-    prompt = f"""
+
+PASSPORT_FIELDS_PROMPT = PromptTemplate("passport.extract_json", """
     Analyze this passport image and extract the following information:
     - Full name of the passport holder
     - Date of birth (in format: DD MMM YYYY)
@@ -68,13 +64,13 @@ def extract_json_from_llama11b(image_base64):
     4. The MRZ should only contain uppercase letters, numbers, and '<' symbols.
 
     Provide the extracted information in a JSON format strictly adhering to the following schema:
-    {PassportData.schema_json(indent=2)}
+    $schema
 
     Example MRZ format:
-    "mrz": {{
+    "mrz": {
         "line1": "P<USASMITH<<JOHN<<<<<<<<<<<<<<<<<<<<<<<<<<<<",
         "line2": "1234567890USA6802034M1509048<<<<<<<<<<<<<<02"
-    }}
+    }
 
     Important:
     - Extract only the information visible in the image.
@@ -82,79 +78,10 @@ def extract_json_from_llama11b(image_base64):
     - If a field is not visible or not applicable, use null for optional fields.
     - Ensure all dates are in DD MMM YYYY format.
     - Double-check the accuracy of all extracted information.
-    """
-    
-    payload = {
-        "model": "accounts/fireworks/models/llama-v3p2-11b-vision-instruct",
-        "max_tokens": 16384,
-        "temperature": 0.1,
-        "response_format": {"type": "json_object", "schema": PassportData.schema_json()},
-        "messages": [
-            {
-                "role": "user",
-                "content": [
-                    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_base64}"}},
-                    {"type": "text", "text": prompt}
-                ]
-            }
-        ]
-    }
-    headers = {
-        "Accept": "application/json",
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {API_KEY}"
-    }
-    response = requests.post(url, headers=headers, json=payload)
-    response.raise_for_status()
-    return response.json()
+    """, response_model=PassportData)
 
 
-    url = "https://api.fireworks.ai/inference/v1/chat/completions"
-    prompt = """
-    Extract and list all text visible in this passport image, line by line. Include everything you can see, such as:
-    - All text on the passport page
-    - Any numbers, codes, or identifiers
-    - Text in different fonts or sizes
-    - Any watermarks or security features you can discern
-    - Text orientation and placement
-    
-    Pay special attention to the Machine Readable Zone (MRZ) at the bottom of the passport page. 
-    Transcribe it exactly as it appears, maintaining the original formatting.
-    
-    Example MRZ format:
-    P<USASMITH<<JOHN<<<<<<<<<<<<<<<<<<<<<<<<<<
-    1234567890USA6802034M1509048<<<<<<<<<<<<<<02
-    
-    Do not interpret or structure the information, just provide a raw, detailed transcription of all visible text and elements.
-    """
-    
-    payload = {
-        "model": "accounts/fireworks/models/llama-v3p2-11b-vision-instruct",
-        "max_tokens": 16384,
-        "temperature": 0.1,
-        "response_format": {"type": "text"},
-        "messages": [
-            {
-                "role": "user",
-                "content": [
-                    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_base64}"}},
-                    {"type": "text", "text": prompt}
-                ]
-            }
-        ]
-    }
-    headers = {
-        "Accept": "application/json",
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {API_KEY}"
-    }
-    response = requests.post(url, headers=headers, json=payload)
-    response.raise_for_status()
-    return response.json()
-
-def extract_raw_text_from_llama11b(image_base64):
-    url = "https://api.fireworks.ai/inference/v1/chat/completions"
-    prompt = """
+PASSPORT_RAW_TEXT_PROMPT = PromptTemplate("passport.extract_raw_text", """
     Extract and list all text visible in this passport image, line by line. Include everything you can see, such as:
     - All text on the passport page
     - Any numbers, codes, or identifiers
@@ -164,43 +91,82 @@ def extract_raw_text_from_llama11b(image_base64):
     
     Provide the extracted text as plain text without any formatting or markdown syntax.
     Do not interpret or structure the information, just provide a raw, detailed transcription of all visible text and elements.
-    """
-    
-    payload = {
-        "model": "accounts/fireworks/models/llama-v3p2-11b-vision-instruct",
-        "max_tokens": 16384,
-        "temperature": 0.1,
-        "response_format": {"type": "text"},
-        "messages": [
-            {
-                "role": "user",
-                "content": [
-                    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_base64}"}},
-                    {"type": "text", "text": prompt}
-                ]
-            }
-        ]
-    }
-    headers = {
-        "Accept": "application/json",
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {API_KEY}"
-    }
-    response = requests.post(url, headers=headers, json=payload)
-    response.raise_for_status()
-    return response.json()
+    """, output_tokens=TRANSCRIPTION_OUTPUT_TOKENS)
+
+
+PASSPORT_COMBINED_PROMPT = PromptTemplate("passport.extract_combined", """
+    Analyze this passport image and return two things in one JSON object:
+
+    1. "fields": the following information, extracted from the passport:
+       - Full name of the passport holder
+       - Date of birth (in format: DD MMM YYYY)
+       - Passport number
+       - Nationality
+       - Place of birth (if visible)
+       - Issuance date (in format: DD MMM YYYY)
+       - Expiration date (in format: DD MMM YYYY)
+       - Sex (M or F)
+       - Authority (issuing authority)
+       - MRZ (Machine Readable Zone) as "line1" and "line2", each exactly 44 characters of
+         uppercase letters, numbers and '<' symbols, copied without interpretation
+
+    2. "transcription": all text visible in the passport page, transcribed line by line exactly
+       as printed, as plain text. Do not interpret or restructure it.
 
+    The JSON must strictly adhere to the following schema:
+    $schema
 
-def validate_fields_with_llama405b(extracted_json, raw_text):
-    url = "https://api.fireworks.ai/inference/v1/chat/completions"
-    validation_prompt = f"""
+    Important:
+    - Extract only the information visible in the image.
+    - Do not invent or assume any information not present.
+    - If a field is not visible or not applicable, use null for optional fields.
+    - Ensure all dates in "fields" are in DD MMM YYYY format.
+    - The transcription must be verbatim; it is used to check the extracted fields.
+    """, 
+                                    response_model=CombinedPassportExtraction,
+                                    extra_output_tokens=TRANSCRIPTION_OUTPUT_TOKENS)
+
+
+PASSPORT_BATCH_PROMPT = PromptTemplate("passport.extract_batch", """
+    The $count images above are separate passports, each labelled with its index.
+    For every image, return one entry in "documents" with:
+
+    - "image_index": the index of the image the entry describes.
+    - "fields": the following information, extracted from that passport only:
+       - Full name of the passport holder
+       - Date of birth (in format: DD MMM YYYY)
+       - Passport number
+       - Nationality
+       - Place of birth (if visible)
+       - Issuance date (in format: DD MMM YYYY)
+       - Expiration date (in format: DD MMM YYYY)
+       - Sex (M or F)
+       - Authority (issuing authority)
+       - MRZ (Machine Readable Zone) as "line1" and "line2", each exactly 44 characters of
+         uppercase letters, numbers and '<' symbols, copied without interpretation
+    - "transcription": all text visible in that passport page, transcribed line by line exactly
+       as printed, as plain text. Do not interpret or restructure it.
+
+    The JSON must strictly adhere to the following schema:
+    $schema
+
+    Important:
+    - Never mix information from different images; each entry describes exactly one image.
+    - Extract only the information visible in the image.
+    - Do not invent or assume any information not present.
+    - If a field is not visible or not applicable, use null for optional fields.
+    - Ensure all dates in "fields" are in DD MMM YYYY format.
+    """, response_model=PassportBatchExtraction)
+
+
+PASSPORT_VALIDATION_PROMPT = PromptTemplate("passport.validate", """
     You are an expert in passport validation. Your task is to validate and correct the information extracted from a passport image. Use the following step-by-step approach:
 
     1. Analyze the extracted JSON:
-    {json.dumps(extracted_json, indent=2)}
+    $extracted_json
 
     2. Compare it with the raw text extraction:
-    {raw_text}
+    $raw_text
 
     3. For each field in the JSON:
        a. Check if it matches the information in the raw text.
@@ -236,174 +202,491 @@ def validate_fields_with_llama405b(extracted_json, raw_text):
     - If a field is truly missing or cannot be determined, use null for optional fields.
     - Explain any significant changes or decisions you make in the validation process.
     - Ensure the MRZ is complete, accurately transcribed, and consistent with other passport data.
-    """
 
+    $focus
+    """, response_model=PassportData)
+
+
+async def extract_json_from_llama11b_async(image_base64, model=LLAMA_11B_VISION):
     payload = {
-        "model": "accounts/fireworks/models/llama-v3p1-405b-instruct",
-        "max_tokens": 16384,
-        "temperature": 0.2,
-        "response_format": {"type": "json_object", "schema": PassportData.schema_json()},
+        "model": model,
+        "max_tokens": PASSPORT_FIELDS_PROMPT.max_tokens,
+        "temperature": 0.1,
+        "response_format": PASSPORT_FIELDS_PROMPT.response_format,
         "messages": [
             {
                 "role": "user",
-                "content": validation_prompt
+                "content": [
+                    {"type": "image_url", "image_url": {"url": image_data_url(image_base64)}},
+                    {"type": "text", "text": PASSPORT_FIELDS_PROMPT.render()}
+                ]
             }
         ]
     }
-    headers = {
-        "Accept": "application/json",
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {API_KEY}"
+    return await chat_completion_async(payload, cache_version=PASSPORT_FIELDS_PROMPT.version)
+
+
+async def extract_raw_text_from_llama11b_async(image_base64, model=LLAMA_11B_VISION):
+    payload = {
+        "model": model,
+        "max_tokens": PASSPORT_RAW_TEXT_PROMPT.max_tokens,
+        "temperature": 0.1,
+        "response_format": PASSPORT_RAW_TEXT_PROMPT.response_format,
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "image_url", "image_url": {"url": image_data_url(image_base64)}},
+                    {"type": "text", "text": PASSPORT_RAW_TEXT_PROMPT.render()}
+                ]
+            }
+        ]
     }
-    response = requests.post(url, headers=headers, json=payload)
-    response.raise_for_status()
-    validated_data = response.json()
-    return json.loads(validated_data['choices'][0]['message']['content'])
+    return await chat_completion_async(payload, cache_version=PASSPORT_RAW_TEXT_PROMPT.version)
 
 
-def process_passport(image_path):
-    buffer = []
+async def extract_combined_from_llama11b_async(image_base64, model=LLAMA_11B_VISION):
+    # One call returning both the structured fields and the raw transcription,
+    # so the image is only sent (and its tokens paid for) once.
+    payload = {
+        "model": model,
+        "max_tokens": PASSPORT_COMBINED_PROMPT.max_tokens,
+        "temperature": 0.1,
+        "response_format": PASSPORT_COMBINED_PROMPT.response_format,
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "image_url", "image_url": {"url": image_data_url(image_base64)}},
+                    {"type": "text", "text": PASSPORT_COMBINED_PROMPT.render()}
+                ]
+            }
+        ]
+    }
+    return await chat_completion_async(payload, cache_version=PASSPORT_COMBINED_PROMPT.version)
 
-    try:
-        # Step 1: Encode the image
-        buffer.append({
-            "description": "Step 1: Encoding the image...",
-            "raw_output": {"status": "Image encoded successfully"}
-        })
-        image_base64 = encode_image_direct(image_path)
-
-        # Step 2: Extract structured JSON
-        buffer.append({
-            "description": "Step 2: Extracting structured information using LLaMA Vision 11B model...",
-            "raw_output": {}
-        })
-        extracted_json = extract_json_from_llama11b(image_base64)
-        extracted_content = json.loads(extracted_json['choices'][0]['message']['content'])
-        buffer[-1]["raw_output"] = extracted_content
-
-        # Step 3: Extract raw text
-        buffer.append({
-            "description": "Step 3: Extracting raw text from the image...",
-            "raw_output": {}
-        })
-        raw_text_response = extract_raw_text_from_llama11b(image_base64)
-        raw_content = raw_text_response['choices'][0]['message']['content']
-        buffer[-1]["raw_output"] = {"raw_text": raw_content}
-
-        # Step 4: Validate and correct fields
-        buffer.append({
-            "description": "Step 4: Validating and correcting extracted information using LLaMA 405B model...",
-            "raw_output": {}
-        })
-        validated_data = validate_fields_with_llama405b(extracted_content, raw_content)
-        buffer[-1]["raw_output"] = validated_data
-
-        # Step 5: Create PassportData object
-        passport_data = PassportData(**validated_data)
-        
-        return passport_data.dict(), buffer
-
-    except Exception as e:
-        print(f"Error in processing passport: {str(e)}")
-        buffer.append({
-            "description": "Error in processing",
-            "raw_output": {"error": str(e)}
-        })
-        return None, buffer
-    buffer = []
 
-    try:
-        # Step 1: Encode the image
-        buffer.append({
-            "description": "Step 1: Encoding the image...",
-            "raw_output": {"status": "Image encoded successfully"}
-        })
-        image_base64 = encode_image_direct(image_path)
-
-        # Step 2: Extract structured JSON
-        buffer.append({
-            "description": "Step 2: Extracting structured information using LLaMA Vision 11B model...",
-            "raw_output": {}
-        })
-        extracted_json = extract_json_from_llama11b(image_base64)
-        extracted_content = json.loads(extracted_json['choices'][0]['message']['content'])
-        buffer[-1]["raw_output"] = extracted_content
-
-        # Step 3: Extract raw text
-        buffer.append({
-            "description": "Step 3: Extracting raw text from the image...",
-            "raw_output": {}
-        })
-        raw_text = extract_raw_text_from_llama11b(image_base64)
-        raw_content = raw_text['choices'][0]['message']['content']
-        buffer[-1]["raw_output"] = raw_content
-
-        # Step 4: Validate and correct fields
-        buffer.append({
-            "description": "Step 4: Validating and correcting extracted information using LLaMA 405B model...",
-            "raw_output": {}
-        })
-        validated_data = validate_fields_with_llama405b(extracted_content, raw_content)
-        buffer[-1]["raw_output"] = validated_data
-
-        # Step 5: Create PassportData object
-        passport_data = PassportData(**validated_data)
-        
-        return passport_data.dict(), buffer
-
-    except Exception as e:
-        print(f"Error in processing passport: {str(e)}")
-        buffer.append({
-            "description": "Error in processing",
-            "raw_output": {"error": str(e)}
-        })
-        return None, buffer
-    buffer = []
+async def extract_batch_from_llama11b_async(images_base64, model=LLAMA_11B_VISION):
+    # Several passports in one request: the instructions and schema are sent once
+    # for the whole batch instead of once per document.
+    payload = {
+        "model": model,
+        "max_tokens": batch_max_tokens(PASSPORT_COMBINED_PROMPT, len(images_base64)),
+        "temperature": 0.1,
+        "response_format": PASSPORT_BATCH_PROMPT.response_format,
+        "messages": [
+            {
+                "role": "user",
+                "content": batch_content(images_base64, PASSPORT_BATCH_PROMPT.render(count=len(images_base64)),
+                                         image_data_url)
+            }
+        ]
+    }
+    return await chat_completion_async(payload, cache_version=PASSPORT_BATCH_PROMPT.version)
+
+
+def extract_json_from_llama11b(image_base64, model=LLAMA_11B_VISION):
+    return run_sync(extract_json_from_llama11b_async(image_base64, model))
+
+
+def extract_raw_text_from_llama11b(image_base64, model=LLAMA_11B_VISION):
+    return run_sync(extract_raw_text_from_llama11b_async(image_base64, model))
+
+
+def extract_combined_from_llama11b(image_base64, model=LLAMA_11B_VISION):
+    return run_sync(extract_combined_from_llama11b_async(image_base64, model))
+
+
+def extract_batch_from_llama11b(images_base64, model=LLAMA_11B_VISION):
+    return run_sync(extract_batch_from_llama11b_async(images_base64, model))
+
+
+async def extract_passport_batch_async(images_base64):
+    """One combined-extraction response per encoded image, made with as few calls as possible."""
+    model = get_cascade_policy("passport").extract_models[0]
+    return await extract_batched(images_base64, lambda images: extract_batch_from_llama11b_async(images, model),
+                                 lambda image: extract_combined_from_llama11b_async(image, model),
+                                 BatchedPassportExtraction, max_batch_size(PASSPORT_COMBINED_PROMPT))
 
+
+def extract_passport_batch(images_base64):
+    return run_sync(extract_passport_batch_async(images_base64))
+
+
+async def validate_fields_with_llama405b_async(extracted_fields, raw_text, focus="", on_partial=None,
+                                              model=LLAMA_405B):
+    # Only the parsed fields and the transcription go into the prompt, never whole responses
+    payload = {
+        "model": model,
+        "max_tokens": PASSPORT_VALIDATION_PROMPT.max_tokens,
+        "temperature": 0.2,
+        "response_format": PASSPORT_VALIDATION_PROMPT.response_format,
+        "messages": [
+            {
+                "role": "user",
+                "content": PASSPORT_VALIDATION_PROMPT.render(
+                    extracted_json=compact_json(extracted_fields), raw_text=raw_text, focus=focus)
+            }
+        ]
+    }
+    validated_data = await chat_completion_async(payload, cache_version=PASSPORT_VALIDATION_PROMPT.version,
+                                                 on_delta=partial_json_handler(on_partial))
+    return json.loads(validated_data['choices'][0]['message']['content'])
+
+
+def validate_fields_with_llama405b(extracted_fields, raw_text, focus="", on_partial=None, model=LLAMA_405B):
+    return run_sync(validate_fields_with_llama405b_async(extracted_fields, raw_text, focus, on_partial, model))
+
+
+# ICAO 9303 TD3 (passport) machine readable zone: two lines of 44 characters
+MRZ_LINE_LENGTH = 44
+MRZ_WEIGHTS = (7, 3, 1)
+MRZ_LINE_PATTERN = re.compile(r"[A-Z0-9<]{30,50}")
+MONTHS = ("JAN", "FEB", "MAR", "APR", "MAY", "JUN", "JUL", "AUG", "SEP", "OCT", "NOV", "DEC")
+
+
+def mrz_check_digit(field):
+    total = 0
+    for i, char in enumerate(field):
+        if char.isdigit():
+            value = int(char)
+        elif "A" <= char <= "Z":
+            value = ord(char) - ord("A") + 10
+        else:  # filler '<'
+            value = 0
+        total += value * MRZ_WEIGHTS[i % 3]
+    return str(total % 10)
+
+
+def _normalize_mrz_line(line):
+    return re.sub(r"\s+", "", line or "").upper()
+
+
+def find_td3_lines(extracted_content=None, raw_text=None):
+    """Locate the two TD3 MRZ lines in the 11B JSON output or the raw transcription."""
+    candidates = []
+    mrz = (extracted_content or {}).get("mrz")
+    if isinstance(mrz, dict) and mrz.get("line1") and mrz.get("line2"):
+        candidates.append((_normalize_mrz_line(mrz["line1"]), _normalize_mrz_line(mrz["line2"])))
+
+    if raw_text:
+        lines = [_normalize_mrz_line(line) for line in raw_text.splitlines()]
+        lines = [line for line in lines if MRZ_LINE_PATTERN.fullmatch(line)]
+        for first, second in zip(lines, lines[1:]):
+            if first.startswith("P"):
+                candidates.append((first, second))
+
+    structural = []
+    for line1, line2 in candidates:
+        # Trailing fillers on the name line are often dropped in transcription;
+        # line 2 has no slack because its positions carry check digits.
+        line1 = line1[:MRZ_LINE_LENGTH].ljust(MRZ_LINE_LENGTH, "<")
+        if line1.startswith("P") and len(line2) == MRZ_LINE_LENGTH:
+            structural.append((line1, line2))
+
+    # Prefer a candidate whose check digits all hold, e.g. the raw transcription
+    # when the JSON copy has a misread character
+    for line1, line2 in structural:
+        if parse_td3_mrz(line1, line2)["valid"]:
+            return line1, line2
+    return structural[0] if structural else None
+
+
+def _mrz_date(yymmdd, future):
+    if not yymmdd.isdigit():
+        return None
+    yy, mm, dd = int(yymmdd[:2]), int(yymmdd[2:4]), int(yymmdd[4:])
+    current_yy = datetime.date.today().year % 100
+    if future:
+        year = 2000 + yy
+    else:
+        year = (1900 if yy > current_yy else 2000) + yy
     try:
-        # Step 1: Encode the image
-        buffer.append({
-            "description": "Step 1: Encoding the image...",
-            "raw_output": {"status": "Image encoded successfully"}
-        })
-        image_base64 = encode_image_direct(image_path)
-
-        # Step 2: Extract structured JSON
-        buffer.append({
-            "description": "Step 2: Extracting structured information using LLaMA Vision 11B model...",
-            "raw_output": {}
-        })
-        extracted_json = extract_json_from_llama11b(image_base64)
-        buffer[-1]["raw_output"] = extracted_json
-
-        # Step 3: Extract raw text
-        buffer.append({
-            "description": "Step 3: Extracting raw text from the image...",
-            "raw_output": {}
-        })
-        raw_text = extract_raw_text_from_llama11b(image_base64)
-        buffer[-1]["raw_output"] = raw_text
-
-        # Step 4: Validate and correct fields
-        buffer.append({
-            "description": "Step 4: Validating and correcting extracted information using LLaMA 405B model...",
-            "raw_output": {}
-        })
-        validated_data = validate_fields_with_llama405b(extracted_json, raw_text)
-        buffer[-1]["raw_output"] = validated_data
-
-        # Step 5: Create PassportData object
-        passport_data = PassportData(**validated_data)
-        
-        return passport_data.dict(), buffer
-
-    except Exception as e:
-        print(f"Error in processing passport: {str(e)}")
-        buffer.append({
-            "description": "Error in processing",
-            "raw_output": {"error": str(e)}
-        })
-        return None, buffer
+        return datetime.date(year, mm, dd)
+    except ValueError:
+        return None
+
+
+def _format_passport_date(date):
+    return f"{date.day:02d} {MONTHS[date.month - 1]} {date.year}" if date else None
+
+
+def parse_td3_mrz(line1, line2):
+    """Decode a TD3 MRZ and verify all of its check digits."""
+    passport_number = line2[0:9]
+    birth = line2[13:19]
+    expiry = line2[21:27]
+    personal_number = line2[28:42]
+    personal_check = line2[42]
+    composite = line2[0:10] + line2[13:20] + line2[21:43]
+
+    checks = {
+        "passport_number": mrz_check_digit(passport_number) == line2[9],
+        "date_of_birth": mrz_check_digit(birth) == line2[19],
+        "expiration_date": mrz_check_digit(expiry) == line2[27],
+        # An unused personal number may carry '<' instead of 0
+        "personal_number": mrz_check_digit(personal_number) == personal_check
+            or (personal_check == "<" and personal_number.strip("<") == ""),
+        "composite": mrz_check_digit(composite) == line2[43],
+    }
+
+    names = line1[5:].split("<<", 1)
+    surname = names[0].replace("<", " ").strip()
+    given_names = names[1].replace("<", " ").strip() if len(names) > 1 else ""
+    date_of_birth = _mrz_date(birth, future=False)
+    expiration_date = _mrz_date(expiry, future=True)
+
+    fields = {
+        "document_type": line1[0:2].replace("<", ""),
+        "issuing_country": line1[2:5].replace("<", ""),
+        "surname": surname,
+        "given_names": given_names,
+        "full_name": " ".join(part for part in (given_names, surname) if part),
+        "passport_number": passport_number.replace("<", ""),
+        "nationality": line2[10:13].replace("<", ""),
+        "date_of_birth": _format_passport_date(date_of_birth),
+        "sex": line2[20] if line2[20] in ("M", "F") else "X",
+        "expiration_date": _format_passport_date(expiration_date),
+        "personal_number": personal_number.replace("<", "") or None,
+    }
+    valid = all(checks.values()) and date_of_birth is not None and expiration_date is not None
+    return {"fields": fields, "checks": checks, "valid": valid, "line1": line1, "line2": line2}
+
+
+def _date_candidates(text):
+    """All dates a free-form passport date string could denote (DD/MM vs MM/DD is ambiguous)."""
+    if not text:
+        return set()
+    text = re.sub(r"([A-Z]{3})/[A-Z]{3}", r"\1", str(text).upper().strip())
+    dates = set()
+    for fmt in ("%d %b %Y", "%d %B %Y", "%Y-%m-%d", "%d/%m/%Y", "%m/%d/%Y", "%d.%m.%Y", "%d-%m-%Y", "%d %m %Y"):
+        try:
+            dates.add(datetime.datetime.strptime(text.title(), fmt).date())
+        except ValueError:
+            continue
+    return dates
+
+
+def mrz_mismatched_fields(mrz_fields, extracted_content):
+    """Checksummed MRZ fields whose 11B values disagree with the MRZ."""
+    def alnum(value):
+        return re.sub(r"[^A-Z0-9]", "", str(value or "").upper())
+
+    mismatched = []
+    if alnum(extracted_content.get("passport_number")) != alnum(mrz_fields["passport_number"]):
+        mismatched.append("passport_number")
+    for field in ("date_of_birth", "expiration_date"):
+        mrz_date = datetime.datetime.strptime(mrz_fields[field].title(), "%d %b %Y").date()
+        if mrz_date not in _date_candidates(extracted_content.get(field)):
+            mismatched.append(field)
+    if str(extracted_content.get("sex") or "").strip().upper()[:1] != mrz_fields["sex"]:
+        mismatched.append("sex")
+    return mismatched
+
+
+def mrz_matches_extraction(mrz_fields, extracted_content):
+    """True when the 11B fields agree with the checksummed MRZ values."""
+    return not mrz_mismatched_fields(mrz_fields, extracted_content)
+
+
+def passport_data_from_mrz(mrz_result, extracted_content):
+    """Merge checksummed MRZ values over the 11B fields."""
+    fields = mrz_result["fields"]
+    data = dict(extracted_content)
+    data.update({
+        "passport_number": fields["passport_number"],
+        "date_of_birth": fields["date_of_birth"],
+        "expiration_date": fields["expiration_date"],
+        "sex": fields["sex"],
+        "mrz": {"line1": mrz_result["line1"], "line2": mrz_result["line2"]},
+    })
+    if not data.get("full_name"):
+        data["full_name"] = fields["full_name"]
+    if not data.get("nationality"):
+        data["nationality"] = fields["nationality"]
+    return data
+
+
+PASSPORT_DATE_FORMATS = ("%d %b %Y", "%d %B %Y")
+PASSPORT_DATE_RULE = date_rule(PASSPORT_DATE_FORMATS, "DD MMM YYYY")
+MRZ_BACKED_FIELDS = ("passport_number", "date_of_birth", "expiration_date", "sex")
+
+PASSPORT_FIELD_RULES = {
+    "full_name": text_rule(),
+    "date_of_birth": PASSPORT_DATE_RULE,
+    "passport_number": text_rule(r"[A-Z0-9<]{5,9}", "a 5-9 character alphanumeric passport number"),
+    "nationality": text_rule(),
+    "place_of_birth": text_rule(),
+    "issuance_date": PASSPORT_DATE_RULE,
+    "expiration_date": PASSPORT_DATE_RULE,
+    "sex": choice_rule({"M", "F", "X"}),
+    "authority": text_rule(),
+}
+
+PASSPORT_REQUIRED_FIELDS = ("full_name", "date_of_birth", "passport_number", "expiration_date", "sex")
+
+
+def _mrz_check(mrz_result):
+    """Cross-check the MRZ itself and the fields it covers against the decoded MRZ."""
+    def check(fields):
+        if mrz_result is None:
+            return {"mrz": "no machine readable zone could be read"}
+        if not mrz_result["valid"]:
+            failed = [name for name, ok in mrz_result["checks"].items() if not ok]
+            return {"mrz": f"MRZ check digits failed: {', '.join(failed) or 'dates'}"}
+        issues = {}
+        for field in mrz_mismatched_fields(mrz_result["fields"], fields):
+            issues[field] = f"disagrees with the checksummed MRZ value {mrz_result['fields'][field]!r}"
+        return issues
+    return check
+
+
+def score_passport_fields(extracted_content, raw_text, mrz_result=None):
+    cross_checks = (
+        date_order_check("date_of_birth", "issuance_date", PASSPORT_DATE_FORMATS),
+        date_order_check("issuance_date", "expiration_date", PASSPORT_DATE_FORMATS),
+        _mrz_check(mrz_result),
+    )
+    scores = score_fields(PassportData, extracted_content, raw_text, PASSPORT_FIELD_RULES,
+                          cross_checks, PASSPORT_REQUIRED_FIELDS)
+    # Checksummed MRZ values outrank fuzzy agreement with the transcription
+    if mrz_result and mrz_result["valid"]:
+        for field in MRZ_BACKED_FIELDS:
+            entry = scores.get(field)
+            if entry and not any("MRZ" in issue for issue in entry["issues"]):
+                entry["confidence"] = 1.0
+                entry["issues"] = []
+    return scores
+
+
+PASSPORT_EXTRACTORS = (extract_json_from_llama11b_async, extract_raw_text_from_llama11b_async,
+                       extract_combined_from_llama11b_async)
+
+
+def _mrz_error(mrz_result):
+    if mrz_result is None:
+        return "no machine readable zone could be read"
+    if not mrz_result["valid"]:
+        failed = [name for name, ok in mrz_result["checks"].items() if not ok]
+        return f"check digits failed: {', '.join(failed) or 'dates'}"
+    return None
+
+
+async def process_passport_async(image, on_event=None, extraction_mode=None, extraction=None):
+    # image: file path, PIL image, encoded image bytes or a data URL.
+    # on_event, if given, receives step start/finish events and streamed partial results.
+    # extraction_mode: "separate" or "combined" (defaults to EXTRACTION_MODE).
+    # extraction: a combined-extraction response already made for this image
+    # (see extract_passport_batch); steps 2 and 3 then make no model call.
+    # Models come from the passport cascade policy: each stage starts on its
+    # cheapest model and only moves to the next when an escalation trigger fires.
+    policy = get_cascade_policy("passport")
+    cascade = CascadeRun(policy)
+    with StepLog(on_event, document_type="passport") as steps:
+        buffer = steps.buffer
+
+        try:
+            # Step 1: Encode the image
+            encode_step = steps.start("Step 1: Encoding the image...", stage="encode")
+            image_data = await asyncio.to_thread(encode_document_image, image)
+            steps.finish(encode_step, {"status": "Image encoded successfully"})
+
+            for tier, model in enumerate(policy.extract_models):
+                cascade.use("extract", model)
+                last = tier == len(policy.extract_models) - 1
+                try:
+                    output = await extract_stage(steps, image_data, extraction_mode, model, PASSPORT_EXTRACTORS,
+                                                 extraction if tier == 0 else None)
+                except json.JSONDecodeError as e:
+                    reasons = policy.escalation_reasons(f"answer is not valid JSON ({e})")
+                    if last or not reasons:
+                        raise
+                    cascade.escalate(steps, reasons, policy.extract_models[tier + 1])
+                    continue
+
+                # Step 4: Decode the MRZ locally and verify its check digits
+                extracted_content = output.fields
+                mrz_lines = find_td3_lines(extracted_content, output.transcription)
+                mrz_result = parse_td3_mrz(*mrz_lines) if mrz_lines else None
+                steps.add("Step 4: Checking MRZ check digits locally...",
+                          mrz_result or {"status": "No TD3 MRZ found"}, stage="mrz")
+
+                # A clean MRZ that agrees with the extraction pins down every checksummed value
+                mrz_clean = bool(mrz_result and mrz_result["valid"]
+                                 and mrz_matches_extraction(mrz_result["fields"], extracted_content))
+                if mrz_clean:
+                    break
+                scores = score_passport_fields(extracted_content, output.transcription, mrz_result)
+                reasons = policy.escalation_reasons(schema_problem(PassportData, extracted_content), scores,
+                                                    _mrz_error(mrz_result))
+                if last or not reasons:
+                    break
+                cascade.escalate(steps, reasons, policy.extract_models[tier + 1])
+
+            # Step 5: Validate and correct fields. A clean MRZ that agrees with the
+            # extracted fields already pins down every checksummed value, so a
+            # validation model is only called when something disagrees or fails.
+            if mrz_clean:
+                validated_data = passport_data_from_mrz(mrz_result, extracted_content)
+                steps.add(f"Step 5: MRZ checksums pass and match the extraction; skipping "
+                          f"{model_label(policy.validate_models[0])} validation.", validated_data, stage="validate")
+            else:
+                # Otherwise score each field locally and only ask the validation
+                # models about the ones in doubt.
+                validated_data = extracted_content
+                doubtful_fields = fields_below_threshold(scores)
+                if not doubtful_fields:
+                    steps.add(f"Step 5: All fields passed local validation; skipping "
+                              f"{model_label(policy.validate_models[0])} validation.",
+                              {"field_confidence": scores, "validated": validated_data}, stage="validate")
+                for tier, model in enumerate(policy.validate_models if doubtful_fields else ()):
+                    cascade.use("validate", model)
+                    last = tier == len(policy.validate_models) - 1
+                    validate_step = steps.start(
+                        f"Step 5: Validating {len(doubtful_fields)} uncertain field(s) using {model_label(model)} model...",
+                        {"field_confidence": scores, "fields_in_doubt": doubtful_fields}, stage="validate")
+                    try:
+                        with steps.activate(validate_step):
+                            corrected = await validate_fields_with_llama405b_async(
+                                validated_data, output.transcription, focus_instructions(scores, doubtful_fields),
+                                on_partial=lambda fields: steps.partial(
+                                    merge_fields(validated_data, fields, doubtful_fields, only_present=True)),
+                                model=model)
+                    except json.JSONDecodeError as e:
+                        reasons = policy.escalation_reasons(f"answer is not valid JSON ({e})")
+                        if last or not reasons:
+                            raise
+                        validate_step["raw_output"]["error"] = str(e)
+                        steps.finish(validate_step)
+                    else:
+                        validated_data = merge_fields(validated_data, corrected, doubtful_fields)
+                        validate_step["raw_output"]["validated"] = corrected
+                        steps.finish(validate_step)
+                        if last:
+                            break
+                        scores = score_passport_fields(validated_data, output.transcription, mrz_result)
+                        doubtful_fields = fields_below_threshold(scores)
+                        reasons = policy.escalation_reasons(schema_problem(PassportData, validated_data), scores)
+                        if not reasons or not doubtful_fields:
+                            break
+                    cascade.escalate(steps, reasons, policy.validate_models[tier + 1])
+
+            cascade.finish(steps, output.provenance)
+
+            # Create PassportData object
+            passport_data = PassportData(**validated_data)
+
+            return passport_data.dict(), buffer
+
+        except Exception as e:
+            print(f"Error in processing passport: {str(e)}")
+            steps.add("Error in processing", {"error": str(e)}, stage="error")
+            steps.status = "error"
+            return None, buffer
+
+
+def process_passport(image, on_event=None, extraction_mode=None, extraction=None):
+    return run_sync(process_passport_async(image, on_event, extraction_mode, extraction))
 
 # # Example usage
 # if __name__ == "__main__":
@@ -0,0 +1,311 @@
+# pipeline.py
+import asyncio
+import contextvars
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pydantic import BaseModel, Field
+from typing import List, Optional
+from cascade import model_label
+from metrics import Span, activate, current_span, document_record, export_document
+from config import get_setting
+
+# Shared pool for pipeline stages that can run side by side. Stages are leaf
+# calls (they never submit work back into this pool), so it cannot deadlock.
+STAGE_WORKERS = int(get_setting("PIPELINE_STAGE_WORKERS", "32"))
+
+_stage_executor = ThreadPoolExecutor(max_workers=STAGE_WORKERS, thread_name_prefix="pipeline-stage")
+
+# "separate" sends the image to the 11B model twice (fields, then raw text);
+# "combined" asks for both in one structured response.
+EXTRACTION_MODES = ("separate", "combined")
+EXTRACTION_MODE = get_setting("EXTRACTION_MODE", "separate")
+
+
+def run_parallel(*stages):
+    """Run independent stages concurrently and return their results in order.
+
+    Each stage is a zero-argument callable. The first stage runs on the calling
+    thread, the rest on the shared stage pool, each in a copy of the caller's
+    context so trace spans carry over. If any stage raises, the first
+    exception (in stage order) is re-raised once every stage has finished.
+    """
+    if not stages:
+        return []
+
+    futures = [_stage_executor.submit(contextvars.copy_context().run, stage) for stage in stages[1:]]
+
+    results = []
+    first_error = None
+    try:
+        results.append(stages[0]())
+    except Exception as e:
+        first_error = e
+        results.append(None)
+
+    for future in futures:
+        try:
+            results.append(future.result())
+        except Exception as e:
+            if first_error is None:
+                first_error = e
+            results.append(None)
+
+    if first_error is not None:
+        raise first_error
+    return results
+
+
+async def gather_stages(*stages):
+    """run_parallel for coroutines: await them concurrently and return their results
+    in order. If any raises, the first exception (in stage order) is re-raised once
+    every stage has finished."""
+    results = await asyncio.gather(*stages, return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return list(results)
+
+
+def resolve_extraction_mode(mode=None):
+    mode = mode or EXTRACTION_MODE
+    if mode not in EXTRACTION_MODES:
+        raise ValueError(f"Unknown extraction mode: {mode}")
+    return mode
+
+
+def response_content(response_json):
+    return response_json['choices'][0]['message']['content']
+
+
+def parse_json_object(text):
+    """json.loads for answers that must be an object; anything else fails like undecodable text."""
+    value = json.loads(text)
+    if not isinstance(value, dict):
+        raise json.JSONDecodeError(f"Expected a JSON object, got {type(value).__name__}", text, 0)
+    return value
+
+
+def normalize_transcription(text):
+    """One line per printed line with inner whitespace collapsed and blank lines dropped."""
+    lines = (" ".join(line.split()) for line in (text or "").splitlines())
+    return "\n".join(line for line in lines if line)
+
+
+def split_combined_extraction(response_json):
+    """Split a combined {"fields", "transcription"} response into the two responses
+    the separate mode produces, so downstream steps cannot tell the modes apart.
+
+    Token usage stays on the fields response only, so it is not counted twice.
+    """
+    content = parse_json_object(response_content(response_json))
+    transcription = content.get("transcription") or ""
+    # Some answers flatten the fields next to the transcription instead of nesting them
+    fields = content.get("fields")
+    if not isinstance(fields, dict):
+        fields = {key: value for key, value in content.items() if key != "transcription"}
+
+    def response_with(text, usage):
+        return {
+            "id": response_json.get("id"),
+            "object": "chat.completion",
+            "model": response_json.get("model"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": text},
+                         "finish_reason": response_json['choices'][0].get("finish_reason")}],
+            "usage": usage,
+        }
+
+    return response_with(json.dumps(fields), response_json.get("usage")), response_with(transcription, None)
+
+
+class Provenance(BaseModel):
+    mode: str = Field(..., description="Extraction mode: separate, combined or batched")
+    model: Optional[str] = Field(None, description="Model that produced the output")
+    response_ids: List[str] = Field(default_factory=list, description="Ids of the responses it was read from")
+    batch_size: int = Field(1, description="Documents sharing the extraction call")
+
+
+class StageOutput(BaseModel):
+    """What extraction hands to scoring and validation: the parsed fields, the
+    normalized transcription and where they came from. The chat-completion
+    responses themselves (ids, usage, finish reasons) stop here."""
+    fields: dict = Field(..., description="Extracted fields, parsed")
+    transcription: str = Field(..., description="Normalized verbatim transcription")
+    provenance: Provenance
+
+    @classmethod
+    def from_responses(cls, fields_response, transcription_response, mode, model=None, batch_size=1):
+        response_ids = []
+        for response in (fields_response, transcription_response):
+            if response.get("id") and response["id"] not in response_ids:
+                response_ids.append(response["id"])
+        return cls(fields=parse_json_object(response_content(fields_response)),
+                   transcription=normalize_transcription(response_content(transcription_response)),
+                   provenance=Provenance(mode=mode, model=model or fields_response.get("model"),
+                                         response_ids=response_ids, batch_size=batch_size))
+
+    @classmethod
+    def from_combined(cls, response_json, mode="combined", model=None):
+        return cls.from_responses(*split_combined_extraction(response_json), mode, model,
+                                  response_json.get("batch_size", 1))
+
+    def fields_json(self):
+        return compact_json(self.fields)
+
+
+def compact_json(value):
+    # Pasted into prompts, where indentation is paid for in tokens
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+
+async def extract_stage(steps, image_data, extraction_mode, model, extractors, extraction=None):
+    """Steps 2 and 3 with one extraction model, returned as a StageOutput.
+
+    extractors holds the document type's (fields, raw_text, combined) async call
+    functions, each taking (image_base64, model). extraction, if given, is a
+    combined response already made by a batched call.
+    """
+    extract_fields, extract_raw_text, extract_combined = extractors
+    label = model_label(model)
+    if extraction is not None:
+        output = StageOutput.from_combined(extraction, "batched", model)
+        steps.add(f"Step 2: Structured information taken from a batched {label} call "
+                  f"({output.provenance.batch_size} documents)", output.fields, stage="extract_batched")
+        steps.add("Step 3: Raw text taken from the batched extraction", {"raw_text": output.transcription},
+                  stage="extract_raw_text")
+        return output
+
+    if resolve_extraction_mode(extraction_mode) == "combined":
+        # Steps 2 and 3 come from a single call
+        combined_step = steps.start(
+            f"Step 2: Extracting structured information and raw text using one {label} call...",
+            stage="extract_combined")
+        with steps.activate(combined_step):
+            response_json = await extract_combined(image_data, model)
+        output = StageOutput.from_combined(response_json, "combined", model)
+        steps.finish(combined_step, output.fields)
+        steps.add("Step 3: Raw text taken from the combined extraction", {"raw_text": output.transcription},
+                  stage="extract_raw_text")
+        return output
+
+    # Steps 2 and 3 only depend on the encoded image, so they run concurrently
+    # and only the validation step waits for both.
+    json_step = steps.start(f"Step 2: Extracting structured information using {label} model...",
+                            stage="extract_fields")
+    raw_text_step = steps.start(f"Step 3: Extracting raw text from the image using {label} model...",
+                                stage="extract_raw_text")
+
+    async def run_step(step, extract, summarize):
+        with steps.activate(step):
+            response_json = await extract(image_data, model)
+        steps.finish(step, summarize(response_content(response_json)))
+        return response_json
+
+    fields_response, raw_text_response = await gather_stages(
+        run_step(json_step, extract_fields, parse_json_object),
+        run_step(raw_text_step, extract_raw_text, lambda text: {"raw_text": normalize_transcription(text)}),
+    )
+    return StageOutput.from_responses(fields_response, raw_text_response, "separate", model)
+
+
+class StepLog:
+    """Ordered record of pipeline steps that reports each one as it starts and finishes.
+
+    `buffer` keeps the familiar list of {"description", "raw_output"} dicts, now
+    with "elapsed_seconds" and per-step "metrics". on_event, if given, is called
+    with plain dicts and may be called from stage worker threads, so it must be
+    thread-safe.
+
+    Used as a context manager, the log is also the document's trace: each step
+    is a span under it, LLM calls made inside steps.run() / run_async() / activate()
+    are totalled on their step, and the finished document is handed to the
+    metrics exporters on exit.
+    """
+
+    def __init__(self, on_event=None, document_type=None):
+        self.buffer = []
+        self.on_event = on_event
+        self.span = Span("document", parent=current_span(), document_type=document_type)
+        self._started = {}
+        self._stages = []
+        self._lock = threading.Lock()
+        self._activation = None
+        # Set to "error" by pipelines that catch their own failures
+        self.status = "ok"
+
+    def __enter__(self):
+        self._activation = activate(self.span)
+        self._activation.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._activation.__exit__(exc_type, exc, tb)
+        self.close("error" if exc_type else self.status)
+        return False
+
+    def close(self, status="ok"):
+        self.span.end()
+        with self._lock:
+            stages = list(self._stages)
+        export_document(document_record(self.span, stages, status))
+
+    def _emit(self, event):
+        if self.on_event is not None:
+            try:
+                self.on_event(event)
+            except Exception as e:
+                print(f"Step event handler failed: {e}")
+
+    def start(self, description, raw_output=None, stage=None):
+        step = {"description": description, "raw_output": {} if raw_output is None else raw_output}
+        span = Span(stage or description.split(":")[0].lower(), parent=self.span)
+        with self._lock:
+            self.buffer.append(step)
+            index = len(self.buffer) - 1
+            self._started[id(step)] = (index, time.perf_counter(), span)
+        self._emit({"event": "step_started", "index": index, "description": description})
+        return step
+
+    def finish(self, step, raw_output=None):
+        if raw_output is not None:
+            step["raw_output"] = raw_output
+        with self._lock:
+            index, started, span = self._started.pop(id(step))
+        step["elapsed_seconds"] = round(time.perf_counter() - started, 3)
+        step["metrics"] = span.end().to_dict()
+        with self._lock:
+            self._stages.append(step["metrics"])
+        self._emit({"event": "step_finished", "index": index, "description": step["description"],
+                    "elapsed_seconds": step["elapsed_seconds"], "metrics": step["metrics"]})
+        return step
+
+    def activate(self, step):
+        """Context manager attributing LLM calls made inside it to step."""
+        with self._lock:
+            _, started, span = self._started[id(step)]
+        # Time between start() and the work actually beginning, e.g. waiting for a pool worker
+        span.queue_seconds = time.perf_counter() - started
+        return activate(span)
+
+    def run(self, step, func, *args, **kwargs):
+        """Run func for an already started step and finish the step with its result."""
+        with self.activate(step):
+            result = func(*args, **kwargs)
+        self.finish(step, result)
+        return result
+
+    async def run_async(self, step, func, *args, **kwargs):
+        """run() for a coroutine function."""
+        with self.activate(step):
+            result = await func(*args, **kwargs)
+        self.finish(step, result)
+        return result
+
+    def add(self, description, raw_output=None, stage=None):
+        """Record a step that completes immediately."""
+        return self.finish(self.start(description, raw_output, stage))
+
+    def partial(self, fields):
+        """Report fields parsed so far from a streamed model response."""
+        self._emit({"event": "partial_result", "fields": fields})
@@ -0,0 +1,77 @@
+# profile_imports.py
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+CODE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_MODULES = ("config", "app", "orientation", "license_processing", "passport_processing",
+                   "inference_client", "metrics", "PIL.Image", "streamlit_cropper")
+
+
+def _import_rows(statement):
+    """(cumulative_us, depth, name) per import -X importtime reports, or None if the statement failed."""
+    # No API key on purpose: importing must not need one
+    env = {key: value for key, value in os.environ.items() if key != "API_KEY"}
+    completed = subprocess.run([sys.executable, "-X", "importtime", "-c", statement],
+                               cwd=CODE_DIR, env=env, capture_output=True, text=True)
+    if completed.returncode != 0:
+        return None
+    rows = []
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative_us, name = line[len("import time:"):].split("|")
+        name = name.rstrip()
+        rows.append((int(cumulative_us), (len(name) - len(name.lstrip())) // 2, name.strip()))
+    return rows
+
+
+def profile_module(module, repeat=3):
+    """Import module in fresh interpreters and keep the fastest run.
+
+    Returns the cumulative time in milliseconds beyond interpreter startup and
+    that run's slowest imports, or None when the module (or one of its
+    dependencies) is missing.
+    """
+    startup = {name for _, _, name in _import_rows("pass") or []}
+    best = None
+    for _ in range(repeat):
+        rows = _import_rows(f"import {module}")
+        if rows is None:
+            return None
+        rows = [row for row in rows if row[2] not in startup]
+        total_ms = sum(cumulative for cumulative, depth, _ in rows if depth == 0) / 1000
+        if best is None or total_ms < best["total_ms"]:
+            best = {"total_ms": total_ms,
+                    "top": [(name, cumulative / 1000) for cumulative, _, name in sorted(rows, reverse=True)[:10]]}
+    return best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure the cold import time of the app and pipeline modules.")
+    parser.add_argument("modules", nargs="*", default=list(DEFAULT_MODULES))
+    parser.add_argument("--repeat", type=int, default=3, help="Fresh interpreters per module; the fastest is kept")
+    parser.add_argument("--top", action="store_true", help="Also list the slowest imports of each module")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args(argv)
+
+    results = {module: profile_module(module, args.repeat) for module in args.modules}
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return 0
+
+    for module, result in results.items():
+        if result is None:
+            print(f"{module:<22} skipped (not importable here)")
+            continue
+        print(f"{module:<22} {result['total_ms']:>8.1f} ms")
+        if args.top:
+            for name, cumulative_ms in result["top"]:
+                print(f"    {name:<40} {cumulative_ms:>8.1f} ms")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,136 @@
+# prompts.py
+import hashlib
+import json
+import math
+import textwrap
+from functools import lru_cache
+from string import Template
+from config import get_setting
+
+# Rough Llama tokenizer ratio for English prompts and JSON; errs on the high side
+CHARS_PER_TOKEN = float(get_setting("PROMPT_CHARS_PER_TOKEN", "3.5"))
+# Prompt tokens counted per attached image (one vision tile)
+IMAGE_PROMPT_TOKENS = int(get_setting("IMAGE_PROMPT_TOKENS", "1601"))
+
+# Output budgets. JSON answers are sized from their schema; free-text
+# transcriptions get a fixed budget, which a full passport page fits in.
+MAX_OUTPUT_TOKENS = int(get_setting("MAX_OUTPUT_TOKENS", "16384"))
+TRANSCRIPTION_OUTPUT_TOKENS = int(get_setting("TRANSCRIPTION_OUTPUT_TOKENS", "2048"))
+OUTPUT_TOKEN_SAFETY_FACTOR = float(get_setting("OUTPUT_TOKEN_SAFETY_FACTOR", "2.0"))
+MIN_OUTPUT_TOKENS = 64
+
+# Assumed length of a single schema value, and of a free-form object such as the MRZ
+VALUE_TOKENS = 24
+OBJECT_VALUE_TOKENS = 96
+
+TEMPLATES = {}
+
+
+def estimate_tokens(text):
+    return math.ceil(len(text) / CHARS_PER_TOKEN) if text else 0
+
+
+def estimate_payload_tokens(payload):
+    """Approximate prompt tokens for a chat-completion payload, images included."""
+    total = 0
+    for message in payload.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, str):
+            total += estimate_tokens(content)
+            continue
+        for part in content or []:
+            if part.get("type") == "text":
+                total += estimate_tokens(part["text"])
+            elif part.get("type") == "image_url":
+                total += IMAGE_PROMPT_TOKENS
+    return total
+
+
+@lru_cache(maxsize=None)
+def schema_json(model_cls, indent=None):
+    # Serializing a pydantic schema is surprisingly slow, and the same few are
+    # needed on every request, both in prompt text and in response_format.
+    return model_cls.schema_json(indent=indent)
+
+
+def _resolve(schema, node):
+    ref = node.get("$ref")
+    if ref:
+        for part in ref.lstrip("#/").split("/"):
+            schema = schema[part]
+        return schema
+    return node
+
+
+def _value_tokens(schema, node):
+    node = _resolve(schema, node)
+    options = node.get("anyOf") or node.get("oneOf")
+    if options:
+        return max(_value_tokens(schema, option) for option in options)
+    if node.get("type") == "object" or "properties" in node:
+        properties = node.get("properties")
+        if not properties:
+            return OBJECT_VALUE_TOKENS
+        return 2 + sum(estimate_tokens(json.dumps(name)) + 2 + _value_tokens(schema, child)
+                       for name, child in properties.items())
+    if node.get("type") == "array":
+        return 4 * _value_tokens(schema, node.get("items", {}))
+    if node.get("type") == "null":
+        return 1
+    return VALUE_TOKENS
+
+
+@lru_cache(maxsize=None)
+def schema_output_tokens(model_cls):
+    """Output tokens needed to answer with one instance of the schema."""
+    schema = json.loads(schema_json(model_cls))
+    return _value_tokens(schema, schema)
+
+
+def output_budget(model_cls=None, extra_tokens=0):
+    """max_tokens for an answer of the given schema, with headroom, plus a free-text budget."""
+    needed = schema_output_tokens(model_cls) if model_cls else 0
+    budget = max(MIN_OUTPUT_TOKENS, math.ceil(needed * OUTPUT_TOKEN_SAFETY_FACTOR) + extra_tokens)
+    return min(MAX_OUTPUT_TOKENS, -(-budget // 64) * 64)
+
+
+class PromptTemplate:
+    """A prompt compiled once at import time.
+
+    text is a string.Template: $schema is replaced with the response model's
+    schema at compile time, and any other $placeholders are filled per call by
+    render(). max_tokens is output_tokens if given, otherwise sized from the
+    response model plus extra_output_tokens. The version hashes everything that
+    shapes the request, so it can be used directly as the response cache version.
+    """
+
+    def __init__(self, name, text, response_model=None, response_type=None, output_tokens=None,
+                 extra_output_tokens=0):
+        self.name = name
+        self.response_model = response_model
+        compiled = textwrap.dedent(text).strip()
+        if response_model is not None:
+            # "$defs"/"$ref" in the schema must survive the per-call substitution
+            schema_text = schema_json(response_model, indent=2).replace("$", "$$")
+            compiled = Template(compiled).safe_substitute(schema=schema_text)
+        self.template = Template(compiled)
+        self.static_tokens = estimate_tokens(compiled)
+        self.max_tokens = output_tokens or output_budget(response_model, extra_output_tokens)
+
+        self.response_format = {"type": response_type or ("json_object" if response_model else "text")}
+        if response_model is not None:
+            self.response_format["schema"] = schema_json(response_model)
+
+        digest = hashlib.sha256(json.dumps(
+            [compiled, self.response_format, self.max_tokens], sort_keys=True).encode("utf-8")).hexdigest()
+        self.version = f"{name}.{digest[:12]}"
+        TEMPLATES[name] = self
+
+    def render(self, **values):
+        return self.template.substitute(**values)
+
+
+def template_stats():
+    """Static prompt size and output budget of every compiled template."""
+    return {name: {"version": prompt.version, "prompt_tokens": prompt.static_tokens, "max_tokens": prompt.max_tokens}
+            for name, prompt in sorted(TEMPLATES.items())}
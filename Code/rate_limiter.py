@@ -0,0 +1,233 @@
+# rate_limiter.py
+import asyncio
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from config import get_client, get_setting
+from metrics import REGISTRY, SECONDS_BUCKETS
+
+# Budgets per model; 0 turns a budget off
+DEFAULT_RPM = float(get_setting("RATE_LIMIT_RPM", "600"))
+DEFAULT_TPM = float(get_setting("RATE_LIMIT_TPM", "0"))
+# Per-model overrides, comma-separated MODEL=RPM/TPM; MODEL matches any model name containing it,
+# e.g. "11b=600/2000000,405b=120/400000"
+MODEL_RATE_LIMITS = get_setting("RATE_LIMITS", "")
+# A bucket holds this many seconds of budget, which bounds bursts
+BURST_SECONDS = float(get_setting("RATE_LIMIT_BURST_SECONDS", "10"))
+
+# AIMD concurrency: +1/limit per successful call at full concurrency, x DECREASE_FACTOR
+# on a 429 or on a call slower than LATENCY_TOLERANCE x its usual latency
+INITIAL_CONCURRENCY = float(get_setting("RATE_LIMIT_INITIAL_CONCURRENCY", "4"))
+MAX_CONCURRENCY = float(get_setting("RATE_LIMIT_MAX_CONCURRENCY", "64"))
+DECREASE_FACTOR = float(get_setting("RATE_LIMIT_DECREASE_FACTOR", "0.5"))
+LATENCY_TOLERANCE = float(get_setting("RATE_LIMIT_LATENCY_TOLERANCE", "3"))
+LATENCY_SAMPLES = 5
+LATENCY_SMOOTHING = 0.1
+# Async callers cannot wait on the condition, so they look for a free slot this often
+ASYNC_POLL_SECONDS = 0.05
+
+RATE_LIMIT_WAIT = REGISTRY.histogram("kyc_rate_limit_wait_seconds", "Time a call waited for the rate limiter",
+                                     SECONDS_BUCKETS, ("model",))
+THROTTLED = REGISTRY.counter("kyc_llm_throttled_total", "Calls answered with 429", ("model",))
+
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header (delta-seconds or HTTP date), or None."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_model_limits(spec):
+    limits = []
+    for item in spec.split(","):
+        if "=" not in item:
+            continue
+        name, budgets = item.split("=", 1)
+        rpm, _, tpm = budgets.partition("/")
+        limits.append((name.strip(), float(rpm or DEFAULT_RPM), float(tpm or DEFAULT_TPM)))
+    return limits
+
+
+class TokenBucket:
+    """Refills at per_minute / 60 per second. Reservations may overdraw it, and the
+    caller sleeps until the debt is paid, so waiting callers are served in order."""
+
+    def __init__(self, per_minute, burst_seconds=BURST_SECONDS):
+        self.rate = per_minute / 60
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount, now):
+        """Take amount and return the seconds to wait before using it."""
+        self._refill(now)
+        self.level -= min(amount, self.capacity)
+        return max(0.0, -self.level / self.rate)
+
+    def adjust(self, amount, now):
+        """Charge (or refund, if negative) the difference between estimated and actual use."""
+        self._refill(now)
+        self.level = min(self.capacity, self.level - amount)
+
+
+class Permit:
+    def __init__(self, tokens, shape):
+        self.tokens = tokens
+        self.shape = shape
+        self.started = time.monotonic()
+
+
+class ModelLimiter:
+    """Request and token budgets plus an AIMD concurrency limit for one model."""
+
+    def __init__(self, model, rpm=DEFAULT_RPM, tpm=DEFAULT_TPM):
+        self.model = model
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.limit = INITIAL_CONCURRENCY
+        self.in_flight = 0
+        self.blocked_until = 0.0
+        self._last_decrease = 0.0
+        # Smoothed latency per call shape (the same prompt template always asks for the same max_tokens)
+        self._latency = {}
+        self._cond = threading.Condition()
+        self.counters = {"calls": 0, "throttled": 0, "slow": 0, "decreases": 0, "waited_seconds": 0.0}
+
+    def acquire(self, tokens=0, shape=None):
+        """Block until a call may start; returns the permit to hand back to release()."""
+        started = time.monotonic()
+        with self._cond:
+            while True:
+                wait = self._admission_wait(time.monotonic())
+                if wait == 0:
+                    break
+                self._cond.wait(wait)
+            delay = self._admit(tokens, time.monotonic())
+        if delay:
+            time.sleep(delay)
+        return self._admitted(started, tokens, shape)
+
+    async def acquire_async(self, tokens=0, shape=None):
+        """acquire() for coroutines, without blocking the event loop. Sync and async
+        callers share the same budgets and concurrency limit."""
+        started = time.monotonic()
+        while True:
+            with self._cond:
+                wait = self._admission_wait(time.monotonic())
+                if wait == 0:
+                    delay = self._admit(tokens, time.monotonic())
+                    break
+            await asyncio.sleep(ASYNC_POLL_SECONDS if wait is None else wait)
+        if delay:
+            await asyncio.sleep(delay)
+        return self._admitted(started, tokens, shape)
+
+    def _admission_wait(self, now):
+        # 0 when a call may start now, seconds while blocked by Retry-After, None until a
+        # call in flight finishes. The caller holds _cond.
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.in_flight >= max(1, int(self.limit)):
+            return None
+        return 0
+
+    def _admit(self, tokens, now):
+        # Take a slot and reserve budget; returns the seconds to wait for the buckets
+        self.in_flight += 1
+        delay = 0.0
+        if self.requests is not None:
+            delay = self.requests.reserve(1, now)
+        if self.tokens is not None and tokens:
+            delay = max(delay, self.tokens.reserve(tokens, now))
+        return delay
+
+    def _admitted(self, started, tokens, shape):
+        waited = time.monotonic() - started
+        with self._cond:
+            self.counters["calls"] += 1
+            self.counters["waited_seconds"] += waited
+        RATE_LIMIT_WAIT.observe(waited, model=self.model)
+        return Permit(tokens, shape)
+
+    def release(self, permit, used_tokens=None, throttled=False, retry_after=None, failed=False):
+        """Finish a call: reconcile its token use and feed the outcome to the concurrency limit."""
+        now = time.monotonic()
+        latency = now - permit.started
+        with self._cond:
+            self.in_flight -= 1
+            if self.tokens is not None and used_tokens is not None:
+                self.tokens.adjust(used_tokens - permit.tokens, now)
+            if throttled:
+                self.counters["throttled"] += 1
+                THROTTLED.inc(model=self.model)
+                if retry_after:
+                    self.blocked_until = max(self.blocked_until, now + retry_after)
+                self._decrease(permit)
+            elif not failed:
+                usual = self._latency.get(permit.shape)
+                if usual is not None and usual[1] >= LATENCY_SAMPLES and latency > LATENCY_TOLERANCE * usual[0]:
+                    self.counters["slow"] += 1
+                    self._decrease(permit)
+                elif self.in_flight + 1 >= int(self.limit):
+                    # Only grow while the current limit is actually being used
+                    self.limit = min(MAX_CONCURRENCY, self.limit + 1 / self.limit)
+                if usual is None:
+                    self._latency[permit.shape] = (latency, 1)
+                else:
+                    self._latency[permit.shape] = (usual[0] + LATENCY_SMOOTHING * (latency - usual[0]), usual[1] + 1)
+            self._cond.notify_all()
+
+    def _decrease(self, permit):
+        # One cut per round trip: calls that started before the last cut saw the old limit
+        if permit.started < self._last_decrease:
+            return
+        self.limit = max(1.0, self.limit * DECREASE_FACTOR)
+        self._last_decrease = time.monotonic()
+        self.counters["decreases"] += 1
+        print(f"Rate limiter: {self.model} concurrency limit lowered to {self.limit:.1f}")
+
+    def stats(self):
+        with self._cond:
+            return {"limit": round(self.limit, 2), "in_flight": self.in_flight, **self.counters}
+
+
+class RateLimiter:
+    """One ModelLimiter per model, shared by every chat completion in the process."""
+
+    def __init__(self, model_limits=MODEL_RATE_LIMITS):
+        self.model_limits = parse_model_limits(model_limits)
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def for_model(self, model):
+        limiter = self._models.get(model)
+        if limiter is None:
+            with self._lock:
+                limiter = self._models.get(model)
+                if limiter is None:
+                    rpm, tpm = DEFAULT_RPM, DEFAULT_TPM
+                    for name, model_rpm, model_tpm in self.model_limits:
+                        if name in (model or ""):
+                            rpm, tpm = model_rpm, model_tpm
+                            break
+                    limiter = self._models[model] = ModelLimiter(model, rpm, tpm)
+        return limiter
+
+    def stats(self):
+        return {model: limiter.stats() for model, limiter in self._models.items()}
+
+
+def get_rate_limiter():
+    return get_client("rate_limiter", RateLimiter)
@@ -0,0 +1,207 @@
+# response_cache.py
+import copy
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from config import get_client, get_setting
+
+# Cache settings
+CACHE_ENABLED = get_setting("RESPONSE_CACHE_ENABLED", "1") not in ("0", "false", "False")
+# Cached answers hold the extracted personal data, so they are only written to
+# disk (under RESPONSE_CACHE_DIR, relative to the working directory) on request
+DISK_ENABLED = get_setting("RESPONSE_CACHE_DISK", "0") not in ("0", "false", "False")
+CACHE_DIR = get_setting("RESPONSE_CACHE_DIR", ".response_cache")
+MEMORY_ENTRIES = int(get_setting("RESPONSE_CACHE_MEMORY_ENTRIES", "256"))
+MAX_DISK_BYTES = int(get_setting("RESPONSE_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+TTL_SECONDS = float(get_setting("RESPONSE_CACHE_TTL", str(7 * 24 * 3600)))
+
+
+def _sha256(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def make_cache_key(payload, prompt_version):
+    """Content-addressed key for a chat-completion payload.
+
+    Images are reduced to the hash of their encoded bytes, and the remaining
+    message text (prompt plus any upstream outputs pasted into it) is hashed
+    separately, so the key never holds the large base64 string.
+    """
+    image_hashes = []
+    text_parts = []
+    for message in payload.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, str):
+            text_parts.append(content)
+            continue
+        for part in content or []:
+            if part.get("type") == "image_url":
+                # The data URL is a pure function of the encoded bytes; hashing it
+                # whole avoids slicing out (and copying) the base64 payload.
+                image_hashes.append(_sha256(part["image_url"]["url"]))
+            elif part.get("type") == "text":
+                text_parts.append(part["text"])
+
+    key_material = json.dumps({
+        "images": image_hashes,
+        "model": payload.get("model"),
+        "prompt_version": prompt_version,
+        "response_format": payload.get("response_format"),
+        "temperature": payload.get("temperature"),
+        "text": _sha256("\x1e".join(text_parts)),
+    }, sort_keys=True)
+    return _sha256(key_material)
+
+
+class ResponseCache:
+    """Two-tier cache: an in-memory LRU in front of a size- and TTL-bounded directory.
+
+    With directory None only the in-memory tier is used.
+    """
+
+    def __init__(self, directory=CACHE_DIR if DISK_ENABLED else None, memory_entries=MEMORY_ENTRIES,
+                 max_disk_bytes=MAX_DISK_BYTES, ttl_seconds=TTL_SECONDS):
+        self.directory = directory
+        self.memory_entries = memory_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.ttl_seconds = ttl_seconds
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_bytes = None
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def _remember(self, key, created, value):
+        with self._lock:
+            self._memory[key] = (created, value)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_entries:
+                self._memory.popitem(last=False)
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and now - entry[0] <= self.ttl_seconds:
+                self._memory.move_to_end(key)
+                self.counters["memory_hits"] += 1
+                return copy.deepcopy(entry[1])
+            if entry is not None:
+                del self._memory[key]
+
+        if self.directory is None:
+            self._count("misses")
+            return None
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            self._count("misses")
+            return None
+
+        if now - entry["created"] > self.ttl_seconds:
+            self._remove(path)
+            self._count("misses")
+            return None
+
+        # Touch the file so disk eviction approximates LRU
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self._remember(key, entry["created"], entry["value"])
+        self._count("disk_hits")
+        return copy.deepcopy(entry["value"])
+
+    def put(self, key, value):
+        created = time.time()
+        self._remember(key, created, copy.deepcopy(value))
+        if self.directory is None:
+            self._count("stores")
+            return
+
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = json.dumps({"created": created, "value": value}).encode("utf-8")
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Response cache write failed: {e}")
+            self._remove(tmp_path)
+            return
+
+        self._count("stores")
+        with self._lock:
+            if self._disk_bytes is not None:
+                self._disk_bytes += len(data)
+            over_budget = self._disk_bytes is None or self._disk_bytes > self.max_disk_bytes
+        if over_budget:
+            self.evict()
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def evict(self):
+        """Drop expired files, then least recently used ones until under 90% of the size budget."""
+        if self.directory is None:
+            return
+        now = time.time()
+        entries = []
+        total = 0
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if now - stat.st_mtime > self.ttl_seconds and name.endswith(".json"):
+                    self._remove(path)
+                    self._count("evictions")
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+
+        if total > self.max_disk_bytes:
+            target = int(self.max_disk_bytes * 0.9)
+            for _, size, path in sorted(entries):
+                if total <= target:
+                    break
+                self._remove(path)
+                self._count("evictions")
+                total -= size
+
+        with self._lock:
+            self._disk_bytes = total
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats["memory_entries"] = len(self._memory)
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+        return stats
+
+
+def get_response_cache():
+    """Return the process-wide response cache, or None when caching is disabled."""
+    if not CACHE_ENABLED:
+        return None
+    return get_client("response_cache", ResponseCache)
@@ -0,0 +1,209 @@
+# result_store.py
+import datetime
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from config import get_client, get_setting
+
+# The store holds personal data, so it is off until RESULT_STORE_PATH names its file
+STORE_PATH = get_setting("RESULT_STORE_PATH", "")
+STORE_ENABLED = bool(STORE_PATH) and get_setting("RESULT_STORE_ENABLED", "1") not in ("0", "false", "False")
+
+# Dates of birth are stored as YYYY-MM-DD when they parse, so they compare and
+# range-scan correctly across document types
+DATE_FORMATS = ("%m/%d/%Y", "%d %b %Y", "%d %B %Y", "%Y-%m-%d")
+
+COLUMNS = ("image_hash", "doc_type", "variant", "license_number", "passport_number", "full_name", "date_of_birth",
+           "source", "result", "steps", "cascade", "elapsed_seconds", "created_at")
+JSON_COLUMNS = ("result", "steps", "cascade")
+
+
+def file_hash(path, chunk_size=1024 * 1024):
+    """sha256 of a file's bytes, the image_hash used for documents read from disk."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def normalize_number(value):
+    if not value:
+        return None
+    return "".join(ch for ch in str(value).upper() if ch.isalnum()) or None
+
+
+def normalize_name(value):
+    """Upper-case name words in sorted order, so "DOE, John A" and "John A Doe" match."""
+    if not value:
+        return None
+    words = "".join(ch if ch.isalnum() else " " for ch in str(value).upper()).split()
+    return " ".join(sorted(words)) or None
+
+
+def normalize_date(value):
+    if not value:
+        return None
+    text = str(value).strip()
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(text.title(), fmt).date().isoformat()
+        except ValueError:
+            continue
+    return text
+
+
+class ResultStore:
+    """SQLite-backed store of validated documents with their steps and timing.
+
+    One row per (image_hash, doc_type, variant); storing the same document again
+    replaces its row. variant tells apart results for edits of one image, e.g. a
+    rotation or crop chosen in the app. Lookups by document number, name and
+    date of birth, image hash and processing time are index scans.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._local = threading.local()
+        with self._connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS documents (
+                    id INTEGER PRIMARY KEY,
+                    image_hash TEXT NOT NULL,
+                    doc_type TEXT NOT NULL,
+                    variant TEXT NOT NULL DEFAULT '',
+                    license_number TEXT,
+                    passport_number TEXT,
+                    full_name TEXT,
+                    date_of_birth TEXT,
+                    source TEXT,
+                    result TEXT NOT NULL,
+                    steps TEXT,
+                    cascade TEXT,
+                    elapsed_seconds REAL,
+                    created_at REAL NOT NULL
+                )""")
+            db.execute("CREATE UNIQUE INDEX IF NOT EXISTS documents_image ON documents (image_hash, doc_type, variant)")
+            db.execute("CREATE INDEX IF NOT EXISTS documents_license_number ON documents (license_number) "
+                       "WHERE license_number IS NOT NULL")
+            db.execute("CREATE INDEX IF NOT EXISTS documents_passport_number ON documents (passport_number) "
+                       "WHERE passport_number IS NOT NULL")
+            db.execute("CREATE INDEX IF NOT EXISTS documents_person ON documents (full_name, date_of_birth)")
+            db.execute("CREATE INDEX IF NOT EXISTS documents_date_of_birth ON documents (date_of_birth)")
+            db.execute("CREATE INDEX IF NOT EXISTS documents_created_at ON documents (created_at)")
+
+    def _connect(self):
+        # One connection per thread; sqlite3 connections can't be shared across threads
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = self._local.db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.row_factory = sqlite3.Row
+            db.execute("PRAGMA busy_timeout = 30000")
+            db.execute("PRAGMA synchronous = NORMAL")
+        return db
+
+    @staticmethod
+    def _values(doc_type, image_hash, result, steps=None, cascade=None, elapsed_seconds=None, source=None,
+                variant="", created_at=None):
+        # The indexed columns are normalized copies; the result keeps the values as extracted
+        return (image_hash, doc_type, variant or "", normalize_number(result.get("license_number")),
+                normalize_number(result.get("passport_number")), normalize_name(result.get("full_name")),
+                normalize_date(result.get("date_of_birth")), source, json.dumps(result),
+                json.dumps(steps) if steps is not None else None,
+                json.dumps(cascade) if cascade is not None else None,
+                elapsed_seconds, created_at or time.time())
+
+    def put(self, doc_type, image_hash, result, **kwargs):
+        """Store one validated document; returns its row id. kwargs: steps, cascade,
+        elapsed_seconds, source, variant and created_at."""
+        return self.put_many([dict(kwargs, doc_type=doc_type, image_hash=image_hash, result=result)])[0]
+
+    def put_many(self, documents):
+        """Store many documents (dicts of put()'s arguments) in one transaction; returns their row ids."""
+        rows = [self._values(**document) for document in documents]
+        if not rows:
+            return []
+        updates = ", ".join(f"{column} = excluded.{column}" for column in COLUMNS[3:])
+        db = self._connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.executemany(f"INSERT INTO documents ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))}) "
+                           f"ON CONFLICT (image_hash, doc_type, variant) DO UPDATE SET {updates}", rows)
+            ids = [db.execute("SELECT id FROM documents WHERE image_hash = ? AND doc_type = ? AND variant = ?",
+                              row[:3]).fetchone()[0] for row in rows]
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        return ids
+
+    def _query(self, where, params, order="created_at DESC", limit=None, steps=False):
+        columns = "*" if steps else ", ".join(("id",) + tuple(column for column in COLUMNS if column != "steps"))
+        sql = f"SELECT {columns} FROM documents WHERE {where} ORDER BY {order}"
+        if limit is not None:
+            sql += f" LIMIT {int(limit)}"
+        return [self._row(row) for row in self._connect().execute(sql, params).fetchall()]
+
+    @staticmethod
+    def _row(row):
+        document = dict(row)
+        for column in JSON_COLUMNS:
+            if document.get(column) is not None:
+                document[column] = json.loads(document[column])
+        return document
+
+    def get(self, document_id):
+        documents = self._query("id = ?", (document_id,), steps=True)
+        return documents[0] if documents else None
+
+    def find_image(self, image_hash, doc_type=None, variant=""):
+        """The stored document for an image, or None; doc_type None matches any type."""
+        if doc_type is None:
+            documents = self._query("image_hash = ? AND variant = ?", (image_hash, variant or ""), limit=1,
+                                    steps=True)
+        else:
+            documents = self._query("image_hash = ? AND doc_type = ? AND variant = ?",
+                                    (image_hash, doc_type, variant or ""), steps=True)
+        return documents[0] if documents else None
+
+    def find_license(self, license_number, limit=None):
+        return self._query("license_number = ?", (normalize_number(license_number),), limit=limit)
+
+    def find_passport(self, passport_number, limit=None):
+        return self._query("passport_number = ?", (normalize_number(passport_number),), limit=limit)
+
+    def find_person(self, full_name, date_of_birth=None, limit=None):
+        """Documents of one holder; the name matches whatever its word order or punctuation."""
+        if date_of_birth is None:
+            return self._query("full_name = ?", (normalize_name(full_name),), limit=limit)
+        return self._query("full_name = ? AND date_of_birth = ?",
+                           (normalize_name(full_name), normalize_date(date_of_birth)), limit=limit)
+
+    def born_between(self, start, end, limit=None):
+        """Documents whose holder was born in [start, end], dates in any stored format."""
+        return self._query("date_of_birth BETWEEN ? AND ?", (normalize_date(start), normalize_date(end)),
+                           order="date_of_birth", limit=limit)
+
+    def processed_between(self, start=None, end=None, doc_type=None, limit=None):
+        """Documents stored in [start, end] (epoch seconds; None leaves that side open)."""
+        where, params = ["created_at BETWEEN ? AND ?"], [start or 0, end or float("inf")]
+        if doc_type is not None:
+            where.append("doc_type = ?")
+            params.append(doc_type)
+        return self._query(" AND ".join(where), params, limit=limit)
+
+    def count(self):
+        return self._connect().execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+
+
+def get_result_store():
+    """Return the process-wide result store, or None when it is disabled or no path is set."""
+    if not STORE_ENABLED:
+        return None
+    return get_client("result_store", lambda: ResultStore(STORE_PATH))
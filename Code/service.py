@@ -0,0 +1,436 @@
+# service.py
+import argparse
+import base64
+import hashlib
+import io
+import ipaddress
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+from config import get_setting
+
+SERVICE_DIR = get_setting("SERVICE_DIR", ".service")
+SERVICE_WORKERS = int(get_setting("SERVICE_WORKERS", "4"))
+# Submissions are refused with 429 once this many jobs are waiting
+MAX_QUEUED_JOBS = int(get_setting("SERVICE_MAX_QUEUED_JOBS", "1000"))
+MAX_UPLOAD_BYTES = int(get_setting("SERVICE_MAX_UPLOAD_BYTES", str(20 * 1024 * 1024)))
+TASKS = ("license", "passport", "auto", "orientation")
+# GET /documents has no authentication, so it only answers on a loopback bind
+# unless this is set (e.g. behind an authenticating proxy)
+REMOTE_DOCUMENTS = get_setting("SERVICE_REMOTE_DOCUMENTS", "0") not in ("0", "false", "False")
+
+
+class JobStore:
+    """SQLite-backed job queue. Image bytes live next to the database, one file per
+    job, until the job is done or failed."""
+
+    def __init__(self, directory=SERVICE_DIR):
+        self.directory = directory
+        self.image_dir = os.path.join(directory, "images")
+        os.makedirs(self.image_dir, exist_ok=True)
+        self.path = os.path.join(directory, "jobs.sqlite3")
+        self._local = threading.local()
+        self._wakeup = threading.Condition()
+        with self._connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    idempotency_key TEXT NOT NULL UNIQUE,
+                    task TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    result TEXT,
+                    error TEXT
+                )""")
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (status, created_at)")
+            # Jobs a previous process was running when it stopped go back in the queue
+            db.execute("UPDATE jobs SET status = 'queued', started_at = NULL WHERE status = 'running'")
+            pending = {row["id"] for row in db.execute("SELECT id FROM jobs WHERE status = 'queued'")}
+        # Images left by finished jobs, e.g. when a process stopped between finish() and the removal
+        for name in os.listdir(self.image_dir):
+            if os.path.splitext(name)[0] not in pending:
+                self._remove_image(os.path.splitext(name)[0])
+
+    def _connect(self):
+        # One connection per thread; sqlite3 connections can't be shared across threads
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = self._local.db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.row_factory = sqlite3.Row
+            db.execute("PRAGMA busy_timeout = 30000")
+        return db
+
+    def image_path(self, job_id):
+        return os.path.join(self.image_dir, f"{job_id}.img")
+
+    def _remove_image(self, job_id):
+        try:
+            os.remove(self.image_path(job_id))
+        except FileNotFoundError:
+            pass
+
+    def queued_count(self):
+        return self._connect().execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+
+    def counts(self):
+        rows = self._connect().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return {status: count for status, count in rows}
+
+    def submit(self, task, image_bytes, idempotency_key):
+        """Return (job, created). A key seen before returns its job instead of
+        queueing the document again; a failed job is queued once more."""
+        db = self._connect()
+        existing = self.get_by_key(idempotency_key)
+        if existing is not None:
+            if existing["status"] != "failed":
+                return existing, False
+            # The image was removed when the job failed
+            with open(self.image_path(existing["id"]), "wb") as f:
+                f.write(image_bytes)
+            db.execute("UPDATE jobs SET status = 'queued', error = NULL, started_at = NULL, finished_at = NULL "
+                       "WHERE id = ? AND status = 'failed'", (existing["id"],))
+            self._notify()
+            return self.get(existing["id"]), False
+
+        job_id = uuid.uuid4().hex
+        with open(self.image_path(job_id), "wb") as f:
+            f.write(image_bytes)
+        try:
+            db.execute("INSERT INTO jobs (id, idempotency_key, task, status, created_at) VALUES (?, ?, ?, 'queued', ?)",
+                       (job_id, idempotency_key, task, time.time()))
+        except sqlite3.IntegrityError:
+            # Lost a race with a concurrent submission of the same key
+            self._remove_image(job_id)
+            return self.get_by_key(idempotency_key), False
+        self._notify()
+        return self.get(job_id), True
+
+    def get(self, job_id):
+        row = self._connect().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def get_by_key(self, idempotency_key):
+        row = self._connect().execute("SELECT * FROM jobs WHERE idempotency_key = ?", (idempotency_key,)).fetchone()
+        return dict(row) if row else None
+
+    def claim(self, timeout=1.0):
+        """Take the oldest queued job and mark it running, waiting up to timeout for one."""
+        deadline = time.monotonic() + timeout
+        while True:
+            db = self._connect()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                row = db.execute("SELECT id FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1").fetchone()
+                if row is not None:
+                    db.execute("UPDATE jobs SET status = 'running', started_at = ?, attempts = attempts + 1 "
+                               "WHERE id = ?", (time.time(), row["id"]))
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+            if row is not None:
+                return self.get(row["id"])
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            with self._wakeup:
+                self._wakeup.wait(remaining)
+
+    def finish(self, job_id, result=None, error=None):
+        try:
+            self._connect().execute(
+                "UPDATE jobs SET status = ?, finished_at = ?, result = ?, error = ? WHERE id = ?",
+                ("failed" if error else "done", time.time(), json.dumps(result) if result is not None else None,
+                 error, job_id))
+        finally:
+            # Removed even when the update fails; resubmitting a failed job writes it again
+            self._remove_image(job_id)
+
+    def _notify(self):
+        with self._wakeup:
+            self._wakeup.notify()
+
+
+def run_job(job, image_path):
+    """Process one job; returns (result, error)."""
+    # Imported on first use so FIREWORKS_BASE_URL and friends can be set first
+    from batch_process import process_document
+
+    if job["task"] == "orientation":
+        from PIL import Image
+        from orientation import detect_orientation
+        with Image.open(image_path) as img:
+            angle, source = detect_orientation(img)
+        return {"angle": angle, "source": source}, None
+
+    from batch_process import stored_document, store_entry
+    from result_store import get_result_store
+
+    # A document the result store already holds is answered from it without model calls
+    store = get_result_store()
+    record = stored_document(store, image_path, job["task"]) if store is not None else None
+    if record is None:
+        record = process_document(image_path, job["task"], include_steps=store is not None)
+        if store is not None and record["status"] == "ok":
+            store.put_many([store_entry(record, source=f"job:{job['id']}")])
+    if record["status"] != "ok":
+        return None, record.get("error") or "unknown error"
+    return {"doc_type": record["doc_type"], "result": record["result"], "cascade": record.get("cascade"),
+            "elapsed_seconds": record["elapsed_seconds"], "stored_id": record.get("stored_id")}, None
+
+
+# GET /documents parameters and the result store lookups they map to
+DOCUMENT_QUERIES = (
+    (("license_number",), "find_license"),
+    (("passport_number",), "find_passport"),
+    (("full_name", "date_of_birth"), "find_person"),
+    (("full_name",), "find_person"),
+    (("born_from", "born_to"), "born_between"),
+    (("processed_from", "processed_to"), "processed_between"),
+)
+
+
+def find_documents(store, params):
+    """Run the first lookup whose parameters are all given; returns stored documents without their steps."""
+    limit = int(params.get("limit", 100))
+    if "image_hash" in params:
+        document = store.find_image(params["image_hash"], params.get("doc_type"), params.get("variant", ""))
+        documents = [document] if document else []
+    else:
+        for names, method in DOCUMENT_QUERIES:
+            if all(name in params for name in names):
+                values = [float(params[name]) if name.startswith("processed_") else params[name] for name in names]
+                documents = getattr(store, method)(*values, limit=limit)
+                break
+        else:
+            raise ValueError("expected license_number, passport_number, full_name [+ date_of_birth], "
+                             "born_from + born_to, processed_from + processed_to or image_hash")
+    for document in documents:
+        document.pop("steps", None)
+    return documents
+
+
+class WorkerPool:
+    """Threads draining the store; model calls never run on a client connection."""
+
+    def __init__(self, store, workers=SERVICE_WORKERS):
+        self.store = store
+        self.workers = workers
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"service-worker-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _work(self):
+        while not self._stop.is_set():
+            try:
+                job = self.store.claim(timeout=1.0)
+            except Exception as e:
+                # e.g. "database is locked"; the worker keeps going rather than dying silently
+                print(f"Claiming a job failed: {e}")
+                self._stop.wait(1.0)
+                continue
+            if job is None:
+                continue
+            started = time.perf_counter()
+            try:
+                result, error = run_job(job, self.store.image_path(job["id"]))
+            except Exception as e:
+                result, error = None, str(e)
+            try:
+                self.store.finish(job["id"], result, error)
+            except Exception as e:
+                # The job stays 'running' until the service restarts
+                print(f"Recording job {job['id']} as {'failed' if error else 'done'} failed: {e}")
+                continue
+            print(f"[{'failed' if error else 'done'}] job {job['id']} ({job['task']}, "
+                  f"{time.perf_counter() - started:.2f}s)")
+
+
+def is_image(image_bytes):
+    from PIL import Image
+    try:
+        # Only reads the header; the pixels are decoded by the worker
+        with Image.open(io.BytesIO(image_bytes)):
+            return True
+    except Exception:
+        return False
+
+
+def is_loopback(host):
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return host == "localhost"
+
+
+def job_view(job):
+    view = {key: job[key] for key in ("id", "task", "status", "created_at", "started_at", "finished_at", "attempts")}
+    view["status_url"] = f"/jobs/{job['id']}"
+    view["result_url"] = f"/jobs/{job['id']}/result"
+    if job["error"]:
+        view["error"] = job["error"]
+    return view
+
+
+def _make_handler(store):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _send(self, status, body, headers=None):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            parts = [part for part in self.path.split("?")[0].split("/") if part]
+            if parts == ["health"]:
+                self._send(200, {"status": "ok", "jobs": store.counts()})
+                return
+            if parts == ["documents"]:
+                self._find_documents()
+                return
+            if len(parts) not in (2, 3) or parts[0] != "jobs" or (len(parts) == 3 and parts[2] != "result"):
+                self._send(404, {"error": "not found"})
+                return
+            job = store.get(parts[1])
+            if job is None:
+                self._send(404, {"error": "unknown job"})
+            elif len(parts) == 2:
+                self._send(200, job_view(job))
+            elif job["status"] == "done":
+                self._send(200, {"id": job["id"], "status": "done", "result": json.loads(job["result"])})
+            elif job["status"] == "failed":
+                self._send(422, {"id": job["id"], "status": "failed", "error": job["error"]})
+            else:
+                self._send(202, job_view(job), headers={"Retry-After": "1"})
+
+        def _find_documents(self):
+            from result_store import get_result_store
+            results = get_result_store()
+            if results is None:
+                self._send(404, {"error": "the result store is disabled"})
+                return
+            if not REMOTE_DOCUMENTS and not is_loopback(self.server.server_address[0]):
+                self._send(403, {"error": "document lookups are only served on a loopback address "
+                                          "(set SERVICE_REMOTE_DOCUMENTS=1 to allow them)"})
+                return
+            params = dict(parse_qsl(urlsplit(self.path).query))
+            try:
+                documents = find_documents(results, params)
+            except ValueError as e:
+                self._send(400, {"error": str(e)})
+                return
+            self._send(200, {"documents": documents})
+
+        def do_POST(self):
+            if self.path.split("?")[0].rstrip("/") != "/jobs":
+                self._send(404, {"error": "not found"})
+                return
+            length = int(self.headers.get("Content-Length", 0))
+            if length > MAX_UPLOAD_BYTES:
+                self._send(413, {"error": f"request larger than {MAX_UPLOAD_BYTES} bytes"})
+                self.close_connection = True
+                return
+            try:
+                body = json.loads(self.rfile.read(length))
+                task = body.get("doc_type", "auto")
+                image_bytes = base64.b64decode(body["image_base64"], validate=True)
+            except (ValueError, KeyError, TypeError):
+                self._send(400, {"error": 'expected JSON {"doc_type": ..., "image_base64": ...}'})
+                return
+            if task not in TASKS:
+                self._send(400, {"error": f"doc_type must be one of {', '.join(TASKS)}"})
+                return
+            if not is_image(image_bytes):
+                self._send(400, {"error": "image_base64 is not a supported image"})
+                return
+
+            # Without an explicit key the same image and task count as the same job
+            key = (self.headers.get("Idempotency-Key") or body.get("idempotency_key")
+                   or f"{task}:{hashlib.sha256(image_bytes).hexdigest()}")
+            if store.get_by_key(key) is None and store.queued_count() >= MAX_QUEUED_JOBS:
+                self._send(429, {"error": "queue is full"}, headers={"Retry-After": "5"})
+                return
+            job, created = store.submit(task, image_bytes, key)
+            self._send(202 if created else 200, job_view(job),
+                       headers={"Location": f"/jobs/{job['id']}"})
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def start_service(port=0, host="127.0.0.1", directory=SERVICE_DIR, workers=SERVICE_WORKERS):
+    """Run the HTTP server and workers on daemon threads; returns (server, pool, base_url)."""
+    store = JobStore(directory)
+    pool = WorkerPool(store, workers)
+    pool.start()
+    server = ThreadingHTTPServer((host, port), _make_handler(store))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="service", daemon=True).start()
+    return server, pool, f"http://{host}:{server.server_address[1]}"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="HTTP job service for KYC document processing.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=SERVICE_WORKERS, help="Jobs processed concurrently")
+    parser.add_argument("--directory", default=SERVICE_DIR, help="Where the job database and images are kept")
+    parser.add_argument("--fake-fireworks", metavar="LATENCY", nargs="?", const="0",
+                        help="Answer model calls from an in-process fake_fireworks server with this latency spec")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="Serve Prometheus metrics on this port")
+    args = parser.parse_args(argv)
+
+    if args.fake_fireworks is not None:
+        from fake_fireworks import FakeFireworks, start_server
+        _, base_url = start_server(FakeFireworks(latency=args.fake_fireworks))
+        os.environ["FIREWORKS_BASE_URL"] = base_url
+        os.environ.setdefault("API_KEY", "fake")
+        print(f"Model calls go to the fake server at {base_url}")
+    if args.metrics_port:
+        from metrics import start_metrics_server
+        start_metrics_server(args.metrics_port)
+
+    server, pool, base_url = start_service(args.port, args.host, args.directory, max(1, args.workers))
+    print(f"Document service listening on {base_url} with {pool.workers} workers", flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        pool.stop(timeout=5)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
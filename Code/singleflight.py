@@ -0,0 +1,113 @@
+# singleflight.py
+import asyncio
+import copy
+import threading
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.followers = 0
+
+
+class SingleFlight:
+    """Runs at most one call per key at a time; callers arriving while it runs
+    wait for it and get (a copy of) its result, or its exception.
+
+    Nothing is kept once the call finishes, finished results belong in a cache.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.counters = {"leaders": 0, "followers": 0}
+
+    def do(self, key, func, *args, **kwargs):
+        """Return (result, shared): shared is True when another caller's call produced the result."""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                self.counters["leaders"] += 1
+                leader = True
+            else:
+                call.followers += 1
+                self.counters["followers"] += 1
+                leader = False
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            # The leader's caller owns the original; followers get their own copy
+            return copy.deepcopy(call.result), True
+
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            if call.error is None and call.followers:
+                # Snapshot before the leader's caller can modify the result
+                call.result = copy.deepcopy(result)
+            call.done.set()
+        return result, False
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
+
+
+class AsyncSingleFlight:
+    """SingleFlight for coroutines on one event loop: followers await the leader's
+    future instead of blocking a thread."""
+
+    def __init__(self):
+        self._calls = {}
+        self.counters = {"leaders": 0, "followers": 0}
+
+    async def do(self, key, func, *args, **kwargs):
+        """Await func(*args, **kwargs) at most once per key at a time; returns (result, shared).
+
+        If the leader is cancelled its followers are not: the first of them to
+        wake runs the call itself and the rest follow it.
+        """
+        while key in self._calls:
+            call = self._calls[key]
+            call.followers += 1
+            self.counters["followers"] += 1
+            try:
+                # Shielded, so a follower being cancelled does not cancel the leader's call
+                return copy.deepcopy(await asyncio.shield(call.done)), True
+            except asyncio.CancelledError:
+                if not call.done.cancelled():
+                    raise
+                # The leader was cancelled, not this caller; take over or follow whoever did
+                self.counters["followers"] -= 1
+
+        call = self._calls[key] = _Call()
+        call.done = asyncio.get_running_loop().create_future()
+        self.counters["leaders"] += 1
+        try:
+            result = await func(*args, **kwargs)
+        except asyncio.CancelledError:
+            call.done.cancel()
+            raise
+        except BaseException as e:
+            call.done.set_exception(e)
+            # Marked as retrieved, so an error no follower awaited is not logged as unhandled
+            call.done.exception()
+            raise
+        finally:
+            del self._calls[key]
+        # Snapshot before the leader's caller can modify the result
+        call.done.set_result(copy.deepcopy(result) if call.followers else None)
+        return result, False
+
+    def in_flight(self):
+        return len(self._calls)
@@ -0,0 +1,34 @@
+# test_field_validation.py
+from field_validation import get_path, merge_fields, set_path
+
+
+def test_set_path_creates_missing_parents():
+    data = {}
+    set_path(data, "address.city", "ANYTOWN")
+    assert data == {"address": {"city": "ANYTOWN"}}
+
+
+def test_set_path_replaces_null_parent():
+    data = {"address": None}
+    set_path(data, "address.city", "ANYTOWN")
+    assert data == {"address": {"city": "ANYTOWN"}}
+
+
+def test_set_path_replaces_string_parent():
+    data = {"address": "123 MAIN ST ANYTOWN"}
+    set_path(data, "address.street", "123 MAIN ST")
+    assert data == {"address": {"street": "123 MAIN ST"}}
+
+
+def test_merge_fields_over_null_parent():
+    base = {"full_name": "JANE DOE", "address": None}
+    corrections = {"address": {"city": "ANYTOWN", "state": "CA"}}
+    merged = merge_fields(base, corrections, ["address.city", "address.state"])
+    assert merged == {"full_name": "JANE DOE", "address": {"city": "ANYTOWN", "state": "CA"}}
+    assert base["address"] is None
+
+
+def test_merge_fields_only_present_keeps_base():
+    base = {"address": {"city": "ANYTOWN", "state": "CA"}}
+    merged = merge_fields(base, {"address": "partial"}, ["address.city"], only_present=True)
+    assert get_path(merged, "address.city") == "ANYTOWN"
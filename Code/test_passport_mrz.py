@@ -0,0 +1,83 @@
+# test_passport_mrz.py
+import datetime
+from passport_processing import MRZ_LINE_LENGTH, _mrz_date, find_td3_lines, mrz_check_digit, parse_td3_mrz
+
+# ICAO Doc 9303 part 4 specimen passport (Utopia, Anna Maria Eriksson)
+LINE1 = "P<UTOERIKSSON<<ANNA<MARIA<<<<<<<<<<<<<<<<<<<"
+LINE2 = "L898902C36UTO7408122F1204159ZE184226B<<<<<10"
+
+
+def test_check_digit_weights():
+    # ICAO Doc 9303 part 3 worked example: 5*7 + 2*3 + 0*1 + 7*7 + 2*3 + 7*1 = 103
+    assert mrz_check_digit("520727") == "3"
+    # Letters count from A = 10 and fillers count as 0
+    assert mrz_check_digit("L898902C3") == "6"
+    assert mrz_check_digit("ZE184226B<<<<<") == "1"
+    assert mrz_check_digit("<<<<<<") == "0"
+
+
+def test_specimen_parses_with_all_checks():
+    mrz = parse_td3_mrz(LINE1, LINE2)
+    assert mrz["valid"]
+    assert all(mrz["checks"].values())
+    fields = mrz["fields"]
+    assert fields["surname"] == "ERIKSSON"
+    assert fields["given_names"] == "ANNA MARIA"
+    assert fields["passport_number"] == "L898902C3"
+    assert fields["nationality"] == "UTO"
+    assert fields["sex"] == "F"
+    assert fields["date_of_birth"] == "12 AUG 1974"
+    assert fields["expiration_date"] == "15 APR 2012"
+    assert fields["personal_number"] == "ZE184226B"
+
+
+def test_composite_check_digit():
+    composite = LINE2[0:10] + LINE2[13:20] + LINE2[21:43]
+    assert mrz_check_digit(composite) == LINE2[43] == "0"
+    # A misread in the personal number keeps its own check wrong and the composite too
+    tampered = LINE2[:28] + "ZE184226C" + LINE2[37:]
+    checks = parse_td3_mrz(LINE1, tampered)["checks"]
+    assert not checks["personal_number"]
+    assert not checks["composite"]
+    assert not parse_td3_mrz(LINE1, tampered)["valid"]
+
+
+def test_birth_century_pivot():
+    current_yy = datetime.date.today().year % 100
+    assert _mrz_date("740812", future=False) == datetime.date(1974, 8, 12)
+    assert _mrz_date(f"{current_yy:02d}0101", future=False).year == 2000 + current_yy
+    assert _mrz_date(f"{(current_yy + 1) % 100:02d}0101", future=False).year == 1900 + (current_yy + 1) % 100
+
+
+def test_expiry_is_always_this_century():
+    assert _mrz_date("120415", future=True) == datetime.date(2012, 4, 15)
+    assert _mrz_date("990101", future=True) == datetime.date(2099, 1, 1)
+
+
+def test_invalid_dates_are_rejected():
+    assert _mrz_date("741312", future=False) is None
+    assert _mrz_date("74<812", future=False) is None
+
+
+def test_find_td3_lines_pads_dropped_name_fillers():
+    raw_text = "PASSPORT\n" + LINE1[:36] + "\n" + LINE2 + "\n"
+    assert find_td3_lines(raw_text=raw_text) == (LINE1, LINE2)
+    assert len(find_td3_lines(raw_text=raw_text)[0]) == MRZ_LINE_LENGTH
+
+
+def test_find_td3_lines_does_not_pad_the_data_line():
+    raw_text = LINE1 + "\n" + LINE2.rstrip("<0") + "\n"
+    assert find_td3_lines(raw_text=raw_text) is None
+
+
+def test_find_td3_lines_accepts_spaced_json_lines():
+    extracted = {"mrz": {"line1": " ".join(LINE1[:20]) + LINE1[20:], "line2": LINE2.lower()}}
+    assert find_td3_lines(extracted) == (LINE1, LINE2)
+
+
+def test_find_td3_lines_prefers_checksum_valid_candidate():
+    misread = LINE2[:2] + "B" + LINE2[3:]
+    extracted = {"mrz": {"line1": LINE1, "line2": misread}}
+    assert find_td3_lines(extracted, raw_text=LINE1 + "\n" + LINE2) == (LINE1, LINE2)
+    # With no valid candidate the first structurally valid one is still returned
+    assert find_td3_lines(extracted, raw_text=LINE1 + "\n" + misread[:-1] + "7") == (LINE1, misread)
@@ -0,0 +1,87 @@
+# test_singleflight.py
+import asyncio
+import pytest
+from singleflight import AsyncSingleFlight
+
+
+def test_followers_share_the_leaders_result():
+    async def main():
+        flight = AsyncSingleFlight()
+        calls = []
+
+        async def work():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return {"value": 1}
+
+        results = await asyncio.gather(*(flight.do("key", work) for _ in range(3)))
+        return calls, results, flight
+
+    calls, results, flight = asyncio.run(main())
+    assert len(calls) == 1
+    assert [shared for _, shared in results] == [False, True, True]
+    assert all(result == {"value": 1} for result, _ in results)
+    assert flight.counters == {"leaders": 1, "followers": 2}
+    assert flight.in_flight() == 0
+
+
+def test_cancelled_leader_hands_the_call_to_a_follower():
+    async def main():
+        flight = AsyncSingleFlight()
+        started = []
+
+        async def work(name):
+            started.append(name)
+            await asyncio.sleep(0.05)
+            return name
+
+        leader = asyncio.create_task(flight.do("key", work, "leader"))
+        await asyncio.sleep(0)
+        followers = [asyncio.create_task(flight.do("key", work, f"follower-{i}")) for i in range(2)]
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        results = await asyncio.gather(*followers)
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return started, results, flight
+
+    started, results, flight = asyncio.run(main())
+    # One follower re-ran the call and the other shared its result
+    assert started == ["leader", "follower-0"]
+    assert results == [("follower-0", False), ("follower-0", True)]
+    assert flight.counters == {"leaders": 2, "followers": 1}
+    assert flight.in_flight() == 0
+
+
+def test_cancelled_follower_leaves_the_leader_running():
+    async def main():
+        flight = AsyncSingleFlight()
+
+        async def work():
+            await asyncio.sleep(0.02)
+            return "done"
+
+        leader = asyncio.create_task(flight.do("key", work))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(flight.do("key", work))
+        await asyncio.sleep(0)
+        follower.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await follower
+        return await leader
+
+    assert asyncio.run(main()) == ("done", False)
+
+
+def test_leader_errors_reach_followers():
+    async def main():
+        flight = AsyncSingleFlight()
+
+        async def work():
+            await asyncio.sleep(0.01)
+            raise ValueError("bad answer")
+
+        return await asyncio.gather(*(flight.do("key", work) for _ in range(2)), return_exceptions=True)
+
+    results = asyncio.run(main())
+    assert all(isinstance(result, ValueError) for result in results)